@@ -53,5 +53,16 @@ rm -rf %{buildroot}
 %{python_sitelib}/%{projectname}
 %{_datadir}/%{projectname}
 %{_bindir}/%{projectname}
+%{_bindir}/aft-results
+%{_bindir}/aft-server
+%{_bindir}/aft-client
+%{_bindir}/aft-cutterd
+%{_bindir}/aft-power
+%{_bindir}/aft-farm
+%{_bindir}/aft-classify
+%{_bindir}/aft-simulate
+%{_bindir}/aft-provision
+%{_bindir}/aft-netbootd
+%{_bindir}/aft-artifacts
 
 %changelog
@@ -40,5 +40,17 @@ setup(name=PROJECT_NAME,
                   (DATA_DOCS_PATH, []),
                  ],
       include_package_data=True,
-      entry_points={'console_scripts': ['aft = aft.main:main'],},
+      entry_points={'console_scripts': ['aft = aft.main:main',
+                                        'aft-results = aft.resultstore:main',
+                                        'aft-server = aft.server:server_main',
+                                        'aft-client = aft.server:client_main',
+                                        'aft-cutterd = aft.cutterdaemon:main',
+                                        'aft-power = aft.powersequencer:main',
+                                        'aft-farm = aft.farm:main',
+                                        'aft-classify = aft.classifier:main',
+                                        'aft-simulate = aft.farmsimulator:main',
+                                        'aft-provision = aft.provisioner:main',
+                                        'aft-netbootd = aft.netboot:main',
+                                        'aft-artifacts = aft.artifactstore:main',
+                                       ],},
      )
@@ -0,0 +1,230 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Session for performing many runs of aft in the same process.
+"""
+
+import os
+import time
+import logging
+import threading
+from ConfigParser import SafeConfigParser
+
+from aft.devicesmanager import DevicesManager
+
+VERSION = "0.1.0"
+
+
+def _signature(*file_names):
+    """
+    Identifies the current version of a set of files.
+    """
+    signature = []
+    for file_name in file_names:
+        try:
+            stat = os.stat(file_name)
+            signature.append((file_name, stat.st_size, stat.st_mtime))
+        except OSError:
+            signature.append((file_name, None, None))
+    return tuple(signature)
+
+
+class AftSession(object):
+    """
+    Holds what can be reused between runs: parsed configuration files and
+    initialized plugin classes. Everything specific to a run lives in the
+    DevicesManager and Tester instances created for it, so nothing
+    accumulates from one run to the next.
+
+    The parsed configuration files form a snapshot, which is replaced as a
+    whole when files change, never modified in place: a run pins the
+    snapshot current when it starts and keeps using it until it ends, even
+    if the files are reloaded in the meantime.
+    """
+    def __init__(self):
+        self._configs = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._device_classes = {}
+        self._topologies = {}
+        self._loaded_topologies = {}
+
+    def after_fork(self):
+        """
+        Must be called in a child process forked while other threads may
+        be using the session.
+        """
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse(file_name):
+        """
+        Returns the signature and the parser of the file, None if it can't
+        be read.
+        """
+        signature = _signature(file_name)
+        config = SafeConfigParser()
+        if not config.read(file_name):
+            return None
+        logging.debug("Parsed configuration file {0}.".format(file_name))
+        return (signature, config)
+
+    def _publish(self, changes):
+        """
+        Replaces the snapshot with a copy including the changes, a None
+        value removing the file.
+        """
+        with self._lock:
+            configs = dict(self._configs)
+            for file_name, config in changes.items():
+                if config is None:
+                    configs.pop(file_name, None)
+                else:
+                    configs[file_name] = config
+            self._configs = configs
+
+    def reload(self):
+        """
+        Re-parses the configuration files changed since they were parsed
+        and publishes them together, in a new snapshot.
+        Returns the names of the files changed.
+        """
+        changes = {}
+        for file_name, (signature, _) in self._configs.items():
+            if _signature(file_name) != signature:
+                changes[file_name] = self._parse(file_name)
+        if changes:
+            self._publish(changes)
+            logging.info("Reloaded configuration files: {0}"
+                         .format(", ".join(sorted(changes))))
+        return sorted(changes)
+
+    def start_watching(self, interval=2.0):
+        """
+        Reloads the configuration files, when they change, from a
+        background thread. Processes forking from the session must call
+        reload() themselves instead, before forking.
+        """
+        def _watch():
+            while True:
+                time.sleep(interval)
+                self.reload()
+        thread = threading.Thread(target=_watch, name="config-watcher")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def get_config(self, file_name):
+        """
+        Returns the parsed configuration file. Returns None if the file
+        can't be read. Within a run, the file is the one of the snapshot
+        pinned by the run, otherwise it is re-read if it changed.
+        The parser is shared: callers must not modify it.
+        """
+        pinned = getattr(self._local, "configs", None)
+        cached = (pinned if pinned is not None else self._configs) \
+            .get(file_name)
+        if cached is not None and \
+                (pinned is not None or cached[0] == _signature(file_name)):
+            return cached[1]
+        parsed = self._parse(file_name)
+        if parsed is None:
+            return None
+        self._publish({file_name: parsed})
+        if pinned is not None:
+            pinned[file_name] = parsed
+        return parsed[1]
+
+    def _get_signature(self, file_name):
+        """
+        Signature of the file in the pinned snapshot, if any.
+        """
+        pinned = getattr(self._local, "configs", None)
+        if pinned is not None and file_name in pinned:
+            return pinned[file_name][0]
+        return _signature(file_name)
+
+    def init_device_class(self, device_class, init_data):
+        """
+        Initializes the device class, unless already done with the same
+        parameters.
+        """
+        parms = sorted(init_data.items())
+        if self._device_classes.get(device_class) == parms:
+            return True
+        if not device_class.init_class(init_data=init_data):
+            return False
+        self._device_classes[device_class] = parms
+        return True
+
+    def init_topology(self, topology_class, topology_file_name,
+                      catalog_file_name, cutter_class):
+        """
+        Initializes the topology class, loading the catalog and probing
+        the cutters, unless already done with the same files. The topology
+        class takes the catalog and the topology from the snapshot.
+        """
+        self.get_config(catalog_file_name)
+        key = (topology_file_name, cutter_class,
+               self._get_signature(catalog_file_name))
+        if self._topologies.get(topology_class) == key:
+            return True
+        self._loaded_topologies.pop(topology_class, None)
+        topology_class.set_config_source(self.get_config)
+        if not topology_class.init(topology_file_name=topology_file_name,
+                                   catalog_file_name=catalog_file_name,
+                                   cutter_class=cutter_class):
+            return False
+        self._topologies[topology_class] = key
+        return True
+
+    def load_topology(self, topology_class, topology_file_name):
+        """
+        Loads the devices of the topology, unless the topology file didn't
+        change. Reusing the devices keeps their sessions open.
+        """
+        self.get_config(topology_file_name)
+        key = self._get_signature(topology_file_name)
+        if self._loaded_topologies.get(topology_class) == key:
+            return True
+        if not topology_class.load():
+            return False
+        self._loaded_topologies[topology_class] = key
+        return True
+
+    def preload(self, cfg_file_name=None):
+        """
+        Parses in advance the platform configuration and the catalogs,
+        topologies and test plans it references.
+        """
+        if cfg_file_name is None:
+            cfg_file_name = DevicesManager.get_default_config_file()
+        config = self.get_config(cfg_file_name)
+        if config is None:
+            logging.warn("Cannot preload {0}.".format(cfg_file_name))
+            return False
+        for file_name in DevicesManager.get_config_files(config):
+            self.get_config(file_name)
+        return True
+
+    def run(self, argv=None):
+        """
+        Performs one run of aft, with command line arguments argv
+        (without the program name).
+        """
+        self.reload()
+        self._local.configs = dict(self._configs)
+        try:
+            return DevicesManager(session=self).run(argv)
+        finally:
+            self._local.configs = None
@@ -0,0 +1,385 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Content-addressed store of the artifacts of the runs: every file is
+stored once, compressed, under the sha256 of its content, and each run
+has a manifest mapping its paths to the contents.
+
+Storing a run leaves its results directory as it is. Optionally, the
+directory becomes a view of the store, to reclaim its space: each file is
+replaced by a symbolic link to its compressed content, named after the
+file with a .gz suffix and readable with zcat and the like. Names and
+contents of the files change, so only tools aware of it can read a view;
+results.xml stays a plain file. checkout recreates the original files.
+"""
+
+import os
+import sys
+import json
+import time
+import gzip
+import shutil
+import hashlib
+import logging
+import tempfile
+from argparse import ArgumentParser
+
+VERSION = "0.1.0"
+
+ARTIFACT_ROOT = os.getenv("AFT_ARTIFACT_ROOT",
+                          os.path.join(os.getenv("AFT_STATEROOT",
+                                                 "/var/lib/aft/"),
+                                       "artifacts"))
+_CHUNK_SIZE = 1024 * 1024
+# Files kept as they are in the view, besides being stored
+_KEEP = frozenset(["results.xml"])
+# Unreferenced contents younger than this are not collected: they may
+# belong to a run being stored
+_GRACE_PERIOD = 3600
+
+
+class ArtifactStore(object):
+    """
+    Blobs in blobs/<2 hex digits>/<sha256>.gz, manifests in
+    manifests/<run name>.json .
+    """
+    def __init__(self, root=ARTIFACT_ROOT):
+        self._root = root
+        self._blobs_dir = os.path.join(root, "blobs")
+        self._manifests_dir = os.path.join(root, "manifests")
+        for dir_name in (self._blobs_dir, self._manifests_dir):
+            if not os.path.isdir(dir_name):
+                os.makedirs(dir_name)
+
+    def _blob_file_name(self, digest):
+        """
+        File holding the compressed content with digest.
+        """
+        return os.path.join(self._blobs_dir, digest[:2], digest + ".gz")
+
+    def _manifest_file_name(self, name):
+        """
+        File holding the manifest of the run.
+        """
+        return os.path.join(self._manifests_dir, name + ".json")
+
+    def put_file(self, file_name):
+        """
+        Stores the content of the file, unless already present.
+        Returns its digest and size.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        with open(file_name, "rb") as source:
+            for chunk in iter(lambda: source.read(_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                size += len(chunk)
+        digest = digest.hexdigest()
+        blob_file_name = self._blob_file_name(digest)
+        if os.path.exists(blob_file_name):
+            # Protects the blob from a collection running concurrently
+            os.utime(blob_file_name, None)
+            return digest, size
+        dir_name = os.path.dirname(blob_file_name)
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        temp_file = tempfile.NamedTemporaryFile(dir=dir_name, suffix=".tmp",
+                                                delete=False)
+        stored = False
+        try:
+            with open(file_name, "rb") as source:
+                compressed = gzip.GzipFile(filename="", mode="wb",
+                                           fileobj=temp_file, mtime=0)
+                shutil.copyfileobj(source, compressed, _CHUNK_SIZE)
+                compressed.close()
+            temp_file.close()
+            os.chmod(temp_file.name, 0444)
+            os.rename(temp_file.name, blob_file_name)
+            stored = True
+        finally:
+            if not stored:
+                temp_file.close()
+                os.unlink(temp_file.name)
+        return digest, size
+
+    def _write_manifest(self, manifest):
+        """
+        Atomically writes the manifest.
+        """
+        file_name = self._manifest_file_name(manifest["name"])
+        temp_file_name = "{0}.{1}".format(file_name, os.getpid())
+        with open(temp_file_name, "w") as temp_file:
+            json.dump(manifest, temp_file, indent=1, sort_keys=True)
+        os.rename(temp_file_name, file_name)
+
+    def load_manifest(self, name):
+        """
+        Returns the manifest of the run, None if unknown.
+        """
+        try:
+            with open(self._manifest_file_name(name)) as manifest:
+                return json.load(manifest)
+        except (IOError, ValueError):
+            return None
+
+    def manifests(self):
+        """
+        Returns the manifests of all the runs, oldest first.
+        """
+        manifests = []
+        for file_name in os.listdir(self._manifests_dir):
+            if file_name.endswith(".json"):
+                manifest = self.load_manifest(file_name[:-len(".json")])
+                if manifest is not None:
+                    manifests.append(manifest)
+        return sorted(manifests, key=lambda manifest: manifest["created"])
+
+    def store_run(self, name, results_dir, failed=False, make_view=False):
+        """
+        Stores the files of the results directory and records the
+        manifest of the run; failed runs can be retained longer. With
+        make_view, the directory is turned into a view of the store, its
+        files becoming links named <file>.gz to their compressed contents.
+        Returns the manifest, None on failure.
+        """
+        manifest = {"name": name, "created": time.time(), "failed": failed,
+                    "results_dir": os.path.abspath(results_dir),
+                    "view": make_view, "files": {}}
+        try:
+            for dir_name, _, file_names in os.walk(results_dir):
+                for file_name in file_names:
+                    full_name = os.path.join(dir_name, file_name)
+                    if os.path.islink(full_name):
+                        continue
+                    digest, size = self.put_file(full_name)
+                    manifest["files"][os.path.relpath(
+                        full_name, results_dir)] = {
+                            "sha256": digest, "size": size,
+                            "mode": os.stat(full_name).st_mode & 0777}
+            self._write_manifest(manifest)
+        except (OSError, IOError) as error:
+            logging.critical("Cannot store the artifacts of {0}: {1}"
+                             .format(results_dir, error))
+            return None
+        if make_view:
+            self._make_view(manifest)
+        logging.info("Stored {0} artifacts of {1}."
+                     .format(len(manifest["files"]), name))
+        return manifest
+
+    def _make_view(self, manifest):
+        """
+        Replaces the stored files with links to their contents.
+        """
+        for path, entry in manifest["files"].items():
+            if os.path.basename(path) in _KEEP:
+                continue
+            full_name = os.path.join(manifest["results_dir"], path)
+            try:
+                os.unlink(full_name)
+                os.symlink(self._blob_file_name(entry["sha256"]),
+                           full_name + ".gz")
+            except OSError as error:
+                logging.warn("Cannot link {0} to the store: {1}"
+                             .format(full_name, error))
+
+    def checkout(self, name, dest_dir):
+        """
+        Recreates the results directory of the run in dest_dir, with
+        plain files. Returns False if the run is unknown.
+        """
+        manifest = self.load_manifest(name)
+        if manifest is None:
+            logging.critical("Unknown run {0}.".format(name))
+            return False
+        for path, entry in manifest["files"].items():
+            full_name = os.path.join(dest_dir, path)
+            if not os.path.isdir(os.path.dirname(full_name)):
+                os.makedirs(os.path.dirname(full_name))
+            compressed = gzip.open(self._blob_file_name(entry["sha256"]))
+            try:
+                with open(full_name, "wb") as target:
+                    shutil.copyfileobj(compressed, target, _CHUNK_SIZE)
+            finally:
+                compressed.close()
+            os.chmod(full_name, entry["mode"])
+        return True
+
+    def _expired(self, max_age, keep_runs, failed_max_age):
+        """
+        Returns the manifests to delete: the ones older than max_age
+        seconds, or failed_max_age for failed runs, except the keep_runs
+        most recent ones. None disables a limit.
+        """
+        manifests = self.manifests()
+        if keep_runs:
+            manifests = manifests[:-keep_runs]
+        now = time.time()
+        expired = []
+        for manifest in manifests:
+            limit = failed_max_age if manifest["failed"] and \
+                failed_max_age is not None else max_age
+            if limit is not None and now - manifest["created"] > limit:
+                expired.append(manifest)
+        return expired
+
+    def collect(self, max_age=None, keep_runs=None, failed_max_age=None,
+                dry_run=False):
+        """
+        Deletes the runs out of the retention policy, with their views,
+        then the contents no longer referenced by any run. Returns the
+        number of runs and of contents deleted, and the bytes freed.
+        """
+        expired = self._expired(max_age, keep_runs, failed_max_age)
+        for manifest in expired:
+            logging.info("Deleting run {0}.".format(manifest["name"]))
+            if dry_run:
+                continue
+            os.unlink(self._manifest_file_name(manifest["name"]))
+            self._remove_view(manifest)
+        expired_names = set(manifest["name"] for manifest in expired)
+        referenced = set(entry["sha256"] for manifest in self.manifests()
+                         if manifest["name"] not in expired_names
+                         for entry in manifest["files"].values())
+        blobs = 0
+        freed = 0
+        now = time.time()
+        for dir_name, _, file_names in os.walk(self._blobs_dir):
+            for file_name in file_names:
+                full_name = os.path.join(dir_name, file_name)
+                stat = os.stat(full_name)
+                if file_name.split(".")[0] in referenced or \
+                        now - stat.st_mtime < _GRACE_PERIOD:
+                    continue
+                blobs += 1
+                freed += stat.st_size
+                if not dry_run:
+                    os.unlink(full_name)
+        logging.info("Collected {0} runs, {1} contents, {2} bytes."
+                     .format(len(expired), blobs, freed))
+        return len(expired), blobs, freed
+
+    def _remove_view(self, manifest):
+        """
+        Removes the view of a deleted run, if it is still a view. The
+        results directory of a run stored without a view is left alone.
+        """
+        if not manifest.get("view", True):
+            return
+        results_dir = manifest["results_dir"]
+        for path in manifest["files"]:
+            full_name = os.path.join(results_dir, path)
+            if os.path.basename(path) not in _KEEP:
+                full_name += ".gz"
+                if not os.path.islink(full_name):
+                    continue
+            try:
+                os.unlink(full_name)
+            except OSError:
+                pass
+        for dir_name, _, _ in sorted(os.walk(results_dir), reverse=True):
+            try:
+                os.rmdir(dir_name)
+            except OSError:
+                pass
+
+    def statistics(self):
+        """
+        Returns the number of runs and contents, the bytes stored and the
+        bytes the runs would take without compression and deduplication.
+        """
+        manifests = self.manifests()
+        contents = 0
+        stored = 0
+        for dir_name, _, file_names in os.walk(self._blobs_dir):
+            for file_name in file_names:
+                contents += 1
+                stored += os.path.getsize(os.path.join(dir_name, file_name))
+        return {"runs": len(manifests), "contents": contents,
+                "stored": stored,
+                "logical": sum(entry["size"] for manifest in manifests
+                               for entry in manifest["files"].values())}
+
+
+def main(argv=None):
+    """
+    Command line interface for storing, restoring and collecting runs.
+    """
+    parser = ArgumentParser(description="Manage the store of the artifacts "
+                                        "of aft runs.")
+    parser.add_argument("--root", action="store", default=ARTIFACT_ROOT,
+                        help="Root of the artifact store.")
+    commands = parser.add_subparsers(dest="command")
+    store = commands.add_parser("store",
+                                help="Store an existing results directory.")
+    store.add_argument("--name", action="store", default=None,
+                       help="Name of the run (default: the directory).")
+    store.add_argument("--view", action="store_true", default=False,
+                       help="Replace the files of the directory with "
+                            "<file>.gz links to their compressed contents.")
+    store.add_argument("results_dir")
+    checkout = commands.add_parser("checkout",
+                                   help="Recreate the files of a run.")
+    checkout.add_argument("name")
+    checkout.add_argument("dest_dir")
+    collect = commands.add_parser("gc", help="Delete the expired runs and "
+                                             "the unreferenced contents.")
+    collect.add_argument("--max-age", action="store", type=float,
+                         default=None, help="Days runs are retained.")
+    collect.add_argument("--failed-max-age", action="store", type=float,
+                         default=None,
+                         help="Days failed runs are retained.")
+    collect.add_argument("--keep-runs", action="store", type=int,
+                         default=None,
+                         help="Most recent runs always retained.")
+    collect.add_argument("--dry-run", action="store_true", default=False)
+    commands.add_parser("list", help="Stored runs.")
+    commands.add_parser("stats", help="Usage of the store.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    artifacts = ArtifactStore(args.root)
+    if args.command == "store":
+        name = args.name or os.path.basename(os.path.abspath(
+            args.results_dir))
+        if artifacts.store_run(name, args.results_dir,
+                               make_view=args.view) is None:
+            return 1
+    elif args.command == "checkout":
+        if not artifacts.checkout(args.name, args.dest_dir):
+            return 1
+    elif args.command == "gc":
+        days = lambda value: value * 86400 if value is not None else None
+        runs, contents, freed = artifacts.collect(
+            max_age=days(args.max_age), keep_runs=args.keep_runs,
+            failed_max_age=days(args.failed_max_age), dry_run=args.dry_run)
+        print("Deleted {0} runs and {1} contents, {2} bytes."
+              .format(runs, contents, freed))
+    elif args.command == "list":
+        for manifest in artifacts.manifests():
+            print("{0}\t{1}\t{2}\t{3}".format(
+                manifest["name"],
+                time.strftime("%Y-%m-%d %H:%M:%S",
+                              time.localtime(manifest["created"])),
+                "failed" if manifest["failed"] else "passed",
+                len(manifest["files"])))
+    elif args.command == "stats":
+        statistics = artifacts.statistics()
+        print("runs\t{0}\ncontents\t{1}\nstored\t{2}\nlogical\t{3}"
+              .format(statistics["runs"], statistics["contents"],
+                      statistics["stored"], statistics["logical"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Capabilities of the devices and requirements of images and test plans.
+
+Capabilities are written as a comma separated list of tags, either flags
+or name:value pairs, e.g. "ram:2048, storage:emmc, usb_hub".
+Requirements use the same names, e.g. "ram>=1024, storage:emmc, usb_hub".
+"""
+
+import re
+import logging
+
+VERSION = "0.1.0"
+
+_CAPABILITY = re.compile(r"^\s*([\w.-]+)\s*(?:[:=]\s*(.*?))?\s*$")
+_REQUIREMENT = re.compile(r"^\s*([\w.-]+)\s*(:|==|=|>=|<=|>|<)?\s*(.*?)\s*$")
+
+_COMPARISONS = {
+    "==": lambda value, limit: value == limit,
+    ">=": lambda value, limit: value >= limit,
+    "<=": lambda value, limit: value <= limit,
+    ">": lambda value, limit: value > limit,
+    "<": lambda value, limit: value < limit,
+}
+
+
+def _comparable(value, limit):
+    """
+    True if both are numbers or both are strings.
+    """
+    numbers = (int, long, float)
+    return isinstance(value, numbers) == isinstance(limit, numbers) and \
+        not isinstance(value, bool)
+
+
+def _typed(value):
+    """
+    Numbers are compared as numbers, anything else as strings.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def parse_capabilities(text):
+    """
+    Returns a dictionary from capability name to value, True for flags.
+    Malformed tags are skipped.
+    """
+    capabilities = {}
+    for tag in (text or "").split(","):
+        if not tag.strip():
+            continue
+        match = _CAPABILITY.match(tag)
+        if match is None:
+            logging.warn("Ignoring malformed capability %s", tag)
+            continue
+        capabilities[match.group(1)] = True if match.group(2) is None \
+            else _typed(match.group(2))
+    return capabilities
+
+
+def parse_requirements(text):
+    """
+    Returns a list of (name, operator, value) tuples, operator being
+    None for the presence of a flag. Malformed requirements are skipped.
+    """
+    requirements = []
+    for tag in (text or "").split(","):
+        if not tag.strip():
+            continue
+        match = _REQUIREMENT.match(tag)
+        if match is None or (match.group(2) is None) != (not match.group(3)):
+            logging.warn("Ignoring malformed requirement %s", tag)
+            continue
+        operator = match.group(2)
+        if operator in (":", "="):
+            operator = "=="
+        requirements.append((match.group(1), operator,
+                             _typed(match.group(3)) if operator else None))
+    return requirements
+
+
+class CapabilityIndex(object):
+    """
+    Inverted index from capability to the ids of the devices having it:
+    finding the devices meeting a set of requirements is an intersection
+    of sets, instead of a check of each device.
+    """
+    def __init__(self):
+        self._by_value = {}
+        self._by_name = {}
+
+    def add(self, dev_id, capabilities):
+        """
+        Indexes a device with its capabilities. A capability can have
+        many values, given as a list.
+        """
+        for name, values in capabilities.items():
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            for value in values:
+                self._by_name.setdefault(name, {}).setdefault(
+                    value, set()).add(dev_id)
+                self._by_value.setdefault((name, value), set()).add(dev_id)
+
+    def _matching(self, requirement):
+        """
+        Returns the ids of the devices meeting one requirement.
+        """
+        name, operator, limit = requirement
+        values = self._by_name.get(name, {})
+        if operator is None:
+            return set().union(*values.values())
+        if operator == "==":
+            return self._by_value.get((name, limit), set())
+        return set().union(*[dev_ids for value, dev_ids in values.items()
+                             if _comparable(value, limit) and
+                             _COMPARISONS[operator](value, limit)])
+
+    def candidates(self, requirements):
+        """
+        Returns the ids of the devices meeting all the requirements.
+        """
+        matching = None
+        for requirement in sorted(requirements,
+                                  key=lambda requirement: requirement[1]
+                                  != "=="):
+            dev_ids = self._matching(requirement)
+            matching = set(dev_ids) if matching is None else \
+                matching & dev_ids
+            if not matching:
+                return set()
+        return matching if matching is not None else \
+            set().union(*[holders for values in self._by_name.values()
+                          for holders in values.values()])
@@ -0,0 +1,152 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Bulk classification of images: which platform, model and type of device
+each one is for, and whether the farm has such a device.
+"""
+
+import re
+import sys
+import json
+import logging
+from argparse import ArgumentParser
+
+from aft.aftsession import AftSession
+from aft.devicescatalog import DevicesCatalog
+from aft.devicesmanager import DevicesManager
+from aft.capabilities import CapabilityIndex
+from aft.devicestopology import describe_device, device_capabilities, \
+    image_requirements
+
+VERSION = "0.1.0"
+
+
+class ImageClassifier(object):
+    """
+    Classifies image file names the same way a run does, against the
+    platform configuration, catalogs and topologies parsed and compiled
+    once for all the images.
+    """
+    def __init__(self, cfg_file_name=None, session=None):
+        self._session = session or AftSession()
+        self._cfg_file_name = cfg_file_name or \
+            DevicesManager.get_default_config_file()
+        self._platforms = None
+
+    def _load(self):
+        """
+        Compiles the platform regular expressions, loads the catalogs and
+        indexes the capabilities of the devices of the topologies, the way
+        the topology classes do. Returns False if the configuration can't
+        be read.
+        """
+        config = self._session.get_config(self._cfg_file_name)
+        if config is None:
+            logging.critical("Cannot read %s", self._cfg_file_name)
+            return False
+        self._platforms = []
+        catalogs = {}
+        for section in config.sections():
+            files = DevicesManager.get_platform_files(config, section)
+            if "catalog" not in files or \
+                    not config.has_option(section, "regex"):
+                logging.warn("Malformed section %s in %s", section,
+                             self._cfg_file_name)
+                continue
+            if files["catalog"] not in catalogs:
+                catalog = DevicesCatalog()
+                parsed = self._session.get_config(files["catalog"])
+                if parsed is not None:
+                    catalog.load_config(parsed)
+                catalogs[files["catalog"]] = catalog
+            catalog = catalogs[files["catalog"]]
+            index = CapabilityIndex()
+            topology = self._session.get_config(files["topology"])
+            if topology is not None:
+                for name in topology.sections():
+                    if topology.has_option(name, "model"):
+                        index.add(name, device_capabilities(
+                            describe_device(topology, name, catalog),
+                            catalog))
+            platform = config.get(section, "platform") \
+                if config.has_option(section, "platform") else None
+            self._platforms.append((re.compile(config.get(section, "regex")),
+                                    platform, catalog, index))
+        return True
+
+    def classify(self, file_name):
+        """
+        Returns a dictionary with file_name, platform, model, type and
+        present, which tells if the topology has a device able to test
+        the image. Fields that can't be determined are None.
+        """
+        if self._platforms is None and not self._load():
+            self._platforms = []
+        result = {"file_name": file_name, "platform": None, "model": None,
+                  "type": None, "present": False}
+        for regex, platform, catalog, index in self._platforms:
+            if not regex.match(file_name):
+                continue
+            entry = catalog.get_entry_by_file_name(file_name)
+            if entry is not None:
+                result.update(platform=platform, model=entry["device_model"],
+                              type=entry["device_type"],
+                              present=bool(index.candidates(
+                                  image_requirements(entry))))
+            else:
+                result.update(platform=platform)
+            break
+        return result
+
+
+def _file_names(args):
+    """
+    Yields the file names from the command line, from the list files and
+    from stdin, the latter when "-" is given or nothing else is.
+    """
+    for file_name in args.file_names:
+        if file_name != "-":
+            yield file_name
+    sources = list(args.from_file)
+    if "-" in args.file_names or not (args.file_names or args.from_file):
+        sources.append(sys.stdin)
+    for source in sources:
+        lines = open(source) if isinstance(source, basestring) else source
+        for line in lines:
+            if line.strip():
+                yield line.strip()
+
+
+def main(argv=None):
+    """
+    Command line interface: one json object per image on stdout.
+    """
+    parser = ArgumentParser(description="Classify images for testing with "
+                                        "aft.")
+    parser.add_argument("--cfg", action="store", default=None,
+                        help="Master configuration file.")
+    parser.add_argument("--from-file", action="append", default=[],
+                        help="File listing image names, one per line, can "
+                             "be repeated.")
+    parser.add_argument("file_names", nargs="*",
+                        help="Image names, - for reading them from stdin.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    classifier = ImageClassifier(cfg_file_name=args.cfg)
+    for file_name in _file_names(args):
+        sys.stdout.write(json.dumps(classifier.classify(file_name)) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,6 +14,7 @@
 Support for loading AFT plugins.
 """
 
+import logging
 from pkg_resources import iter_entry_points
 
 
@@ -21,13 +22,35 @@ from pkg_resources import iter_entry_points
 class ClassLoader(object):
     """
     Class for loading plugins.
+    Loaded classes are cached, for processes performing many runs.
     """
+    _plugins = {}
+
     @staticmethod
     def load_plugin(class_name):
         """
         Used to load dynamically one of the classes available.
         """
-        for obj in iter_entry_points(group="aft_plugins",
-                                     name=class_name.lower()):
-            return obj.load()
+        name = class_name.lower()
+        if name not in ClassLoader._plugins:
+            for obj in iter_entry_points(group="aft_plugins", name=name):
+                ClassLoader._plugins[name] = obj.load()
+                break
+            else:
+                return None
+        return ClassLoader._plugins[name]
+
+    @staticmethod
+    def preload_plugins():
+        """
+        Imports all the plugins available, e.g. before forking workers.
+        Returns the number of plugins loaded.
+        """
+        for obj in iter_entry_points(group="aft_plugins"):
+            try:
+                ClassLoader._plugins[obj.name] = obj.load()
+            except ImportError as error:
+                logging.warn("Cannot load plugin {0}: {1}"
+                             .format(obj.name, error))
+        return len(ClassLoader._plugins)
 # pylint: enable=too-few-public-methods
@@ -17,10 +17,11 @@ Abstract Model of a Command Line tool.
 import abc
 import sys
 import logging
+import threading
 import subprocess
-import multiprocessing
 
 from collections import namedtuple
+from aft.concurrency import run_async, current_cancellation
 
 VERSION = "0.1.0"
 
@@ -68,56 +69,92 @@ class CmdLineTool(object):
     @classmethod
     def _run(cls, parms=(), timeout=-1, verbose=False):
         """
-        Runs the command in a separate thread, with timeout.
+        Runs the command with timeout.
         """
-        result_q = multiprocessing.Queue()
-        result = None
-        process = multiprocessing.Process(target=_runner,
-                                          args=[cls.command, parms,
-                                                result_q, verbose])
         timeout = cls._timeout if timeout == -1 else timeout
-        try:
-            process.start()
-            process.join(timeout=timeout)
-            if process.is_alive():
-                process.terminate()
-                process.join()
-            else:
-                result = result_q.get()
-        except multiprocessing.TimeoutError:
-            logging.warn("Command timedout:"
-                         "{0} {1}".format(cls.command, parms))
+        command = (cls.command,) + tuple(parms)
+        result = run_command(command, timeout=timeout, verbose=verbose,
+                             stderr=subprocess.STDOUT)
+        if result is not None and result.returncode != 0:
+            logging.debug("Error running:\n%s\n* returncode: %s\n"
+                          "* stdout: %s\n* stderr: %s\n", command,
+                          result.returncode, result.stdoutdata,
+                          result.stderrdata)
         if cls._exit_on_error and result is None:
             sys.exit(-1)
         return result
 
+    @classmethod
+    def _run_async(cls, parms=(), timeout=-1, verbose=False):
+        """
+        Runs the command in background, returning a Future.
+        """
+        return run_async(cls._run, parms=parms, timeout=timeout,
+                         verbose=verbose)
+
 
-def _runner(command, parms, result_q, verbose=False):
+# pylint: disable=too-many-arguments
+def run_command(command, timeout, verbose=False, stdin=None,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE):
     """
-    Executes the command with the given parameters.
-    It's meant to run from a thread with timeout.
+    Executes the command, killing it if it exceeds the timeout.
+    Waiting happens in the calling thread, so that many commands can be
+    supervised concurrently without a process for each of them.
+    Within a Cancellation, the timeout is bounded by its deadline and the
+    command is killed if the work is cancelled, or not started at all if
+    it already is.
+    Returns None in case of timeout or cancellation; a process killed by
+    another signal has the negative signal number as returncode.
     """
+    if verbose:
+        logging.debug("%s", command)
+    cancellation = current_cancellation()
+    if cancellation is not None:
+        if cancellation.cancelled():
+            logging.warn("Work cancelled, not running: %s", command)
+            return None
+        timeout = cancellation.bound(timeout)
     try:
-        command = (command,) + parms
-        if verbose:
-            logging.debug("{0}".format(command))
-        process = subprocess.Popen(command,
-                                   stderr=subprocess.STDOUT,
-                                   stdout=subprocess.PIPE,)
-        stdoutdata, stderrdata = process.communicate()
-        result = CmdResult(returncode=process.returncode,
-                           stdoutdata=stdoutdata,
-                           stderrdata=stderrdata)
-        if result.returncode != 0:
-            logging.debug("Error running:\n{0}\n".format(command) +
-                          "* returncode: {0}\n".format(result.returncode) +
-                          "* stdout: {0}\n".format(result.stdoutdata) +
-                          "* stderr: {0}\n".format(result.stderrdata))
+        process = subprocess.Popen(command, stdin=stdin, stdout=stdout,
+                                   stderr=stderr)
     except OSError as error:
-        result = CmdResult(returncode=error.errno, stdoutdata="",
-                           stderrdata=error.strerror)
-        logging.debug("OSError running:\n{0}\n".format(command) +
-                      "* returncode: {0}\n".format(result.returncode) +
-                      "* error message {0}\n".format(result.stderrdata))
-    result_q.put(result)
+        logging.debug("OSError running:\n%s\n* returncode: %s\n"
+                      "* error message %s\n", command, error.errno,
+                      error.strerror)
+        return CmdResult(returncode=error.errno, stdoutdata="",
+                         stderrdata=error.strerror)
+    if cancellation is not None:
+        cancellation.add_process(process)
+    timed_out = threading.Event()
+
+    def kill():
+        """
+        Kills the process on timeout, telling it apart from other signals.
+        """
+        timed_out.set()
+        process.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.daemon = True
+    timer.start()
+    try:
+        stdoutdata, stderrdata = process.communicate()
+    finally:
+        timer.cancel()
+        timer.join()
+        if cancellation is not None:
+            cancellation.remove_process(process)
+    if timed_out.is_set():
+        logging.warn("Command timedout: %s", command)
+        return None
+    if cancellation is not None and cancellation.cancelled() and \
+            process.returncode < 0:
+        logging.warn("Command cancelled: %s", command)
+        return None
+    if process.returncode < 0:
+        logging.warn("Command killed by signal %s: %s", -process.returncode,
+                     command)
+    return CmdResult(returncode=process.returncode, stdoutdata=stdoutdata,
+                     stderrdata=stderrdata)
+# pylint: enable=too-many-arguments
 # pylint: enable=too-few-public-methods
@@ -0,0 +1,341 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Lightweight concurrent execution, for driving many devices from one
+single process.
+"""
+
+import sys
+import time
+import Queue
+import logging
+import threading
+
+from aft.logpipeline import get_context, set_context
+
+VERSION = "0.1.0"
+
+_local = threading.local()
+
+
+class Future(object):
+    """
+    Result of an operation running in background.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self.context = get_context()
+        self.cancellation = current_cancellation()
+
+    def done(self):
+        """
+        True when the operation has completed.
+        """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for completion, returns False on timeout.
+        """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Returns the value produced by the operation, or None if it didn't
+        complete within timeout. Exceptions are re-raised in the caller.
+        """
+        if not self.wait(timeout):
+            return None
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def add_done_callback(self, callback):
+        """
+        Calls callback(future) on completion, or immediately if the
+        operation has already completed.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _complete(self, result, exc_info):
+        """
+        Stores the outcome and notifies waiters and callbacks.
+        """
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def run(self, function, *args, **kwargs):
+        """
+        Executes the operation in the calling thread, within the
+        cancellation of the thread which created the future.
+        """
+        set_context(**self.context)
+        try:
+            with self.cancellation or Cancellation():
+                result = function(*args, **kwargs)
+        # pylint: disable=broad-except
+        except Exception:
+            logging.exception("Error in background operation {0}"
+                              .format(function))
+            self._complete(None, sys.exc_info())
+        # pylint: enable=broad-except
+        else:
+            self._complete(result, None)
+
+
+def run_async(function, *args, **kwargs):
+    """
+    Starts function in a dedicated background thread.
+    """
+    future = Future()
+    thread = threading.Thread(target=future.run,
+                              args=(function,) + args, kwargs=kwargs)
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+class Deadline(object):
+    """
+    Point in time by which an operation must be over, never later than the
+    deadline of the operation containing it. Without timeout nor parent,
+    there is no limit.
+    """
+    def __init__(self, timeout=None, parent=None):
+        self._expiry = None
+        if timeout is not None:
+            self._expiry = time.time() + timeout
+        if parent is not None and parent._expiry is not None:
+            self._expiry = parent._expiry if self._expiry is None else \
+                min(self._expiry, parent._expiry)
+
+    def child(self, timeout=None):
+        """
+        Deadline of an operation contained in this one.
+        """
+        return Deadline(timeout, parent=self)
+
+    def remaining(self):
+        """
+        Seconds left, None if there is no limit.
+        """
+        if self._expiry is None:
+            return None
+        return max(0, self._expiry - time.time())
+
+    def bound(self, timeout):
+        """
+        timeout, shortened not to exceed the deadline.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+    def expired(self):
+        """
+        True once the deadline has passed.
+        """
+        return self._expiry is not None and time.time() >= self._expiry
+
+
+class Cancellation(object):
+    """
+    Work which can be cancelled as a whole: the commands started for it by
+    run_command, from any thread within it, are bounded by its deadline,
+    killed when it, or its parent, is cancelled and refused afterwards.
+    A thread is within it between __enter__ and __exit__, and so are the
+    futures the thread creates meanwhile.
+    """
+    def __init__(self, deadline=None, parent=None):
+        self.deadline = deadline or Deadline()
+        self._parent = parent
+        self._cancelled = False
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def child(self, deadline=None):
+        """
+        Cancellation of work contained in this one.
+        """
+        return Cancellation(deadline, parent=self)
+
+    def cancelled(self):
+        """
+        True once this or a parent has been cancelled.
+        """
+        return self._cancelled or \
+            (self._parent is not None and self._parent.cancelled())
+
+    def bound(self, timeout):
+        """
+        timeout, shortened not to exceed the deadline.
+        """
+        return self.deadline.bound(timeout)
+
+    def cancel(self):
+        """
+        Kills the processes still running for the work, and makes further
+        ones be refused.
+        """
+        with self._lock:
+            self._cancelled = True
+            processes = list(self._processes)
+        for process in processes:
+            _kill(process)
+        return True
+
+    def add_process(self, process):
+        """
+        Registers a process started for the work, killing it at once if
+        the work has been cancelled. Returns False in that case.
+        """
+        cancellation = self
+        while cancellation is not None:
+            with cancellation._lock:
+                cancellation._processes.add(process)
+            cancellation = cancellation._parent
+        if self.cancelled():
+            _kill(process)
+            return False
+        return True
+
+    def remove_process(self, process):
+        """
+        Forgets a process which has exited.
+        """
+        cancellation = self
+        while cancellation is not None:
+            with cancellation._lock:
+                cancellation._processes.discard(process)
+            cancellation = cancellation._parent
+
+    def __enter__(self):
+        if not hasattr(_local, "cancellations"):
+            _local.cancellations = []
+        _local.cancellations.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.cancellations.pop()
+        return False
+
+
+def _kill(process):
+    """
+    Kills a process, unless already gone.
+    """
+    try:
+        process.kill()
+    except OSError:
+        pass
+
+
+def current_cancellation():
+    """
+    Returns the innermost cancellation the calling thread is within, None
+    if there is none.
+    """
+    cancellations = getattr(_local, "cancellations", None)
+    return cancellations[-1] if cancellations else None
+
+
+def run_until(deadline, function, *args, **kwargs):
+    """
+    Calls function, giving up on it if it's still running when deadline
+    expires: it's left running in background, so the caller must stop it
+    some other way, e.g. by power cycling the device it's blocked on.
+    Returns True and the value produced, or False and None on expiry.
+    Exceptions are re-raised in the caller.
+    """
+    if deadline is None or deadline.remaining() is None:
+        return True, function(*args, **kwargs)
+    future = run_async(function, *args, **kwargs)
+    if not future.wait(deadline.remaining()):
+        return False, None
+    return True, future.result(0)
+
+
+def gather(futures, timeout=None):
+    """
+    Waits for all the futures, within a global timeout, and returns their
+    results, None for the ones still running.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    results = []
+    for future in futures:
+        remaining = None if deadline is None else \
+            max(0, deadline - time.time())
+        future.wait(remaining)
+        results.append(future.result(0) if future.done() else None)
+    return results
+
+
+class WorkerPool(object):
+    """
+    Fixed number of worker threads consuming operations from a queue:
+    bounds the concurrency, e.g. when supervising hundreds of devices.
+    """
+    def __init__(self, workers):
+        self._queue = Queue.Queue()
+        self._threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        """
+        Executes the queued operations, until shutdown.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, function, args, kwargs = item
+            future.run(function, *args, **kwargs)
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues function for execution, returns its Future.
+        """
+        future = Future()
+        self._queue.put((future, function, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stops the workers, after the operations already queued.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
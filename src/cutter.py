@@ -14,8 +14,45 @@
 Base class for Cutter devices.
 """
 
+import os
 import abc
+import json
+import socket
+import logging
 from aft.cmdlinetool import CmdLineTool
+from aft.concurrency import run_async
+
+DAEMON_SOCKET = os.getenv("AFT_CUTTER_SOCKET", "/var/run/aft/cutter.sock")
+DAEMON_TIMEOUT = 30
+
+
+def daemon_request(timeout=DAEMON_TIMEOUT, **request):
+    """
+    Sends a request to the cutter daemon and returns its reply, or None
+    if the daemon is not running. Once the request is sent, a daemon not
+    replying within timeout is an error reply: it may still execute it.
+    """
+    if not os.path.exists(DAEMON_SOCKET):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(DAEMON_SOCKET)
+    except socket.error as error:
+        logging.warn("Cutter daemon not available: %s", error)
+        connection.close()
+        return None
+    try:
+        connection.sendall(json.dumps(request) + "\n")
+        reply = connection.makefile("r").readline()
+        if not reply:
+            return {"error": "The cutter daemon closed the connection."}
+        return json.loads(reply)
+    except (socket.error, ValueError) as error:
+        return {"error": "No valid reply from the cutter daemon: {0}"
+                         .format(error)}
+    finally:
+        connection.close()
 
 
 # pylint: disable=no-init
@@ -26,6 +63,39 @@ class Cutter(CmdLineTool):
     DEFAULT_TIMEOUT = 5
     __metaclass__ = abc.ABCMeta
 
+    # Channel changes go through the cutter daemon, when it is running.
+    # The daemon itself clears this, to drive the hardware directly.
+    use_daemon = True
+    _channel_states = {}
+    # True when the cutters are the ones served by the daemon
+    _served = False
+
+    @classmethod
+    def init_served(cls):
+        """
+        Takes the cutters and their channels from the daemon, when it is
+        running and serves this class: the hardware is probed once, by the
+        daemon, not by each process. Returns False if the daemon doesn't
+        serve the cutters, which must then be initialized with init.
+        """
+        cls._served = False
+        if not cls.use_daemon:
+            return False
+        reply = daemon_request(op="cutters", cutter_class=cls.__name__)
+        if reply is None or "error" in reply:
+            return False
+        cls._types = []
+        cls._cutters = [_ServedCutter(cls.__name__, cutter["cutter_id"])
+                        for cutter in reply["cutters"]]
+        cls._channels = [CutterChannel(cutter=served, channel_id=channel_id)
+                         for served, cutter in zip(cls._cutters,
+                                                   reply["cutters"])
+                         for channel_id in cutter["channels"]]
+        cls._served = True
+        logging.info("Cutters served by the daemon: %s",
+                     [cutter["cutter_id"] for cutter in reply["cutters"]])
+        return True
+
     @classmethod
     def init_class(cls, command=None, timeout=DEFAULT_TIMEOUT,
                    exit_on_error=False):
@@ -35,6 +105,12 @@ class Cutter(CmdLineTool):
         cls._types = []
         cls._cutters = []
         cls._channels = []
+        if cls.use_daemon and (daemon_request(
+                op="ping", cutter_class=cls.__name__) or {}).get("result"):
+            cls.command = command
+            cls._exit_on_error = exit_on_error
+            cls._timeout = timeout
+            return True
         return super(Cutter, cls).init_class(command=command,
                                              timeout=timeout,
                                              exit_on_error=exit_on_error)
@@ -74,28 +150,168 @@ class Cutter(CmdLineTool):
         Returns the channel with channel_id which belongs to cutter_id
         """
 
+    @classmethod
+    def get_channel(cls, cutter_id, channel_id):
+        """
+        Returns the channel with channel_id which belongs to cutter_id,
+        among the ones served by the daemon, if it serves the cutters.
+        """
+        if not cls._served:
+            return cls.get_channel_by_id_and_cutter_id(cutter_id, channel_id)
+        for channel in cls._channels:
+            if channel.get_cutter().get_cutter_id() == str(cutter_id) and \
+                    str(channel.get_id()) == str(channel_id):
+                return channel
+        logging.critical("Channel %s of cutter %s not served by the daemon.",
+                         channel_id, cutter_id)
+        return None
+
     @abc.abstractmethod
     def _set_channel_connected_state(self, channel_id, connected):
         """
         Method programming the state of a channel
         """
 
+    def get_cutter_id(self):
+        """
+        Identifies the cutter across processes: its cutter_id, the stable
+        hardware id defined by the plugin, e.g. a serial number. None if the
+        plugin defines none, in which case the daemon cannot route requests
+        to the cutter and it is driven directly.
+        """
+        cutter_id = getattr(self, "cutter_id", None)
+        if cutter_id is None:
+            return None
+        return str(cutter_id)
+
+    def _change_channel_state(self, channel_id, connected):
+        """
+        Programs the state of a channel, through the daemon if available.
+        The hardware is driven directly only if the daemon is unreachable:
+        an error replied by the daemon is a failure.
+        """
+        reply = None
+        if self.use_daemon and self.get_cutter_id() is not None:
+            reply = daemon_request(op="set", cutter_class=type(self).__name__,
+                                   cutter_id=self.get_cutter_id(),
+                                   channel_id=channel_id, connected=connected)
+        if reply is not None:
+            if "error" in reply:
+                logging.critical("Cutter daemon failed to set channel %s of "
+                                 "cutter %s: %s", channel_id,
+                                 self.get_cutter_id(), reply["error"])
+                return False
+            result = reply.get("result")
+        else:
+            result = self._set_channel_connected_state(channel_id=channel_id,
+                                                       connected=connected)
+        if result:
+            Cutter._channel_states[(self, channel_id)] = connected
+        return result
+
+    def get_channel_state(self, channel_id):
+        """
+        Returns True if the channel is connected, False if disconnected and
+        None if unknown. The state is the one last programmed, by this
+        process or, when it is running, by any client of the daemon.
+        """
+        if self.use_daemon and self.get_cutter_id() is not None:
+            reply = daemon_request(op="get", cutter_class=type(self).__name__,
+                                   cutter_id=self.get_cutter_id(),
+                                   channel_id=channel_id)
+            if reply is not None:
+                if "error" in reply:
+                    logging.warn("Cutter daemon failed to get channel %s of "
+                                 "cutter %s: %s", channel_id,
+                                 self.get_cutter_id(), reply["error"])
+                return reply.get("connected")
+        return Cutter._channel_states.get((self, channel_id))
+
     def connect_channel(self, channel_id):
         """
         Method connecting a channel
         """
-        return self._set_channel_connected_state(channel_id=channel_id,
-                                                 connected=True)
+        return self._change_channel_state(channel_id=channel_id,
+                                          connected=True)
 
     def disconnect_channel(self, channel_id):
         """
         Method disconnecting a channel
         """
-        return self._set_channel_connected_state(channel_id=channel_id,
-                                                 connected=False)
+        return self._change_channel_state(channel_id=channel_id,
+                                          connected=False)
 # pylint: enable=no-init
 
 
+class _ServedCutter(object):
+    """
+    Cutter owned by the daemon, known only by its cutter_id: its channels
+    are programmed and read through the daemon, never directly.
+    """
+    def __init__(self, cutter_class, cutter_id):
+        self._cutter_class = cutter_class
+        self.cutter_id = cutter_id
+
+    def __repr__(self):
+        return "ServedCutter({0}, {1})".format(self._cutter_class,
+                                               self.cutter_id)
+
+    def get_cutter_id(self):
+        """
+        Same as Cutter.get_cutter_id .
+        """
+        return self.cutter_id
+
+    def _request(self, **request):
+        """
+        Sends a request about this cutter to the daemon, returns its reply,
+        an error one if the daemon is gone.
+        """
+        reply = daemon_request(cutter_class=self._cutter_class,
+                               cutter_id=self.cutter_id, **request)
+        if reply is None:
+            return {"error": "The cutter daemon is not running."}
+        return reply
+
+    def _change_channel_state(self, channel_id, connected):
+        """
+        Programs the state of a channel, through the daemon.
+        """
+        reply = self._request(op="set", channel_id=channel_id,
+                              connected=connected)
+        if "error" in reply:
+            logging.critical("Cutter daemon failed to set channel %s of "
+                             "cutter %s: %s", channel_id, self.cutter_id,
+                             reply["error"])
+            return False
+        return reply.get("result")
+
+    def get_channel_state(self, channel_id):
+        """
+        Same as Cutter.get_channel_state .
+        """
+        reply = self._request(op="get", channel_id=channel_id)
+        if "error" in reply:
+            logging.warn("Cutter daemon failed to get channel %s of "
+                         "cutter %s: %s", channel_id, self.cutter_id,
+                         reply["error"])
+        return reply.get("connected")
+
+    def connect_channel(self, channel_id):
+        """
+        Same as Cutter.connect_channel .
+        """
+        return self._change_channel_state(channel_id=channel_id,
+                                          connected=True)
+
+    def disconnect_channel(self, channel_id):
+        """
+        Same as Cutter.disconnect_channel .
+        """
+        return self._change_channel_state(channel_id=channel_id,
+                                          connected=False)
+
+
 class CutterChannel(object):
     """
     Cutters have variable number of channels,
@@ -128,3 +344,21 @@ class CutterChannel(object):
         Disconnect the device.
         """
         return self._cutter.disconnect_channel(channel_id=self._channel_id)
+
+    def is_connected(self):
+        """
+        Returns the last known state of the channel, None if unknown.
+        """
+        return self._cutter.get_channel_state(channel_id=self._channel_id)
+
+    def connect_async(self):
+        """
+        Connect the device in background, returning a Future.
+        """
+        return run_async(self.connect)
+
+    def disconnect_async(self):
+        """
+        Disconnect the device in background, returning a Future.
+        """
+        return run_async(self.disconnect)
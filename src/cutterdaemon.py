@@ -0,0 +1,234 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Per-host daemon owning the cutters: the aft processes send it their
+channel changes, which are serialized per cutter and coalesced.
+"""
+
+import os
+import sys
+import json
+import errno
+import signal
+import logging
+import threading
+import SocketServer
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+from aft.cutter import Cutter, DAEMON_SOCKET
+from aft.classloader import ClassLoader
+from aft.concurrency import Future
+from aft.logpipeline import setup_logging
+
+VERSION = "0.1.0"
+
+
+class _CutterQueue(object):
+    """
+    Applies the channel changes of one cutter, one at a time, from a
+    dedicated thread. Requests for a channel arriving while a previous one
+    is still queued are merged with it: the last requested state wins and
+    all the requesters get the outcome of programming it.
+    """
+    def __init__(self, cutter):
+        self._cutter = cutter
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self.states = {}
+        thread = threading.Thread(target=self._worker,
+                                  name="cutter-" + cutter.get_cutter_id())
+        thread.daemon = True
+        thread.start()
+
+    def request(self, channel_id, connected):
+        """
+        Queues a change of state, returns a Future with its outcome.
+        """
+        with self._condition:
+            entry = self._pending.get(channel_id)
+            if entry is None:
+                entry = self._pending[channel_id] = [connected, Future()]
+            else:
+                logging.debug("Coalescing request for channel %s of %s",
+                              channel_id, self._cutter.get_cutter_id())
+                entry[0] = connected
+            self._condition.notify()
+            return entry[1]
+
+    def _apply(self, channel_id, connected):
+        """
+        Programs the hardware.
+        """
+        # pylint: disable=protected-access
+        result = bool(self._cutter._set_channel_connected_state(
+            channel_id=channel_id, connected=connected))
+        # pylint: enable=protected-access
+        if result:
+            self.states[channel_id] = connected
+        return result
+
+    def _worker(self):
+        """
+        Serves the queued requests, oldest channel first.
+        """
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                channel_id, (connected, future) = \
+                    self._pending.popitem(last=False)
+            future.run(self._apply, channel_id, connected)
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    """
+    One json request per line, one json reply per line.
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                reply = self.server.daemon.serve(request)
+            except (ValueError, KeyError, TypeError) as error:
+                reply = {"error": str(error)}
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Threaded server on a Unix socket.
+    """
+    daemon_threads = True
+
+
+class CutterDaemon(object):
+    """
+    Owns the cutters of one class, as found by its probing.
+    """
+    def __init__(self, cutter_class):
+        self._cutter_class = cutter_class
+        self._queues = {}
+        self._channel_ids = {}
+        self._unserved = 0
+
+    def init(self):
+        """
+        Probes the cutters, driving them directly.
+        """
+        Cutter.use_daemon = False
+        if not self._cutter_class.init():
+            return False
+        for channel in self._cutter_class.get_channels():
+            cutter = channel.get_cutter()
+            cutter_id = cutter.get_cutter_id()
+            if cutter_id is None:
+                logging.warn("Cutter %s has no hardware id, not served.",
+                             cutter)
+                self._unserved += 1
+                continue
+            if cutter_id not in self._queues:
+                self._queues[cutter_id] = _CutterQueue(cutter)
+            self._channel_ids.setdefault(cutter_id, []).append(
+                channel.get_id())
+        logging.info("Cutters found: %s", sorted(self._queues))
+        return True
+
+    def serve(self, request):
+        """
+        Executes one request, returns the reply.
+        """
+        if request["op"] == "ping":
+            return {"result": request.get("cutter_class") ==
+                              self._cutter_class.__name__}
+        if request.get("cutter_class") != self._cutter_class.__name__:
+            return {"error": "Cutter class {0} not served."
+                             .format(request.get("cutter_class"))}
+        if request["op"] == "cutters":
+            # The clients probe the cutters themselves, to find them all
+            if self._unserved:
+                return {"error": "Cutters without hardware id."}
+            return {"cutters": [{"cutter_id": cutter_id, "channels": ids}
+                                for cutter_id, ids in
+                                sorted(self._channel_ids.items())]}
+        queue = self._queues.get(request["cutter_id"])
+        if queue is None:
+            return {"error": "Unknown cutter {0}."
+                             .format(request["cutter_id"])}
+        channel_id = request["channel_id"]
+        if request["op"] == "get":
+            return {"connected": queue.states.get(channel_id)}
+        if request["op"] == "set":
+            future = queue.request(channel_id, bool(request["connected"]))
+            try:
+                return {"result": future.result()}
+            # pylint: disable=broad-except
+            except Exception as error:
+                return {"error": str(error)}
+            # pylint: enable=broad-except
+        return {"error": "Unknown request {0}.".format(request["op"])}
+
+    def serve_forever(self, socket_name=DAEMON_SOCKET):
+        """
+        Accepts requests on the Unix socket, until interrupted.
+        """
+        dir_name = os.path.dirname(socket_name)
+        if dir_name and not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        try:
+            os.unlink(socket_name)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+        server = _UnixServer(socket_name, _RequestHandler)
+        server.daemon = self
+        os.chmod(socket_name, 0660)
+        logging.info("Serving cutters on %s", socket_name)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(socket_name)
+
+
+def main(argv=None):
+    """
+    Entry point of the cutter daemon.
+    """
+    parser = ArgumentParser(description="Serve the cutters of this host "
+                                        "to the aft processes.")
+    parser.add_argument("--socket", action="store", default=DAEMON_SOCKET,
+                        help="Unix socket to listen on.")
+    parser.add_argument("cutter_class",
+                        help="Name of the cutter plugin, e.g. ClewareCutter.")
+    args = parser.parse_args(argv)
+    setup_logging(file_name="aft-cutterd.log")
+    cutter_class = ClassLoader.load_plugin(args.cutter_class)
+    if cutter_class is None:
+        logging.critical("Cutter class %s not found.", args.cutter_class)
+        return 1
+    daemon = CutterDaemon(cutter_class)
+    if not daemon.init():
+        logging.critical("Cannot initialize the cutters.")
+        return 1
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.serve_forever(args.socket)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,7 +16,15 @@ Class representing a DUT.
 
 
 import abc
-from aft.tester import Tester
+import time
+import logging
+import tempfile
+from aft.concurrency import run_async, Cancellation
+from aft.netboot import unpack_image, write_boot_config, clear_boot_config
+from aft.readiness import ExecuteProbe, wait_for_probes
+from aft.remotesession import SessionPool
+from aft.filetransfer import create_archive, extract_archive, \
+    local_digests, parse_digests
 
 VERSION = "0.1.0"
 
@@ -26,6 +34,13 @@ class Device(object):
     Abstract class representing a DUT.
     """
     __metaclass__ = abc.ABCMeta
+    # Subclass of RemoteSession used by execute_in_session
+    _session_class = None
+    _session_pool = None
+    # Scratch file on the device, for transfers without streaming support
+    _REMOTE_ARCHIVE = "/tmp/aft_transfer.tar"
+    TRANSFER_TIMEOUT = 300
+    BOOT_TIMEOUT = 300
 
     def __init__(self, device_descriptor, channel):
         self.name = device_descriptor["name"]
@@ -33,6 +48,12 @@ class Device(object):
         self.dev_id = device_descriptor["id"]
         self.channel = channel
         self.catalog_entry = device_descriptor["catalog_entry"]
+        self.mac = device_descriptor.get("mac")
+        self.boot_time = None
+        self._power_on_time = None
+        # Bumped by cancel: the work of older generations is cancelled
+        self.generation = 0
+        self._cancellation = Cancellation()
 
     @abc.abstractmethod
     def is_in_test_mode(self):
@@ -52,41 +73,294 @@ class Device(object):
         Writes the specified image to the device.
         """
 
-    def test(self):
+    def deploy_image(self, file_name):
+        """
+        Deploys the image as the catalog entry of the device says:
+        deploy = write (the default) writes it to the storage of the
+        device, deploy = netboot serves it over the network.
+        """
+        if self.catalog_entry.get("deploy", "write") == "netboot":
+            return self.netboot_image(file_name)
+        clear_boot_config(self.dev_id, mac=self.mac)
+        return self.write_image(file_name)
+
+    def netboot_image(self, file_name):
+        """
+        Unpacks the image on the host, unless already done, points the
+        boot configuration of the device to it and power cycles the
+        device, which is expected to boot from the network.
+        """
+        image_dir = unpack_image(file_name)
+        if image_dir is None or not write_boot_config(
+                self.dev_id, image_dir, self.catalog_entry, mac=self.mac):
+            return False
+        logging.info("Booting {0} from the network.".format(self.name))
+        self.detach()
+        return self.attach()
+
+    def write_image_async(self, file_name):
+        """
+        Writes the image in background, returning a Future.
+        """
+        return run_async(self.write_image, file_name)
+
+    def boot_deployed_image(self):
+        """
+        Boots the image already present on the device, when the write
+        is skipped. The default version power cycles the device.
+        """
+        self.detach()
+        return self.attach()
+
+    def verify_image(self, fingerprint):
+        """
+        Optional lightweight check, run after boot_deployed_image, that the
+        device really runs the image described by fingerprint.
+        The default version trusts the recorded fingerprint.
+        """
+        return True
+
+    def test(self, tester):
         """
         Runs the tests associated with the specified image.
         """
-        return Tester.test(device=self)
+        return tester.test(device=self)
+
+    def cancellation(self, deadline=None):
+        """
+        Returns the Cancellation of some work on the device, bounded by
+        deadline, belonging to the current generation: within it, the
+        commands of execute and of the other operations are bounded by the
+        deadline and killed by cancel.
+        """
+        return self._cancellation.child(deadline)
+
+    def cancel(self):
+        """
+        Cancels the work of the current generation, killing the commands
+        it is still running and refusing new ones, e.g. once its deadline
+        expired. Work started afterwards belongs to the next generation.
+        """
+        cancellation = self._cancellation
+        self._cancellation = Cancellation()
+        self.generation += 1
+        return cancellation.cancel()
 
     def detach(self):
         """
         Open the associated cutter channel.
         """
+        self.close_sessions()
         return self.channel.disconnect()
 
     def attach(self):
         """
         Close the associated cutter channel.
         """
+        self._power_on_time = time.time()
         return self.channel.connect()
 
+    def _get_readiness_probes(self):
+        """
+        Probes telling that the device is ready for testing, in the order
+        they are expected to succeed. Plugins can prepend cheaper probes,
+        e.g. a pattern on the serial console or the ssh port opening.
+        """
+        return [ExecuteProbe(self)]
+
+    def _expected_boot_time(self):
+        """
+        How long the device is expected to take for booting: the last
+        measurement, or the value from the catalog, if any.
+        """
+        if self.boot_time is not None:
+            return self.boot_time
+        try:
+            return float(self.catalog_entry.get("expected_boot_time", 0))
+        except ValueError:
+            return 0
+
+    def wait_until_ready(self, timeout=BOOT_TIMEOUT, probes=None):
+        """
+        Waits, up to timeout seconds, for all the readiness probes to
+        succeed and records the boot time, measured from power on.
+        Polling starts at half of the expected boot time and then backs
+        off exponentially, so that testing can start as soon as possible.
+        """
+        if probes is None:
+            probes = self._get_readiness_probes()
+        start_time = self._power_on_time or time.time()
+        initial_delay = max(0, self._expected_boot_time() / 2 -
+                            (time.time() - start_time))
+        logging.info("Waiting for {0} to become ready.".format(self.name))
+        if not wait_for_probes(probes, timeout, initial_delay=initial_delay):
+            logging.critical("Device {0} not ready after {1}s."
+                             .format(self.name, timeout))
+            return False
+        self.boot_time = time.time() - start_time
+        logging.info("Device {0} ready after {1:.1f}s."
+                     .format(self.name, self.boot_time))
+        return True
+
     @abc.abstractmethod
     def execute(self, command, timeout, user="root", verbose=False):
         """
         Runs a command on the device and returns log and errorlevel.
+        Plugins having a _session_class can simply delegate to
+        execute_in_session.
         """
 
+    def execute_async(self, command, timeout, user="root", verbose=False):
+        """
+        Runs a command on the device in background, returning a Future.
+        """
+        return run_async(self.execute, command, timeout, user=user,
+                         verbose=verbose)
+
+    def _get_session_parameters(self):
+        """
+        Parameters passed to the constructor of the session class,
+        besides device and user. Typically the address of the device.
+        """
+        return {}
+
+    def get_session(self, user="root"):
+        """
+        Returns the persistent session for the user, or None if the
+        device doesn't support sessions.
+        """
+        if self._session_class is None:
+            return None
+        if self._session_pool is None:
+            self._session_pool = \
+                SessionPool(self._session_class, self,
+                            **self._get_session_parameters())
+        return self._session_pool.get(user)
+
+    def execute_in_session(self, command, timeout, user="root",
+                           verbose=False):
+        """
+        Runs a command reusing the persistent session of the user.
+        The session reconnects automatically, if the device rebooted.
+        """
+        session = self.get_session(user)
+        if session is None:
+            logging.critical("Device {0} doesn't support sessions."
+                             .format(self.name))
+            return None
+        return session.execute(command, timeout, verbose)
+
+    def close_sessions(self):
+        """
+        Closes all the sessions open towards the device.
+        """
+        if self._session_pool is not None:
+            self._session_pool.invalidate()
+
     @abc.abstractmethod
     def push(self, local_file, remote_file, user="root"):
         """
         Deploys a file from the local filesystem to the device (remote).
         """
 
-#    @abc.abstractmethod
-#    def pull(self, remote_file, local_file, user="root"):
-#        """
-#        Fetches a file from the device (remote) to the local filesystem.
-#        """
+    def pull(self, remote_file, local_file, user="root",
+             timeout=TRANSFER_TIMEOUT):
+        """
+        Fetches a file from the device (remote) to the local filesystem.
+        The default version streams the file through the session of the
+        user; plugins without streaming sessions must override it.
+        """
+        session = self.get_session(user)
+        if session is None or not session.supports_streaming:
+            logging.critical("Device {0} doesn't support pulling files."
+                             .format(self.name))
+            return False
+        with open(local_file, "wb") as local:
+            result = session.stream(("cat", remote_file), timeout,
+                                    stdout=local)
+        return result is not None and result.returncode == 0
+
+    def push_many(self, file_pairs, user="root", timeout=TRANSFER_TIMEOUT):
+        """
+        Deploys many files with one single transfer.
+        file_pairs is a sequence of (local_file, remote_file) tuples,
+        with absolute remote paths.
+        """
+        file_pairs = list(file_pairs)
+        if not file_pairs:
+            return True
+        logging.info("Pushing {0} files to {1}."
+                     .format(len(file_pairs), self.name))
+        with tempfile.NamedTemporaryFile(suffix=".tar") as archive:
+            create_archive(file_pairs, archive)
+            return self._push_archive(archive, user, timeout)
+
+    def _push_archive(self, archive, user, timeout):
+        """
+        Unpacks the local tar file object on the device, streaming it when
+        possible, otherwise going through a scratch file.
+        """
+        unpack = ("tar", "-x", "-C", "/", "-f")
+        session = self.get_session(user)
+        if session is not None and session.supports_streaming:
+            result = session.stream(unpack + ("-",), timeout, stdin=archive)
+        else:
+            self.push(archive.name, self._REMOTE_ARCHIVE, user=user)
+            result = self.execute(unpack + (self._REMOTE_ARCHIVE,),
+                                  timeout, user=user)
+            self.execute(("rm", "-f", self._REMOTE_ARCHIVE), timeout,
+                         user=user)
+        return result is not None and result.returncode == 0
+
+    def sync_dir(self, local_dir, remote_dir, user="root",
+                 timeout=TRANSFER_TIMEOUT):
+        """
+        Makes remote_dir on the device match local_dir, transferring only
+        the files that are missing or have different content.
+        """
+        result = self.execute(("find", remote_dir, "-type", "f",
+                               "-exec", "md5sum", "{}", "+"),
+                              timeout, user=user)
+        remote = {}
+        if result is not None and result.returncode == 0:
+            remote = parse_digests(result.stdoutdata)
+        changed = [(local_file, remote_file)
+                   for local_file, remote_file, digest
+                   in local_digests(local_dir, remote_dir)
+                   if remote.get(remote_file) != digest]
+        logging.info("Syncing {0} to {1}:{2}, {3} files changed."
+                     .format(local_dir, self.name, remote_dir, len(changed)))
+        return self.push_many(changed, user=user, timeout=timeout)
+
+    def pull_many(self, remote_files, local_dir, user="root", compress=True,
+                  timeout=TRANSFER_TIMEOUT):
+        """
+        Fetches many files or directories with one single transfer,
+        optionally compressed, and unpacks them into local_dir, preserving
+        their remote paths.
+        """
+        pack = ("tar", "-cz" if compress else "-c", "-f")
+        remote_files = tuple(remote_files)
+        session = self.get_session(user)
+        with tempfile.NamedTemporaryFile(suffix=".tar") as archive:
+            if session is not None and session.supports_streaming:
+                result = session.stream(pack + ("-",) + remote_files,
+                                        timeout, stdout=archive)
+            else:
+                result = self.execute(pack + (self._REMOTE_ARCHIVE,) +
+                                      remote_files, timeout, user=user)
+                if result is not None and result.returncode == 0 and \
+                        not self.pull(self._REMOTE_ARCHIVE, archive.name,
+                                      user=user):
+                    result = None
+                self.execute(("rm", "-f", self._REMOTE_ARCHIVE), timeout,
+                             user=user)
+            if result is None or result.returncode != 0:
+                logging.critical("Failed to pull files from {0}."
+                                 .format(self.name))
+                return False
+            archive.flush()
+            return extract_archive(archive.name, local_dir)
 
     def __eq__(self, comp):
         return self.dev_id == comp.dev_id
@@ -29,27 +29,48 @@ class DevicesCatalog(list):
         """
         Loads the catalog from disk.
         """
-        del self[:]
         config = ConfigParser.SafeConfigParser()
         try:
             config.read(file_name)
-            for section in config.sections():
-                item = dict(config.items(section))
-                item["device_model"] = section
-                self.append(item)
         except ConfigParser.ParsingError as error:
             logging.critical("Error while loading catalog file {0}\n {1}"
                              .format(file_name, error))
             return False
+        return self.load_config(config)
+
+    def load_config(self, config):
+        """
+        Loads the catalog from the parsed catalog file.
+        """
+        del self[:]
+        self._patterns = {}
+        for section in config.sections():
+            item = dict(config.items(section))
+            item["device_model"] = section
+            self.append(item)
         return self[:]
 
+    def _get_patterns(self, key):
+        """
+        Returns the regular expressions of the entries for key, compiled
+        once, together with their entries.
+        """
+        patterns = getattr(self, "_patterns", None)
+        if patterns is None:
+            patterns = self._patterns = {}
+        if key not in patterns:
+            patterns[key] = [(re.compile(item[key], re.DOTALL), item)
+                             for item in self if key in item]
+        return patterns[key]
+
     def _search(self, key, value):
         """
         Returns the first matching catalog entry.
         """
         if "regex" in key:
-            for item in self[:]:
-                if re.match(item[key], "".join(value), re.DOTALL):
+            value = "".join(value)
+            for pattern, item in self._get_patterns(key):
+                if pattern.match(value):
                     return item
         else:
             loging.critical("Searching devices catalog by unsupported key:"
@@ -71,6 +92,12 @@ class DevicesCatalog(list):
         """
         return self._get_model_and_type("device_regex", device_signature)
 
+    def get_entry_by_file_name(self, file_name):
+        """
+        Returns the catalog entry of the device the image is for, or None.
+        """
+        return self._search("file_name_regex", file_name)
+
     def get_model_and_type_by_file_name(self, file_name):
         """
         Returns model and type based on info extracted from the device.
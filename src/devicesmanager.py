@@ -14,11 +14,17 @@
 
 import logging
 from argparse import ArgumentParser
-from ConfigParser import SafeConfigParser
 import re
 import os
 from aft.classloader import ClassLoader
 from aft.tester import Tester
+from aft.journal import Journal
+from aft.rerunner import Rerunner
+from aft.logpipeline import set_context
+from aft.concurrency import Deadline, run_until
+from aft.capabilities import parse_requirements
+from aft.imagefingerprint import ImageFingerprint, image_hash, \
+    load_fingerprint, save_fingerprint, clear_fingerprint
 
 
 VERSION = "0.1.0"
@@ -54,10 +60,135 @@ class DevicesManager(object):
     _cutter_class = None
     _topology_file_name = None
     _catalog_file_name = None
+    _force_write = False
+    _fingerprint = None
+    _journal = None
+    _ordering = "plan"
+    _stop_on_failure = False
+    _use_cache = False
+    _output_policy = "keep"
+    _store_artifacts = None
+    _rerun_failed = 0
+    _rerun_devices = 1
+    _job_timeout = None
+    _write_timeout = None
+    _test_timeout = None
     _success = False
 
+    def __init__(self, session):
+        """
+        session caches configuration files and the initialization of the
+        plugins, between runs in the same process.
+        """
+        self._session = session
+        self._tester = Tester()
+        self._requirements = []
+        self._deadline = Deadline()
+        self._device = None
+        self._lockfile = None
+
+    @classmethod
+    def get_default_config_file(cls):
+        """
+        Returns the platform configuration used when --cfg is not given.
+        """
+        return cls.__DEFAULT_CFG_FILE_NAME
+
     @classmethod
-    def _load_config(cls):
+    def get_platform_files(cls, config, section):
+        """
+        Returns a dictionary with the catalog, topology and test plan
+        files of a platform section, for the ones it specifies.
+        """
+        files = {}
+        if config.has_option(section, "catalog"):
+            catalog = config.get(section, "catalog")
+            files["catalog"] = os.path.join(
+                cls.__CATALOG_BASE_PATH,
+                catalog + cls.__CATALOG_FILE_NAME_ENDING)
+            files["topology"] = os.path.join(
+                cls.__TOPOLOGY_BASE_PATH,
+                catalog + cls.__TOPOLOGY_FILE_NAME_ENDING)
+        if config.has_option(section, "test_plan"):
+            files["test_plan"] = os.path.join(
+                cls.__TEST_PLAN_BASE_PATH,
+                config.get(section, "test_plan") +
+                cls.__TEST_PLAN_FILE_NAME_ENDING)
+        return files
+
+    @classmethod
+    def get_config_files(cls, config):
+        """
+        Returns the catalog, topology and test plan files referenced by
+        the sections of the parsed platform configuration.
+        """
+        file_names = []
+        for section in config.sections():
+            files = cls.get_platform_files(config, section)
+            file_names.extend(files[kind]
+                              for kind in ("catalog", "topology", "test_plan")
+                              if kind in files)
+        return file_names
+
+    def _load_section(self, config, section):
+        """
+        Loads the plugin classes and the file names of one platform section
+        of the master configuration file.
+        """
+        logging.info("Loading configuration for platform {0} ."
+                     .format(section))
+
+        parms = dict(config.items(section))
+        del parms["regex"]
+
+        try:
+            self._job_timeout, self._write_timeout, self._test_timeout = [
+                float(parms.pop(key)) if key in parms else None
+                for key in ("job_timeout", "write_timeout", "test_timeout")]
+        except ValueError as error:
+            logging.critical("Malformed timeout in section {0} of file {1}:"
+                             " {2}".format(section, self._cfg_file_name,
+                                           error))
+            return False
+
+        platform = parms["platform"]
+        name = platform + self.__TOPOLOGY_CLASS_NAME_ENDING
+        logging.debug("Topology name: {0}".format(name))
+        self._topology_class = ClassLoader.load_plugin(class_name=name)
+        name = platform + self.__DEVICE_CLASS_NAME_ENDING
+        self._device_class = ClassLoader.load_plugin(class_name=name)
+        del parms["platform"]
+
+        self._catalog_file_name = \
+            os.path.join(self.__CATALOG_BASE_PATH,
+                         parms["catalog"] +
+                         self.__CATALOG_FILE_NAME_ENDING)
+        self._topology_file_name = \
+            os.path.join(self.__TOPOLOGY_BASE_PATH,
+                         parms["catalog"] +
+                         self.__TOPOLOGY_FILE_NAME_ENDING)
+        del parms["catalog"]
+
+        self._cutter_class = \
+            ClassLoader.load_plugin(class_name=parms["cutter"])
+        del parms["cutter"]
+
+        self._test_plan = \
+            os.path.join(self.__TEST_PLAN_BASE_PATH,
+                         parms["test_plan"] +
+                         self.__TEST_PLAN_FILE_NAME_ENDING)
+        del parms["test_plan"]
+
+        if not (self._topology_class and self._device_class and
+                self._cutter_class and self._test_plan):
+            logging.critical("Loading failed.\n"
+                             "Malformed section {0} in file {1}."
+                             .format(section, self._cfg_file_name))
+            return False
+        self._device_init_data = parms
+        return True
+
+    def _load_config(self):
         """
         Loads the master configuration file:
         processes known parameters and leaves a dictionary
@@ -66,233 +197,491 @@ class DevicesManager(object):
         """
         logging.debug("Loading configuration file.")
         try:
-            config = SafeConfigParser()
-            if [] == config.read(cls._cfg_file_name):
+            config = self._session.get_config(self._cfg_file_name)
+            if config is None:
                 logging.critical("Error: configuration file {0} not found."
-                                 .format(cls._cfg_file_name))
+                                 .format(self._cfg_file_name))
                 return False
             for section in config.sections():
-                if not re.match(config.get(section, "regex"), cls._file_name):
+                if not re.match(config.get(section, "regex"), self._file_name):
                     continue
-                logging.info("Loading configuration for platform {0} ."
-                             .format(section))
-
-                parms = dict(config.items(section))
-                del parms["regex"]
-
-                platform = parms["platform"]
-                name = platform + cls.__TOPOLOGY_CLASS_NAME_ENDING
-                logging.debug("Topology name: {0}".format(name))
-                cls._topology_class = ClassLoader.load_plugin(class_name=name)
-                name = platform + cls.__DEVICE_CLASS_NAME_ENDING
-                cls._device_class = ClassLoader.load_plugin(class_name=name)
-                del parms["platform"]
-
-                cls._catalog_file_name = \
-                    os.path.join(cls.__CATALOG_BASE_PATH,
-                                 parms["catalog"] +
-                                 cls.__CATALOG_FILE_NAME_ENDING)
-                cls._topology_file_name = \
-                    os.path.join(cls.__TOPOLOGY_BASE_PATH,
-                                 parms["catalog"] +
-                                 cls.__TOPOLOGY_FILE_NAME_ENDING)
-                del parms["catalog"]
-
-                cls._cutter_class = \
-                    ClassLoader.load_plugin(class_name=parms["cutter"])
-                del parms["cutter"]
-
-                cls._test_plan = \
-                    os.path.join(cls.__TEST_PLAN_BASE_PATH,
-                                 parms["test_plan"] +
-                                 cls.__TEST_PLAN_FILE_NAME_ENDING)
-                del parms["test_plan"]
-
-                if not (cls._topology_class and cls._device_class and
-                        cls._cutter_class and cls._test_plan):
-                    logging.critical("Loading failed.\n"
-                                     "Malformed section {0} in file {1}."
-                                     .format(section, cls._cfg_file_name))
+                if not self._load_section(config, section):
                     return False
                 logging.info("Configuration loaded.")
                 break
             else:
                 logging.critical("Could not find a type of device "
                                  "compatible with the image selected {0}"
-                                 .format(cls._file_name))
+                                 .format(self._file_name))
                 return False
         except KeyError as error:
             logging.critical("Missing configuration key from configuration "
                              "file:\n{0}".format(error))
             return False
-        cls._device_init_data = parms
         return True
 
-    @classmethod
-    def _generate_topology(cls):
+    def _generate_topology(self):
         """
         Scan and record the layout of devices and cutters
         """
-        return cls._success and \
-            cls._topology_class.generate()
+        return self._success and \
+            self._topology_class.generate()
 
-    @classmethod
-    def _image_is_supported(cls):
+    def _image_is_supported(self):
         """
         Loads the topology descriptor and verifies if the image
         is supported for testing.
         """
-        if not cls._success:
+        if not self._success:
             logging.debug("Success already compromised:"
                           " not testing for image supported.")
-        elif not cls._topology_class.load():
+        elif not self._session.load_topology(
+                topology_class=self._topology_class,
+                topology_file_name=self._topology_file_name):
             logging.critical("Failed to load topology class.")
-        elif not cls._topology_class.identify_model_and_type(cls._file_name):
+        elif not self._topology_class.identify_model_and_type(self._file_name):
             logging.critical("Failed to identify model and type.")
         else:
             return True
-        cls._success = False
+        self._success = False
         return False
 
-    @classmethod
-    def _reserve(cls):
+    def _reserve(self):
         """
         Loads the topology descriptor and reserves a device
         of the appropriate type and model, if available.
         """
-        if not cls._success:
+        if not self._success:
             logging.debug("Success already compromised:"
                           " not reserving a device.")
-        elif not cls._topology_class.reserve():
-            logging.critical("Failed to reserve a device")
         else:
-            return True
-        cls._success = False
+            self._device, self._lockfile = self._topology_class.reserve(
+                preferred_dev_id=self._resumed_dev_id(),
+                requirements=self._tester.get_requirements() +
+                self._requirements,
+                image_hash=self._image_hash())
+            if self._device is None:
+                logging.critical("Failed to reserve a device")
+            else:
+                # The run really starts: from now on it has a results
+                # directory, holding also its log
+                if not os.path.isdir(self._journal.results_dir):
+                    os.makedirs(self._journal.results_dir)
+                set_context(device=self._device.dev_id,
+                            job=self._journal.results_dir)
+                # The deadline of the job counts from when it holds the
+                # device
+                self._deadline = Deadline(self._job_timeout)
+                return True
+        self._success = False
         return False
 
-    @classmethod
-    def _write_image(cls):
+    def _release(self):
+        """
+        Powers off the reserved device and puts it back to the pool, once
+        the commands still running for it are killed.
+        """
+        if self._device is not None:
+            self._device.cancel()
+            self._device.detach()
+            self._topology_class.unlock_device(self._device, self._lockfile)
+        self._device = None
+        self._lockfile = None
+
+    def _image_hash(self):
+        """
+        Hash of the image, for preferring the devices already holding it,
+        None if the image can't be read.
         """
-        Writes the image to the reserved device.
+        try:
+            return image_hash(self._file_name)
+        except (OSError, IOError) as error:
+            logging.warn("Cannot hash the image: {0}".format(error))
+            return None
+
+    def _resumed_dev_id(self):
+        """
+        Id of the device used by the run being resumed, if any.
+        """
+        if self._journal is None or self._journal.header is None:
+            return None
+        return self._journal.header["dev_id"]
+
+    def _open_journal(self, results_dir):
+        """
+        Loads the journal of the interrupted run stored in results_dir,
+        or creates a new one, if results_dir is None.
+        """
+        if results_dir is None:
+            self._journal = Journal(self._tester.new_results_dir())
+            return True
+        journal = Journal(results_dir)
+        if not journal.load():
+            logging.critical("No run to resume in {0}.".format(results_dir))
+            return False
+        if journal.finished:
+            logging.critical("The run in {0} is already complete."
+                             .format(results_dir))
+            return False
+        if journal.header["file_name"] != os.path.abspath(self._file_name):
+            logging.critical("The run in {0} was testing a different image:"
+                             " {1}".format(results_dir,
+                                           journal.header["file_name"]))
+            return False
+        logging.info("Resuming run in {0}: {1} test cases completed."
+                     .format(results_dir, len(journal.cases)))
+        self._tester.set_results_dir(results_dir)
+        self._journal = journal
+        return True
+
+    def _record_deployment(self, device):
+        """
+        Records in the journal which image is on which device, or checks
+        that it is still the one of the run being resumed.
+        """
+        self._tester.set_image(file_name=os.path.abspath(self._file_name),
+                               image_hash=self._fingerprint["image_hash"])
+        if self._journal.header is None:
+            self._journal.start(file_name=os.path.abspath(self._file_name),
+                               dev_id=device.dev_id,
+                               fingerprint=self._fingerprint)
+        elif self._journal.header["dev_id"] != device.dev_id:
+            logging.warn("Resuming on device {0} instead of {1}."
+                         .format(device.dev_id,
+                                 self._journal.header["dev_id"]))
+        return True
+
+    def _image_already_deployed(self, device):
+        """
+        Checks if the device still holds the very same image, written
+        in the same way, so that writing it again can be skipped.
+        """
+        if self._force_write:
+            logging.info("Rewriting of the image forced.")
+            return False
+        if not self._fingerprint.matches(load_fingerprint(device.dev_id)):
+            return False
+        logging.info("Device {0} already holds the image."
+                     .format(device.dev_id))
+        if not device.boot_deployed_image():
+            logging.warn("Failed to boot the image already deployed.")
+            return False
+        if not device.verify_image(self._fingerprint):
+            logging.warn("The device doesn't run the recorded image.")
+            return False
+        return True
+
+    def _compute_fingerprint(self, device):
+        """
+        Fingerprint of the image, as written by device. False if the image
+        can't be read.
+        """
+        try:
+            self._fingerprint = ImageFingerprint.compute(self._file_name,
+                                                        device)
+        except (OSError, IOError) as error:
+            logging.critical("Cannot hash the image: {0}".format(error))
+            return False
+        return True
+
+    def _write_image(self):
+        """
+        Writes the image to the reserved device, unless it's already there.
         """
         logging.info("Writing image to the test device.")
-        if not cls._success:
+        device = self._device
+        if not self._success:
             logging.critical("Success already compromised:"
                              " not attempting to write image.")
-        elif not cls._topology_class.reserved_device:
+        elif not device:
             logging.critical("No device was reserved: aborting image write.")
-        elif not cls._topology_class.reserved_device.write_image(cls._file_name):
-            logging.critical("Failed to write image.")
+        elif not self._compute_fingerprint(device):
+            logging.critical("Cannot read the image {0}."
+                             .format(self._file_name))
+        elif self._journal.header is not None and \
+                self._journal.header["fingerprint"]["image_hash"] != \
+                self._fingerprint["image_hash"]:
+            logging.critical("The image changed since the run being"
+                             " resumed.")
+        elif self._image_already_deployed(device):
+            logging.info("Skipping image write.")
+            return self._record_deployment(device)
         else:
-            return True
-        cls._success = False
+            clear_fingerprint(device.dev_id)
+            cancellation = device.cancellation(
+                self._deadline.child(self._write_timeout))
+            with cancellation:
+                completed, written = run_until(cancellation.deadline,
+                                               device.deploy_image,
+                                               self._file_name)
+            if not completed:
+                logging.critical("Writing the image exceeded its "
+                                 "deadline: powering off the device.")
+                device.cancel()
+                device.detach()
+            elif not written:
+                logging.critical("Failed to write image.")
+            else:
+                save_fingerprint(device.dev_id, self._fingerprint)
+                return self._record_deployment(device)
+        self._success = False
         return False
 
-    @classmethod
-    def _test(cls):
+    def _test(self):
         """
         Runs tests on the device
         """
         logging.info("Testing the image written on the device.")
-        if not cls._success:
+        if not self._success:
             logging.critical("Success already compromised:"
                              " not attempting to test image.")
-        elif not cls._topology_class.reserved_device:
+        elif not self._device:
             logging.critical("No device was reserved: aborting image test.")
-        elif not cls._topology_class.reserved_device.test():
-            logging.critical("Failed to test image.")
+        elif not self._device.wait_until_ready(
+                timeout=self._deadline.bound(self._device.BOOT_TIMEOUT)):
+            logging.critical("The device didn't become ready.")
         else:
-            return True
-        cls._success = False
+            deadline = self._deadline.child(self._test_timeout)
+            self._tester.set_deadline(deadline)
+            rerunner = self._start_rerunner(deadline)
+            try:
+                tested = self._device.test(self._tester)
+            finally:
+                if rerunner is not None:
+                    rerunner.close()
+            if tested:
+                return True
+            logging.critical("Failed to test image.")
+        self._success = False
         return False
 
+    def _start_rerunner(self, deadline):
+        """
+        Offers to the tester the other compatible devices, for rerunning
+        the failed test cases, if requested. Only the ones already holding
+        the image are used, when needed, and booted within deadline.
+        """
+        if not self._rerun_failed or not self._rerun_devices:
+            return None
+        device = self._device
+        devices = [candidate for candidate in
+                   self._topology_class.get_compatible_devices(
+                       self._file_name,
+                       self._tester.get_requirements() + self._requirements)
+                   if candidate != device]
+        if not devices:
+            return None
+        rerunner = Rerunner(topology_class=self._topology_class,
+                            devices=devices, fingerprint=self._fingerprint,
+                            workers=self._rerun_devices, deadline=deadline)
+        self._tester.set_rerunner(rerunner)
+        return rerunner
 
-    @classmethod
-    def _validate(cls):
+    def _validate(self):
         """
         Grabs a compatible device, writes to it the image and tests it.
         """
         logging.info("Validating the image.")
-        if not cls._success:
+        if not self._success:
             logging.critical("Success already compromised:"
                              " not attempting to validate image.")
-        elif not cls._reserve():
+        elif not self._reserve():
             logging.critical("Failed to reserve device.")
-        elif not cls._write_image():
+        elif not self._write_image():
             logging.critical("Failed to write the test image to the device.")
-        elif not cls._test():
+        elif not self._test():
             logging.critical("Failed to test the device.")
         else:
             return True
-        cls._success = False
+        self._success = False
         return False
 
-    @classmethod
-    def _load_configuration_files(cls):
+    def _load_configuration_files(self):
         """
         Performs all the initializations preceding the writing of the image
         and testing steps.
         """
-        cls._success = False
-        if not cls._load_config():
+        self._success = False
+        if not self._load_config():
             logging.critical("Failed to load config file.")
             return False
         logging.debug("Loading test plan.")
-        if not Tester.init(test_plan=cls._test_plan):
+        if not self._tester.init(
+                test_plan=self._test_plan, journal=self._journal,
+                ordering=self._ordering,
+                stop_on_failure=self._stop_on_failure,
+                use_cache=self._use_cache,
+                output_policy=self._output_policy,
+                config=self._session.get_config(self._test_plan),
+                store_artifacts=self._store_artifacts,
+                rerun_failed=self._rerun_failed):
             logging.critical("Failed to load test plan file.")
             return False
         logging.debug("Initializing device class.")
-        if not cls._device_class.init_class(init_data=cls._device_init_data):
+        if not self._session.init_device_class(
+                device_class=self._device_class,
+                init_data=self._device_init_data):
             logging.critical("Failed to initialize device class.")
             return False
         logging.debug("Initializing topology class.")
-        if not cls._topology_class.init(
-               topology_file_name=cls._topology_file_name,
-               catalog_file_name=cls._catalog_file_name,
-               cutter_class=cls._cutter_class):
+        if not self._session.init_topology(
+                topology_class=self._topology_class,
+                topology_file_name=self._topology_file_name,
+                catalog_file_name=self._catalog_file_name,
+                cutter_class=self._cutter_class):
             logging.critical("Failed to initialize topology class.")
             return False
-        cls._success = True
+        self._success = True
         return True
 
-    @classmethod
-    def run(cls):
+    def load_platform(self, section, cfg_file_name=None):
         """
-        Parse arguments and act accordingly.
+        Loads one platform section of the master configuration file and
+        its topology, without an image: for operations on the whole farm.
+        """
+        self._cfg_file_name = cfg_file_name or self.__DEFAULT_CFG_FILE_NAME
+        config = self._session.get_config(self._cfg_file_name)
+        if config is None or not config.has_section(section):
+            logging.critical("Platform {0} not found in {1}."
+                             .format(section, self._cfg_file_name))
+            return False
+        try:
+            if not self._load_section(config, section):
+                return False
+        except KeyError as error:
+            logging.critical("Missing configuration key from configuration "
+                             "file:\n{0}".format(error))
+            return False
+        return self._session.init_device_class(
+            device_class=self._device_class,
+            init_data=self._device_init_data) and \
+            self._session.init_topology(
+                topology_class=self._topology_class,
+                topology_file_name=self._topology_file_name,
+                catalog_file_name=self._catalog_file_name,
+                cutter_class=self._cutter_class) and \
+            self._session.load_topology(
+                topology_class=self._topology_class,
+                topology_file_name=self._topology_file_name)
+
+    def get_topology_class(self):
+        """
+        Returns the topology class of the platform loaded.
+        """
+        return self._topology_class
+
+    def run(self, argv=None):
+        """
+        Parse arguments (by default sys.argv) and act accordingly.
         """
         E_NO_IMAGE_NAME = 1
         E_CONFIG_FILES  = 2
         E_UNTESTABLE = 3
         E_TEST_FAILED = 4
+        set_context(device=None, job=None)
         logging.debug("Building argument parser.")
         parser = ArgumentParser()
         parser.add_argument("--testable", action="store_true",
                             default=False,
                             help="Test if a specified image is supported.")
+        parser.add_argument("--force-write", action="store_true",
+                            default=False,
+                            help="Write the image even if the device "
+                                 "already holds it.")
+        parser.add_argument("--resume", action="store", nargs="?",
+                            const="", default=None, metavar="RESULTS_DIR",
+                            help="Resume an interrupted run, skipping the "
+                                 "test cases already completed. Defaults "
+                                 "to the most recent unfinished run.")
+        parser.add_argument("--order", action="store",
+                            choices=Tester.ORDERINGS, default="plan",
+                            help="Order of execution of the test cases: "
+                                 "as in the plan, most likely to fail first "
+                                 "or shortest first, based on history.")
+        parser.add_argument("--stop-on-failure", action="store_true",
+                            default=False,
+                            help="Skip the remaining test cases after the "
+                                 "first failure.")
+        parser.add_argument("--use-cache", action="store_true",
+                            default=False,
+                            help="Report the cacheable test cases which "
+                                 "already passed with the same image on the "
+                                 "same device model, without running them.")
+        parser.add_argument("--output", action="store",
+                            choices=Tester.OUTPUT_POLICIES, default="keep",
+                            help="What to do with the output of each test "
+                                 "case, once its result is journaled: keep "
+                                 "it in memory, release it, or also spill "
+                                 "its xunit section to disk.")
+        parser.add_argument("--store-artifacts", action="store_true",
+                            default=False,
+                            help="Copy the results into the artifact store, "
+                                 "compressed and deduplicated.")
+        parser.add_argument("--artifacts-view", action="store_true",
+                            default=False,
+                            help="Store the results like --store-artifacts "
+                                 "and replace the files of the results "
+                                 "directory by <file>.gz links to their "
+                                 "compressed contents in the store.")
+        parser.add_argument("--rerun-failed", action="store", type=int,
+                            default=0, metavar="ATTEMPTS",
+                            help="Rerun each failed test case up to ATTEMPTS "
+                                 "times, to tell flaky test cases from real "
+                                 "failures.")
+        parser.add_argument("--rerun-devices", action="store", type=int,
+                            default=1,
+                            help="Maximum number of other devices already "
+                                 "holding the image used for the reruns, "
+                                 "in parallel with the test plan; with 0 "
+                                 "the reruns follow it on the same device.")
+        parser.add_argument("--require", action="append", default=[],
+                            help="Capabilities the device must have, e.g. "
+                                 "\"ram>=1024, usb_hub\", can be repeated.")
         parser.add_argument("--cfg", action="store",
-                            default=cls.__DEFAULT_CFG_FILE_NAME,
+                            default=self.__DEFAULT_CFG_FILE_NAME,
                             help="Configuration file describing "
                                  "supported platforms.")
         parser.add_argument("file_name", action="store",
                             help="Image to write: a local file, "
                                  "compatible with the supported platforms.")
         logging.debug("Parsing arguments.")
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
         if not hasattr(args, "file_name"):
             logging.critical("Error parsing arguments: missing image name")
             return -E_NO_IMAGE_NAME
 # pylint: disable=protected-access
-        cls._file_name = args.file_name
-        logging.debug("SW Image file {0}.".format(cls._file_name))
-        cls._cfg_file_name = args.cfg
-        logging.debug("Configuration file {0}.".format(cls._cfg_file_name))
+        self._file_name = args.file_name
+        logging.debug("SW Image file {0}.".format(self._file_name))
+        self._cfg_file_name = args.cfg
+        self._force_write = args.force_write
+        self._ordering = args.order
+        self._stop_on_failure = args.stop_on_failure
+        self._use_cache = args.use_cache
+        self._output_policy = args.output
+        if args.artifacts_view:
+            self._store_artifacts = "view"
+        elif args.store_artifacts:
+            self._store_artifacts = "copy"
+        self._rerun_failed = max(0, args.rerun_failed)
+        self._rerun_devices = max(0, args.rerun_devices)
+        self._requirements = parse_requirements(",".join(args.require))
+        logging.debug("Configuration file {0}.".format(self._cfg_file_name))
+        results_dir = None
+        if args.resume is not None:
+            results_dir = args.resume or \
+                Journal.find_latest(Tester._TEST_EXEC_ROOT)
+            if results_dir is None:
+                logging.critical("No interrupted run to resume.")
+                return -E_CONFIG_FILES
+        if not self._open_journal(results_dir):
+            return -E_CONFIG_FILES
         logging.debug("Loading configuration files.")
-        result = cls._load_configuration_files()
+        result = self._load_configuration_files()
         if result is False:
             logging.debug("Error while loading configuration files.")
             return -E_CONFIG_FILES
         logging.debug("Checking if the image is supported.")
-        result = cls._image_is_supported()
+        result = self._image_is_supported()
         if result is False:
             logging.debug("Image is not supported.")
         else:
@@ -304,15 +693,17 @@ class DevicesManager(object):
             else:
                 return -E_UNTESTABLE
         logging.debug("Validating SW Image.")
-        result = cls._validate()
+        try:
+            result = self._validate()
+        finally:
+            self._release()
         if result is True:
             logging.info("Validation Succesful.")
         else:
             logging.critical("Validation Failed.")
 # pylint: enable=protected-access
-        if cls._topology_class is not None and \
-                cls._topology_class.reserved_device is not None:
-            cls._topology_class.reserved_device.detach()
+        set_context(device=None, job=None)
+        self._tester.archive_results()
         if result is True:
             return 0
         else:
@@ -20,29 +20,84 @@ import sys
 import time
 import errno
 import fcntl
-import atexit
 import logging
 import ConfigParser
 from aft.devicescatalog import DevicesCatalog
+from aft.imagefingerprint import load_fingerprint, preempt_lease
+from aft.capabilities import CapabilityIndex, parse_capabilities, \
+    parse_requirements
 
 VERSION = "0.1.0"
 
 
+def describe_device(config, section, catalog):
+    """
+    Returns the descriptor of the device of a section of the topology,
+    with the catalog entry of its model, if any.
+    """
+    device_descriptor = dict(config.items(section))
+    device_descriptor["name"] = section
+    for item in catalog:
+        if item["device_model"] == device_descriptor["model"]:
+            device_descriptor["catalog_entry"] = item
+            break
+    return device_descriptor
+
+
+def device_capabilities(device_descriptor, catalog):
+    """
+    Capabilities of a device: the ones of its model in the catalog, with
+    the ones of the device in the topology on top, plus its model and the
+    types of device its name matches.
+    """
+    capabilities = parse_capabilities(
+        device_descriptor.get("catalog_entry", {}).get("capabilities"))
+    capabilities.update(parse_capabilities(
+        device_descriptor.get("capabilities")))
+    capabilities["model"] = device_descriptor["model"]
+    capabilities["type"] = sorted(set(
+        item["device_type"] for item in catalog
+        if item.get("device_type", "\0") in device_descriptor["name"]))
+    return capabilities
+
+
+def image_requirements(entry):
+    """
+    Requirements of the devices able to test the images of a catalog
+    entry: its model and type, plus the ones it lists.
+    """
+    return [("model", "==", entry["device_model"]),
+            ("type", "==", entry["device_type"])] + \
+        parse_requirements(entry.get("requires"))
+
+
 class DevicesTopology(object):
     """
     Class handling the layout of devices and cutters.
     """
     __metaclass__ = abc.ABCMeta
     _LOCK_ROOT = os.getenv("AFT_LOCKROOT", "/var/lock/")
+    # Seconds between attempts of reserving a device, while all are busy
+    RESERVE_POLL = 10
     _device_class = None
     _cutter_class = None
     _model = None
     _dev_type = None
     _devices = None
-    _lockfile = None
-    reserved_device = None
     _topology_file_name = None
     _devices_catalog = None
+    _index = None
+    _requirements = ()
+    _config_source = None
+
+    @classmethod
+    def set_config_source(cls, get_config):
+        """
+        Makes the topology take the catalog and topology files as parsed
+        by get_config(file_name), e.g. from the snapshot of a session,
+        instead of reading them again.
+        """
+        cls._config_source = staticmethod(get_config)
 
     @classmethod
     def init(cls, topology_file_name, catalog_file_name,
@@ -58,8 +113,14 @@ class DevicesTopology(object):
         cls._cutter_class = cutter_class
         cls._topology_file_name = topology_file_name
         cls._devices_catalog = DevicesCatalog()
-        return cls._devices_catalog.load(catalog_file_name) and \
-            cls._cutter_class.init()
+        if cls._config_source is not None:
+            catalog = cls._config_source(catalog_file_name)
+            loaded = catalog is not None and \
+                cls._devices_catalog.load_config(catalog)
+        else:
+            loaded = cls._devices_catalog.load(catalog_file_name)
+        return loaded and (cls._cutter_class.init_served() or
+                           cls._cutter_class.init())
 
     @classmethod
     def load(cls):
@@ -71,30 +132,33 @@ class DevicesTopology(object):
         try:
             logging.debug("Loading topology file: {0}".
                           format(cls._topology_file_name))
-            config.read(cls._topology_file_name)
+            if cls._config_source is not None:
+                config = cls._config_source(cls._topology_file_name) or \
+                    config
+            else:
+                config.read(cls._topology_file_name)
             logging.debug("Topology file loaded.")
             for section in config.sections():
-                device_descriptor = dict(config.items(section))
-                device_descriptor["name"] = section
-                for item in cls._devices_catalog:
-                    if item["device_model"] == device_descriptor["model"]:
-                        device_descriptor["catalog_entry"] = item
-                        break
+                device_descriptor = describe_device(config, section,
+                                                    cls._devices_catalog)
                 logging.debug("Processing device descriptor: {0}".
                               format(device_descriptor))
                 logging.debug("Acquiring cutter.")
-                channel = \
-                    cls._cutter_class.get_channel_by_id_and_cutter_id(
-                        device_descriptor["cutter"],
-                        device_descriptor["channel"])
+                channel = cls._cutter_class.get_channel(
+                    device_descriptor["cutter"], device_descriptor["channel"])
                 logging.debug("Channel acquired: {0}".format(channel))
                 device_class = cls._device_class(device_descriptor=
                                                  device_descriptor,
                                                  channel=channel)
                 logging.debug("Device Class created as: {0}".
                               format(device_class))
+                device_class.capabilities = device_capabilities(
+                    device_descriptor, cls._devices_catalog)
                 cls._devices.append(device_class)
             logging.debug("Devices: {0}".format(cls._devices))
+            cls._index = CapabilityIndex()
+            for device in cls._devices:
+                cls._index.add(device.dev_id, device.capabilities)
             return True
         except (OSError, ConfigParser.ParsingError) as error:
             logging.critical("Error while loading config file {0}\n {1}"
@@ -148,58 +212,151 @@ class DevicesTopology(object):
         Verifies if there is any known device mode/type that is compatible
         with the candidate image.
         """
-        cls._model, cls._dev_type = \
-            cls._devices_catalog.get_model_and_type_by_file_name(file_name)
-        return cls._model is not None and cls._dev_type is not None
+        entry = cls._devices_catalog.get_entry_by_file_name(file_name)
+        if entry is None:
+            cls._model, cls._dev_type, cls._requirements = None, None, ()
+            return False
+        cls._model, cls._dev_type = entry["device_model"], entry["device_type"]
+        cls._requirements = image_requirements(entry)
+        return True
 
     @classmethod
-    def reserve(cls):
+    def _find_compatible(cls, requirements=()):
         """
-        Searches and reserves a device that is compatible with the type of
-        image that will be written.
+        Returns the devices of the model and type identified, meeting the
+        requirements of the image and the ones given.
         """
-        present = False
-        # Loop as long as there are compatible devices, but busy
-        while True:
-            for device in cls._devices:
-                if cls._dev_type in device.name and \
-                        cls._model == device.model:
-                    present = True
-                    logging.info("Attempting to acquire {0} {1}"
-                                 .format(cls._model, device.dev_id))
-                    try:
-                        old_mask = os.umask(011)
-                        cls._lockfile = \
-                            os.fdopen(os.open(
-                                os.path.join(cls._LOCK_ROOT,
-                                             "aft_" + device.dev_id),
-                                os.O_WRONLY | os.O_CREAT, 0660), "w")
-                        os.umask(old_mask)
-                        fcntl.flock(cls._lockfile,
-                                    fcntl.LOCK_EX | fcntl.LOCK_NB)
-                        logging.info("Device acquired.")
-                        cls.reserved_device = device
-                        atexit.register(cls.release)
-                        return device
-                    except IOError as err:
-                        if err.errno in {errno.EACCES, errno.EAGAIN}:
-                            logging.info("All devices busy ... trying later.")
-                        else:
-                            logging.critical("Cannot obtain lock file.")
-                            sys.exit(-1)
-            if not present:
-                cls.reserved_device = None
+        dev_ids = cls._index.candidates(list(cls._requirements) +
+                                        list(requirements))
+        return [device for device in cls.get_devices()
+                if device.dev_id in dev_ids]
+
+    @classmethod
+    def get_compatible_devices(cls, file_name, requirements=()):
+        """
+        Returns the devices able to test the image, none if unsupported.
+        """
+        if not cls.identify_model_and_type(file_name):
+            return []
+        return cls._find_compatible(requirements)
+
+    @classmethod
+    def _lock_file_name(cls, device):
+        """
+        Returns the name of the lock file of the device.
+        """
+        return os.path.join(cls._LOCK_ROOT, "aft_" + device.dev_id)
+
+    @classmethod
+    def is_device_busy(cls, device):
+        """
+        True if the device is reserved by some process. The lock of the
+        device is looked up in /proc/locks, never taken, so that a
+        reservation can't find the device busy because of the check.
+        Where /proc/locks is missing, a device with a lock file is busy.
+        """
+        try:
+            info = os.stat(cls._lock_file_name(device))
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                return False
+            raise
+        lock_id = "{0:02x}:{1:02x}:{2}".format(os.major(info.st_dev),
+                                               os.minor(info.st_dev),
+                                               info.st_ino)
+        try:
+            with open("/proc/locks") as locks:
+                # e.g. "1: FLOCK  ADVISORY  WRITE 1234 08:01:5678 0 EOF",
+                # waiters have "->" after the number
+                return any(fields[1] == "FLOCK" and fields[5] == lock_id
+                           for fields in (line.split() for line in locks)
+                           if len(fields) > 5)
+        except IOError:
+            return True
+
+    @classmethod
+    def get_devices(cls):
+        """
+        Returns the devices of the topology.
+        """
+        return list(cls._devices or [])
+
+    @classmethod
+    def lock_device(cls, device):
+        """
+        Locks a device without waiting, like a reservation does.
+        Returns the lock file, for unlock_device, or None if the device is
+        busy. Raises IOError if the lock can't be taken for other reasons.
+        """
+        old_mask = os.umask(011)
+        try:
+            lockfile = os.fdopen(os.open(cls._lock_file_name(device),
+                                         os.O_WRONLY | os.O_CREAT, 0660), "w")
+        finally:
+            os.umask(old_mask)
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as err:
+            lockfile.close()
+            if err.errno in {errno.EACCES, errno.EAGAIN}:
                 return None
-            logging.info("Sleeping 10s")
-            time.sleep(10)
+            raise
+        return lockfile
+
+    @classmethod
+    def unlock_device(cls, device, lockfile):
+        """
+        Releases a lock taken with lock_device.
+        """
+        lockfile.close()
+        os.unlink(cls._lock_file_name(device))
 
     @classmethod
-    def release(cls):
+    def _holds_image(cls, device, image_hash):
         """
-        Put the reserved device back to the pool. It will happen anyway when
-        the process dies, but this removes the stale lockfile.
+        True if the image with image_hash was the last one written to the
+        device.
         """
-        if cls.reserved_device and cls._lockfile:
-            cls._lockfile.close()
-            os.unlink(os.path.join(cls._LOCK_ROOT,
-                                   "aft_" + cls.reserved_device.dev_id))
+        fingerprint = load_fingerprint(device.dev_id)
+        return image_hash is not None and fingerprint is not None and \
+            fingerprint["image_hash"] == image_hash
+
+    @classmethod
+    def reserve(cls, preferred_dev_id=None, requirements=(), image_hash=None):
+        """
+        Searches and reserves a device that is compatible with the type of
+        image that will be written and meets the requirements, e.g. of the
+        test plan. The device with preferred_dev_id, if any, is tried first,
+        then the ones already holding the image with image_hash.
+        While all are busy, a device being pre-provisioned with another
+        image is pre-empted.
+        Returns the device and its lock file, for unlock_device, or None
+        and None if no device is compatible.
+        """
+        devices = sorted(cls._find_compatible(requirements),
+                         key=lambda device: (
+                             device.dev_id != preferred_dev_id,
+                             not cls._holds_image(device, image_hash)))
+        if not devices:
+            return None, None
+        # Loop as long as there are compatible devices, but busy
+        while True:
+            for device in devices:
+                logging.info("Attempting to acquire {0} {1}"
+                             .format(cls._model, device.dev_id))
+                try:
+                    lockfile = cls.lock_device(device)
+                except IOError:
+                    logging.critical("Cannot obtain lock file.")
+                    sys.exit(-1)
+                if lockfile is None:
+                    logging.info("All devices busy ... trying later.")
+                    continue
+                logging.info("Device acquired.")
+                return device, lockfile
+            if any(preempt_lease(device.dev_id, image_hash)
+                   for device in devices):
+                time.sleep(1)
+                continue
+            logging.info("Sleeping {0}s".format(cls.RESERVE_POLL))
+            time.sleep(cls.RESERVE_POLL)
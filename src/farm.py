@@ -0,0 +1,789 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Farms spread over several host PCs: a coordinator keeps the global queue of
+jobs and dispatches them to the agents running on each host.
+The protocol is one json request per TCP connection, answered by one json
+reply, so that any tool can talk to the farm.
+Agents run the command lines they receive: every request must carry the
+shared token of the farm, and the agents accept only the options of aft
+harmless on a shared host.
+"""
+
+import os
+import re
+import sys
+import json
+import hmac
+import time
+import Queue
+import signal
+import hashlib
+import socket
+import logging
+import itertools
+import threading
+import SocketServer
+from argparse import ArgumentParser, REMAINDER
+
+from aft.aftsession import AftSession
+from aft.devicesmanager import DevicesManager
+from aft.imagefingerprint import image_hash, load_fingerprint
+from aft.logpipeline import setup_logging, after_fork
+
+VERSION = "0.1.0"
+
+DEFAULT_PORT = 7411
+RPC_TIMEOUT = 30
+TOKEN_ENV = "AFT_FARM_TOKEN"
+# Seconds a job keeps running without its coordinator asking about it
+JOB_LEASE = 300
+
+# Options of aft a job may use, the agent sets --cfg itself
+_JOB_OPTIONS = frozenset([
+    "--testable", "--force-write", "--order", "--stop-on-failure",
+    "--use-cache", "--output", "--store-artifacts", "--artifacts-view",
+    "--rerun-failed", "--rerun-devices", "--require"])
+
+_AGENT_DIR = os.path.join(os.getenv("AFT_STATEROOT", "/var/lib/aft/"),
+                          "agent")
+
+
+def parse_address(address):
+    """
+    Converts host:port into a socket address, port defaulting to
+    DEFAULT_PORT.
+    """
+    host, _, port = address.rpartition(":")
+    if not host:
+        return (port, DEFAULT_PORT)
+    return (host, int(port))
+
+
+def load_token(file_name=None):
+    """
+    Returns the shared token of the farm: the first line of file_name, if
+    given, else the value of the environment variable AFT_FARM_TOKEN, or
+    None if there is none.
+    """
+    if file_name is None:
+        return os.getenv(TOKEN_ENV) or None
+    try:
+        with open(file_name) as token_file:
+            return token_file.readline().strip() or None
+    except IOError as error:
+        logging.critical("Cannot read the token: %s", error)
+        return None
+
+
+def _same_token(token, expected):
+    """
+    Compares two tokens in constant time.
+    """
+    if not isinstance(token, basestring):
+        return False
+    digests = [hashlib.sha256(value.encode("utf-8")).digest()
+               for value in (token, expected)]
+    return hmac.compare_digest(*digests)
+
+
+def check_job_argv(argv):
+    """
+    Returns why the aft command line of a job is not acceptable, or None.
+    """
+    if not isinstance(argv, list) or \
+            not all(isinstance(arg, basestring) for arg in argv):
+        return "Invalid command line."
+    for arg in argv:
+        if arg.startswith("-") and arg.split("=", 1)[0] not in _JOB_OPTIONS:
+            return "Option {0} not allowed.".format(arg)
+    return None
+
+
+def rpc_call(address, token, timeout=RPC_TIMEOUT, **request):
+    """
+    Sends one request, authenticated by the token, returns the reply or
+    None if the peer can't be reached.
+    """
+    request["token"] = token
+    try:
+        connection = socket.create_connection(address, timeout)
+    except socket.error as error:
+        logging.warn("Cannot reach %s:%s: %s", address[0], address[1], error)
+        return None
+    try:
+        connection.sendall(json.dumps(request) + "\n")
+        reply = connection.makefile("r").readline()
+        return json.loads(reply) if reply else None
+    except (socket.error, ValueError) as error:
+        logging.warn("Request to %s:%s failed: %s", address[0], address[1],
+                     error)
+        return None
+    finally:
+        connection.close()
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    """
+    One json request per line, one json reply per line. Requests without
+    the token of the server are refused.
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not _same_token(request.pop("token", None),
+                                   self.server.token):
+                    logging.warn("Refused request from %s:%s",
+                                 *self.client_address)
+                    reply = {"error": "Not authorized."}
+                else:
+                    reply = self.server.service.serve(request)
+            except (ValueError, KeyError, TypeError, AttributeError) as error:
+                reply = {"error": str(error)}
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+
+class _TcpServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    Threaded TCP server of a service, requiring its token.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service, token):
+        SocketServer.TCPServer.__init__(self, address, _RequestHandler)
+        self.service = service
+        self.token = token
+
+
+class Agent(object):
+    """
+    Runs the jobs dispatched to one host, each in a child process forked
+    from the agent, and reports devices, capacity and health of the host.
+    Each request of the coordinator about a running job renews its lease:
+    a job whose lease expires terminates itself, e.g. if the host is cut
+    off from the coordinator. The state of the jobs is also kept in their
+    work directories, for answering about them after a restart.
+    """
+    JOB_RETENTION = 3600
+    # Seconds between checks of the lease, by the process of the job
+    LEASE_CHECK = 10
+    _JOB_ID = re.compile(r"^[\w.-]+$")
+
+    def __init__(self, token, cfg_file_name=None, work_dir=_AGENT_DIR,
+                 max_jobs=8):
+        self._token = token
+        self._session = AftSession()
+        self._cfg_file_name = cfg_file_name or \
+            DevicesManager.get_default_config_file()
+        self._work_dir = os.path.abspath(work_dir)
+        self._max_jobs = max_jobs
+        self._jobs = {}
+        self._pids = {}
+        self._submissions = Queue.Queue()
+        self._lock = threading.RLock()
+        self._started = time.time()
+        self._server = None
+
+    def _platforms(self, file_name=None):
+        """
+        Returns the topology classes of the platforms, only the ones
+        supporting file_name, if given.
+        """
+        config = self._session.get_config(self._cfg_file_name)
+        if config is None:
+            logging.critical("Cannot read %s", self._cfg_file_name)
+            return []
+        topologies = []
+        for section in config.sections():
+            if file_name is not None and \
+                    not re.match(config.get(section, "regex"), file_name):
+                continue
+            manager = DevicesManager(session=self._session)
+            if manager.load_platform(section, self._cfg_file_name):
+                topologies.append(manager.get_topology_class())
+        return topologies
+
+    def _running_jobs(self):
+        """
+        Returns the jobs not completed yet.
+        """
+        return [job for job in self._jobs.values() if job["state"] != "done"]
+
+    def status(self):
+        """
+        Devices of the host, with their state and image, and health.
+        """
+        with self._lock:
+            devices = []
+            for topology_class in self._platforms():
+                for device in topology_class.get_devices():
+                    fingerprint = load_fingerprint(device.dev_id)
+                    devices.append({
+                        "name": device.name, "dev_id": device.dev_id,
+                        "model": device.model,
+                        "busy": topology_class.is_device_busy(device),
+                        "image_hash": fingerprint["image_hash"]
+                                      if fingerprint else None})
+            running = len(self._running_jobs())
+        if not os.path.isdir(self._work_dir):
+            os.makedirs(self._work_dir)
+        disk = os.statvfs(self._work_dir)
+        return {"host": socket.gethostname(), "devices": devices,
+                "running": running, "max_jobs": self._max_jobs,
+                "load": os.getloadavg()[0],
+                "disk_free": disk.f_bavail * disk.f_frsize,
+                "uptime": time.time() - self._started}
+
+    def offer(self, file_name):
+        """
+        How many devices of the host can test the image, how many of them
+        are free and on how many of the free ones it is already deployed.
+        A job dispatched here, but not yet running its reservation, counts
+        as occupying a device.
+        """
+        offer = {"compatible": 0, "free": 0, "cached": 0, "models": []}
+        if not os.path.isfile(file_name):
+            offer["error"] = "Image {0} not found.".format(file_name)
+            return offer
+        digest = image_hash(file_name)
+        with self._lock:
+            busy = 0
+            free_devices = []
+            models = set()
+            for topology_class in self._platforms(file_name):
+                for device in topology_class.get_compatible_devices(
+                        file_name):
+                    models.add(device.model)
+                    offer["compatible"] += 1
+                    if topology_class.is_device_busy(device):
+                        busy += 1
+                    else:
+                        free_devices.append(device)
+            jobs = self._running_jobs()
+            own = len([job for job in jobs if set(job["models"]) & models])
+            if len(jobs) < self._max_jobs:
+                offer["free"] = max(0, offer["compatible"] - max(busy, own))
+        if offer["free"]:
+            for device in free_devices:
+                fingerprint = load_fingerprint(device.dev_id)
+                if fingerprint is not None and \
+                        fingerprint["image_hash"] == digest:
+                    offer["cached"] += 1
+        offer["models"] = sorted(models)
+        return offer
+
+    def submit(self, job_id, argv, file_name):
+        """
+        Queues a job, to be started by the main thread.
+        """
+        if not isinstance(job_id, basestring) or \
+                not self._JOB_ID.match(job_id):
+            return {"accepted": False, "error": "Invalid job."}
+        error = check_job_argv(argv)
+        if error is not None:
+            return {"accepted": False, "error": error}
+        with self._lock:
+            if job_id in self._jobs:
+                return {"accepted": False, "error": "Duplicate job."}
+            self._jobs[job_id] = {
+                "job_id": job_id, "argv": argv, "file_name": file_name,
+                "models": self.offer(file_name)["models"], "state": "queued",
+                "exit_code": None, "work_dir": os.path.join(self._work_dir,
+                                                            job_id),
+                "submitted": time.time(), "started": None, "finished": None}
+        self._submissions.put(job_id)
+        return {"accepted": True}
+
+    def _recover(self, job_id):
+        """
+        Returns the job started before a restart of the agent, from its
+        work directory, or None if the agent never started it.
+        """
+        work_dir = os.path.join(self._work_dir, job_id)
+        if not self._JOB_ID.match(job_id) or not os.path.isdir(work_dir):
+            return None
+        job = {"job_id": job_id, "work_dir": work_dir, "state": "done",
+               "exit_code": None}
+        try:
+            with open(os.path.join(work_dir, "exit_code")) as exit_file:
+                job["exit_code"] = int(exit_file.read())
+            return job
+        except (IOError, ValueError):
+            pass
+        try:
+            with open(os.path.join(work_dir, "pid")) as pid_file:
+                pid = int(pid_file.read())
+            # The job leads its own process group
+            if os.getpgid(pid) == pid:
+                job["state"] = "running"
+        except (IOError, OSError, ValueError):
+            pass
+        return job
+
+    def job(self, job_id):
+        """
+        State of a job, renewing its lease while it runs. A job the agent
+        doesn't have, or which ended without an exit code, is gone: it
+        may be dispatched again.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id) or self._recover(job_id)
+            if job is None:
+                return {"error": "Unknown job.", "gone": True}
+            if job["state"] == "done" and job["exit_code"] is None:
+                return {"error": "Job interrupted.", "gone": True}
+            if job["state"] == "running":
+                lease = os.path.join(job["work_dir"], "lease")
+                open(lease, "a").close()
+                os.utime(lease, None)
+            return dict(job)
+
+    def serve(self, request):
+        """
+        Executes one request, returns the reply.
+        """
+        if request["op"] == "status":
+            return self.status()
+        if request["op"] == "offer":
+            return self.offer(request["file_name"])
+        if request["op"] == "submit":
+            return self.submit(request["job_id"], request["argv"],
+                               request["file_name"])
+        if request["op"] == "job":
+            return self.job(request["job_id"])
+        return {"error": "Unknown request {0}.".format(request["op"])}
+
+    def _start(self, job_id):
+        """
+        Forks the process running the job. The request threads and the
+        writer of the logs may hold locks at the time of the fork: the lock
+        of the agent is held across it, and the child replaces the locks of
+        the logging pipeline and of the session before using them.
+        """
+        job = self._jobs[job_id]
+        if not os.path.isdir(job["work_dir"]):
+            os.makedirs(job["work_dir"])
+        # A job dispatched again after being interrupted here
+        for name in ("exit_code", "pid"):
+            if os.path.exists(os.path.join(job["work_dir"], name)):
+                os.unlink(os.path.join(job["work_dir"], name))
+        open(os.path.join(job["work_dir"], "lease"), "w").close()
+        with self._lock:
+            pid = os.fork()
+            if pid == 0:
+                self._run_job(job)
+            job["state"] = "running"
+            job["started"] = time.time()
+            self._pids[pid] = job_id
+        with open(os.path.join(job["work_dir"], "pid"), "w") as pid_file:
+            pid_file.write(str(pid))
+        logging.info("Started job %s, pid %d", job_id, pid)
+
+    @classmethod
+    def _watch_lease(cls, job):
+        """
+        Terminates the process of the job and its children once the lease
+        of the job expires.
+        """
+        lease = os.path.join(job["work_dir"], "lease")
+        while True:
+            time.sleep(cls.LEASE_CHECK)
+            try:
+                expired = time.time() - os.path.getmtime(lease) > JOB_LEASE
+            except OSError:
+                expired = True
+            if expired:
+                logging.critical("Lease of job %s expired, terminating it.",
+                                 job["job_id"])
+                os.killpg(0, signal.SIGTERM)
+                return
+
+    def _run_job(self, job):
+        """
+        Runs the job in the child process, never returns.
+        """
+        exit_code = 1
+        try:
+            after_fork()
+            os.setsid()
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+            self._server.socket.close()
+            self._session.after_fork()
+            os.chdir(job["work_dir"])
+            setup_logging()
+            watchdog = threading.Thread(target=self._watch_lease, args=(job,))
+            watchdog.daemon = True
+            watchdog.start()
+            exit_code = self._session.run(["--cfg", self._cfg_file_name] +
+                                          job["argv"])
+        except SystemExit as error:
+            exit_code = error.code if isinstance(error.code, int) else 1
+        # pylint: disable=broad-except
+        except BaseException:
+            logging.exception("Job %s failed.", job["job_id"])
+        # pylint: enable=broad-except
+        finally:
+            logging.shutdown()
+            try:
+                with open(os.path.join(job["work_dir"], "exit_code"),
+                          "w") as exit_file:
+                    exit_file.write(str(exit_code))
+            except IOError:
+                pass
+            os._exit(exit_code & 0xff) # pylint: disable=protected-access
+
+    def _reap(self):
+        """
+        Records the outcome of the jobs completed and forgets the old ones.
+        """
+        while self._pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+            with self._lock:
+                job = self._jobs[self._pids.pop(pid)]
+                job["state"] = "done"
+                job["finished"] = time.time()
+                job["exit_code"] = exit_code - 256 if exit_code > 127 \
+                    else exit_code
+            logging.info("Job %s completed, exit code %d", job["job_id"],
+                         job["exit_code"])
+        with self._lock:
+            for job_id, job in self._jobs.items():
+                if job["finished"] is not None and \
+                        time.time() - job["finished"] > self.JOB_RETENTION:
+                    del self._jobs[job_id]
+
+    def serve_forever(self, address):
+        """
+        Serves requests in background and runs the jobs, until interrupted.
+        """
+        self._server = _TcpServer(address, self, self._token)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logging.info("Agent serving on %s:%s", *self._server.server_address)
+        try:
+            while True:
+                try:
+                    job_id = self._submissions.get(timeout=1)
+                    self._session.reload()
+                    self._start(job_id)
+                except Queue.Empty:
+                    pass
+                self._reap()
+        finally:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class Coordinator(object):
+    """
+    Global queue of jobs. A job goes to a healthy agent having a free
+    device able to test its image, preferring the ones where the image is
+    already deployed and then the ones with more free devices.
+    Jobs are taken in order, but a job waiting for busy devices doesn't
+    hold back the following ones, which may need other models.
+    A job is lost once its agent confirms it is gone, e.g. because the
+    agent restarted before running it, or once it can't be reached for
+    longer than the lease of the job, after which the job has terminated
+    itself. A lost job is queued again, up to MAX_ATTEMPTS dispatches, then
+    completed with an error. Jobs are thus never run twice at the same
+    time, but are run at least once: a job which completed while its agent
+    couldn't be reached runs again.
+    """
+    # The lease of the job, plus the time the job takes to notice it
+    JOB_TIMEOUT = JOB_LEASE + 3 * Agent.LEASE_CHECK
+    MAX_ATTEMPTS = 2
+
+    def __init__(self, token, agents, interval=5.0):
+        self._token = token
+        self._agents = dict((address, {"healthy": False, "status": None,
+                                       "last_seen": None})
+                            for address in agents)
+        self._queue = []
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._interval = interval
+        self._wakeup = threading.Event()
+
+    def submit(self, argv, file_name):
+        """
+        Queues a job, returns its description. Paths in the command line
+        must be valid on all the hosts, e.g. on shared storage.
+        """
+        error = check_job_argv(argv)
+        if error is not None:
+            return {"error": error}
+        with self._lock:
+            job_id = "{0}-{1}".format(int(time.time()), next(self._counter))
+            self._jobs[job_id] = {
+                "job_id": job_id, "argv": argv, "file_name": file_name,
+                "state": "queued", "agent": None, "exit_code": None,
+                "error": None, "submitted": time.time(), "attempts": 0,
+                "last_seen": None}
+            self._queue.append(job_id)
+            job = dict(self._jobs[job_id])
+        self._wakeup.set()
+        return job
+
+    def status(self):
+        """
+        State of the agents and of the queue.
+        """
+        with self._lock:
+            return {"agents": [dict(agent, address="{0}:{1}".format(*address))
+                               for address, agent in self._agents.items()],
+                    "queued": list(self._queue),
+                    "running": [job_id for job_id, job in self._jobs.items()
+                                if job["agent"] is not None and
+                                job["state"] != "done"]}
+
+    def serve(self, request):
+        """
+        Executes one request, returns the reply.
+        """
+        if request["op"] == "submit":
+            return self.submit(request["argv"], request["file_name"])
+        if request["op"] == "job":
+            with self._lock:
+                job = self._jobs.get(request["job_id"])
+                return dict(job) if job else {"error": "Unknown job."}
+        if request["op"] == "status":
+            return self.status()
+        return {"error": "Unknown request {0}.".format(request["op"])}
+
+    def _poll_agents(self):
+        """
+        Refreshes capacity and health of the agents.
+        """
+        for address, agent in self._agents.items():
+            status = rpc_call(address, self._token, op="status")
+            with self._lock:
+                agent["healthy"] = status is not None and "error" not in status
+                if agent["healthy"]:
+                    agent["status"] = status
+                    agent["last_seen"] = time.time()
+
+    def _poll_jobs(self):
+        """
+        Follows the jobs running on the agents.
+        """
+        with self._lock:
+            jobs = [(job["job_id"], job["agent"]) for job in self._jobs.values()
+                    if job["agent"] is not None and job["state"] != "done"]
+        for job_id, agent in jobs:
+            reply = rpc_call(parse_address(agent), self._token, op="job",
+                             job_id=job_id)
+            with self._lock:
+                job = self._jobs[job_id]
+                if reply is not None and "error" not in reply:
+                    job["state"] = reply["state"]
+                    job["exit_code"] = reply["exit_code"]
+                    job["last_seen"] = time.time()
+                elif reply is not None and reply.get("gone"):
+                    self._lose(job, reply["error"])
+                elif time.time() - job["last_seen"] > self.JOB_TIMEOUT:
+                    self._lose(job, reply["error"] if reply else
+                               "Agent not reachable.")
+
+    def _lose(self, job, reason):
+        """
+        Queues again a job its agent lost, or completes it with an error
+        if it has been dispatched MAX_ATTEMPTS times. Called with the lock
+        held.
+        """
+        logging.warn("Job %s lost by %s: %s", job["job_id"], job["agent"],
+                     reason)
+        job["agent"] = None
+        if job["attempts"] < self.MAX_ATTEMPTS:
+            job["state"] = "queued"
+            self._queue.append(job["job_id"])
+        else:
+            job["state"] = "done"
+            job["error"] = "Job lost by its agent: {0}".format(reason)
+
+    def _choose_agent(self, file_name):
+        """
+        Returns the best agent for the image, or None, and whether any
+        agent has devices able to test it.
+        """
+        best = None
+        compatible = False
+        for address, agent in self._agents.items():
+            if not agent["healthy"]:
+                continue
+            offer = rpc_call(address, self._token, op="offer",
+                             file_name=file_name)
+            if offer is None:
+                continue
+            compatible = compatible or offer["compatible"] > 0
+            if offer["free"] > 0:
+                rank = (offer["cached"] > 0, offer["free"])
+                if best is None or rank > best[0]:
+                    best = (rank, address)
+        return (best[1] if best else None), compatible
+
+    def _dispatch(self):
+        """
+        Sends the queued jobs to the agents.
+        """
+        with self._lock:
+            queue = list(self._queue)
+            all_healthy = all(agent["healthy"]
+                              for agent in self._agents.values())
+        for job_id in queue:
+            job = self._jobs[job_id]
+            address, compatible = self._choose_agent(job["file_name"])
+            if address is not None:
+                reply = rpc_call(address, self._token, op="submit",
+                                 job_id=job_id, argv=job["argv"],
+                                 file_name=job["file_name"])
+                if reply is None or not reply.get("accepted"):
+                    continue
+                logging.info("Job %s dispatched to %s:%s", job_id, *address)
+                with self._lock:
+                    job["state"] = "dispatched"
+                    job["agent"] = "{0}:{1}".format(*address)
+                    job["attempts"] += 1
+                    job["last_seen"] = time.time()
+                    self._queue.remove(job_id)
+            elif not compatible and all_healthy:
+                logging.warn("No device in the farm can test %s",
+                             job["file_name"])
+                with self._lock:
+                    job["state"] = "done"
+                    job["error"] = "No compatible device."
+                    self._queue.remove(job_id)
+
+    def serve_forever(self, address):
+        """
+        Serves requests in background and schedules, until interrupted.
+        """
+        server = _TcpServer(address, self, self._token)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logging.info("Coordinator serving on %s:%s", *server.server_address)
+        try:
+            while True:
+                self._poll_agents()
+                self._poll_jobs()
+                self._dispatch()
+                self._wakeup.wait(self._interval)
+                self._wakeup.clear()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def _image_argument(argv):
+    """
+    Returns the image of an aft command line: its last positional argument.
+    """
+    positional = [arg for arg in argv if not arg.startswith("-")]
+    return positional[-1] if positional else None
+
+
+def main(argv=None):
+    """
+    Command line interface: runs an agent or a coordinator, or submits a
+    job to a coordinator and optionally waits for its exit code.
+    All need the token of the farm, from --token-file or AFT_FARM_TOKEN.
+    """
+    parser = ArgumentParser(description="Farm of aft hosts.")
+    parser.add_argument("--token-file", action="store", default=None,
+                        help="File holding the shared token of the farm, "
+                             "by default taken from " + TOKEN_ENV + ".")
+    commands = parser.add_subparsers(dest="command")
+    agent = commands.add_parser("agent", help="Run the jobs of this host.")
+    agent.add_argument("--listen", action="store",
+                       default="127.0.0.1:{0}".format(DEFAULT_PORT),
+                       help="host:port to serve on, only local by default.")
+    agent.add_argument("--cfg", action="store", default=None,
+                       help="Master configuration file.")
+    agent.add_argument("--max-jobs", action="store", type=int, default=8)
+    agent.add_argument("--work-dir", action="store", default=_AGENT_DIR)
+    coordinator = commands.add_parser("coordinator",
+                                      help="Dispatch jobs to the agents.")
+    coordinator.add_argument("--listen", action="store",
+                             default="127.0.0.1:{0}".format(DEFAULT_PORT + 1),
+                             help="host:port to serve on, only local by "
+                                  "default.")
+    coordinator.add_argument("--agent", action="append", required=True,
+                             help="host:port of an agent, can be repeated.")
+    coordinator.add_argument("--interval", action="store", type=float,
+                             default=5.0)
+    submit = commands.add_parser("submit", help="Submit an aft command "
+                                 "line, after --.")
+    submit.add_argument("--coordinator", action="store",
+                        default="localhost:{0}".format(DEFAULT_PORT + 1))
+    submit.add_argument("--wait", action="store_true", default=False)
+    submit.add_argument("aft_args", nargs=REMAINDER)
+    status = commands.add_parser("status", help="State of the farm.")
+    status.add_argument("--coordinator", action="store",
+                        default="localhost:{0}".format(DEFAULT_PORT + 1))
+    args = parser.parse_args(argv)
+    token = load_token(args.token_file)
+    if token is None:
+        parser.error("No token: use --token-file or " + TOKEN_ENV + ".")
+
+    if args.command == "agent":
+        setup_logging(file_name="aft-agent.log")
+        Agent(token, cfg_file_name=args.cfg, work_dir=args.work_dir,
+              max_jobs=args.max_jobs).serve_forever(parse_address(args.listen))
+    elif args.command == "coordinator":
+        setup_logging(file_name="aft-coordinator.log")
+        Coordinator(token, [parse_address(address) for address in args.agent],
+                    interval=args.interval).serve_forever(
+                        parse_address(args.listen))
+    elif args.command == "status":
+        print(json.dumps(rpc_call(parse_address(args.coordinator), token,
+                                  op="status"), indent=2))
+    else:
+        address = parse_address(args.coordinator)
+        if args.aft_args[:1] == ["--"]:
+            del args.aft_args[0]
+        argv = [os.path.abspath(arg) if os.path.exists(arg) else arg
+                for arg in args.aft_args]
+        file_name = _image_argument(argv)
+        if file_name is None:
+            parser.error("No image in the aft command line.")
+        job = rpc_call(address, token, op="submit", argv=argv,
+                       file_name=file_name)
+        if job is None:
+            return 1
+        if "job_id" not in job:
+            sys.stderr.write(job["error"] + "\n")
+            return 1
+        print(job["job_id"])
+        while args.wait:
+            job = rpc_call(address, token, op="job", job_id=job["job_id"])
+            if job is None:
+                return 1
+            if job["state"] == "done":
+                if job["error"]:
+                    sys.stderr.write(job["error"] + "\n")
+                    return 1
+                return job["exit_code"]
+            time.sleep(2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
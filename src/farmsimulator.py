@@ -0,0 +1,709 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Discrete-event simulation of a farm, for capacity planning: a trace of
+jobs is replayed against the real platform configuration, catalogs,
+topologies and test plans, without any hardware.
+"""
+
+import re
+import sys
+import json
+import math
+import time
+import copy
+import heapq
+import random
+import sqlite3
+import logging
+import ConfigParser
+from argparse import ArgumentParser
+
+from aft.device import Device
+from aft.aftsession import AftSession
+from aft.devicesmanager import DevicesManager
+from aft.devicestopology import DevicesTopology
+from aft.capabilities import CapabilityIndex, parse_requirements
+from aft.resultstore import ResultStore
+
+VERSION = "0.1.0"
+
+# Durations of the phases, in seconds, when not configured otherwise
+DEFAULT_DURATIONS = {"write": "300", "boot": "60", "case": "60",
+                     "switch": "1"}
+
+
+def parse_distribution(text):
+    """
+    Converts the description of a distribution of durations into a
+    function drawing a sample from a random generator. The formats are
+    "30" or "const:30", "uniform:20,40", "normal:60,10" and "exp:60".
+    Raises ValueError if the description is malformed.
+    """
+    kind, _, parms = str(text).strip().partition(":")
+    if not parms:
+        kind, parms = "const", kind
+    parms = [float(parm) for parm in parms.split(",")]
+    samplers = {
+        "const": (1, lambda rng: parms[0]),
+        "uniform": (2, lambda rng: rng.uniform(parms[0], parms[1])),
+        "normal": (2, lambda rng: rng.normalvariate(parms[0], parms[1])),
+        "exp": (1, lambda rng: rng.expovariate(1.0 / parms[0])),
+    }
+    if kind not in samplers or len(parms) != samplers[kind][0]:
+        raise ValueError("Malformed distribution {0}".format(text))
+    sampler = samplers[kind][1]
+    return lambda rng: max(0.0, sampler(rng))
+
+
+def load_trace(file_name):
+    """
+    Reads a trace of jobs: one json object per line, with the arrival
+    time in seconds, the image and, optionally, the capabilities required,
+    e.g. {"time": 120, "image": "foo.img", "require": "ram>=1024"}.
+    Returns the jobs sorted by arrival time, None if it can't be read.
+    """
+    jobs = []
+    try:
+        with open(file_name) as trace:
+            for line in trace:
+                if not line.strip():
+                    continue
+                job = json.loads(line)
+                jobs.append({"time": float(job["time"]),
+                             "image": job["image"],
+                             "require": job.get("require")})
+    except (IOError, ValueError, KeyError, TypeError) as error:
+        logging.critical("Cannot read trace {0}: {1}"
+                         .format(file_name, error))
+        return None
+    return sorted(jobs, key=lambda job: job["time"])
+
+
+def generate_trace(images, rate, duration, rng):
+    """
+    Poisson arrivals of rate jobs per hour, over duration seconds, each
+    job testing one of the images, chosen at random.
+    """
+    jobs = []
+    now = rng.expovariate(rate / 3600.0)
+    while now < duration:
+        jobs.append({"time": now, "image": rng.choice(images),
+                     "require": None})
+        now += rng.expovariate(rate / 3600.0)
+    return jobs
+
+
+def _percentiles(values):
+    """
+    Median, 90th and 99th percentile and maximum, by nearest rank.
+    """
+    values = sorted(values)
+    if not values:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+    def rank(fraction):
+        """
+        Value at the given fraction of the sorted values.
+        """
+        return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+    return {"p50": rank(0.5), "p90": rank(0.9), "p99": rank(0.99),
+            "max": values[-1]}
+
+
+class Durations(object):
+    """
+    Durations of the phases of a job, drawn from distributions given per
+    device model in a configuration file, like
+
+        [DEFAULT]
+        write = uniform:240,360
+        [modelA]
+        boot = normal:45,5
+
+    The durations of the test cases are drawn from their history, when
+    available, from the "case" distribution otherwise. Phases not in the
+    file use DEFAULT_DURATIONS.
+    """
+    def __init__(self, rng):
+        self._rng = rng
+        self._config = ConfigParser.SafeConfigParser()
+        self._history = {}
+        self._samplers = {}
+
+    def load(self, file_name=None, use_history=True):
+        """
+        Reads the distributions and the history of the test cases.
+        Returns False if the distributions can't be parsed.
+        """
+        try:
+            if file_name is not None and not self._config.read(file_name):
+                logging.critical("Cannot read {0}".format(file_name))
+                return False
+            for section in [None] + self._config.sections():
+                for phase in DEFAULT_DURATIONS:
+                    self._sampler(section, phase)
+        except (ConfigParser.Error, ValueError) as error:
+            logging.critical("Error in the durations {0}: {1}"
+                             .format(file_name, error))
+            return False
+        if use_history:
+            try:
+                store = ResultStore()
+                self._history = store.case_durations()
+                store.close()
+            except (sqlite3.Error, OSError) as error:
+                logging.warn("No history of durations available: {0}"
+                             .format(error))
+        return True
+
+    def _sampler(self, model, phase, default=None):
+        """
+        Returns the sampler of a phase for a model, parsed once.
+        """
+        key = (model, phase, default)
+        if key not in self._samplers:
+            if model is not None and self._config.has_section(model) and \
+                    self._config.has_option(model, phase):
+                text = self._config.get(model, phase)
+            elif phase in self._config.defaults():
+                text = self._config.defaults()[phase]
+            elif default is not None:
+                text = default
+            else:
+                text = DEFAULT_DURATIONS[phase]
+            self._samplers[key] = parse_distribution(text)
+        return self._samplers[key]
+
+    def phase(self, model, phase, default=None):
+        """
+        Draws the duration of a phase on a device model. default is the
+        distribution to use when the file doesn't configure the phase,
+        e.g. the expected boot time from the catalog.
+        """
+        return self._sampler(model, phase, default)(self._rng)
+
+    def case(self, model, name):
+        """
+        Draws the duration of a test case on a device model.
+        """
+        history = self._history.get(model, {}).get(name)
+        if history:
+            return self._rng.choice(history)
+        return self.phase(model, "case")
+
+
+class _SimulatedChannel(object):
+    """
+    Cutter channel of a simulated device: only its address.
+    """
+    def __init__(self, cutter_id, cutter_ch):
+        self.cutter_id = cutter_id
+        self.cutter_ch = cutter_ch
+
+    def __repr__(self):
+        return "SimulatedChannel({0}, {1})".format(self.cutter_id,
+                                                   self.cutter_ch)
+
+
+class _SimulatedCutter(object):
+    """
+    Stand-in for the cutter plugin: no hardware to probe.
+    """
+    @classmethod
+    def init_served(cls):
+        """
+        No daemon serving simulated cutters.
+        """
+        return False
+
+    @classmethod
+    def init(cls):
+        """
+        Nothing to initialize.
+        """
+        return True
+
+    @classmethod
+    def get_channel(cls, cutter_id, channel_id):
+        """
+        Returns a channel with the address from the topology.
+        """
+        return _SimulatedChannel(cutter_id, channel_id)
+
+
+class _SimulatedDevice(Device):
+    """
+    Stand-in for the device plugin: the simulator times its phases.
+    """
+    def is_in_test_mode(self):
+        """
+        Never: the simulator doesn't talk to the device.
+        """
+        return False
+
+    def is_in_service_mode(self):
+        """
+        Never: the simulator doesn't talk to the device.
+        """
+        return False
+
+    def write_image(self, file_name):
+        """
+        Not supported: the simulator only times the write.
+        """
+        return False
+
+    def execute(self, command, timeout, user="root", verbose=False):
+        """
+        Not supported: the simulator only times the test cases.
+        """
+        return None
+
+    def push(self, local_file, remote_file, user="root"):
+        """
+        Not supported: there is no device.
+        """
+        return False
+
+
+class _SimulatedTopology(DevicesTopology):
+    """
+    Topology loaded from the real files, with simulated devices and
+    cutters. Matching images and requirements to devices is inherited.
+    """
+    @classmethod
+    def _detect(cls, force=False):
+        """
+        Nothing to detect.
+        """
+        return False
+
+    @classmethod
+    def scale(cls, factors):
+        """
+        Adds copies of the devices: factors maps a model, or None for
+        all, to the number of devices to have for each one in the topology.
+        The copies share the cutter of their original.
+        """
+        devices = []
+        for device in cls._devices:
+            factor = factors.get(device.model, factors.get(None, 1))
+            devices.append(device)
+            for index in range(1, factor):
+                clone = copy.copy(device)
+                clone.name = "{0}-{1}".format(device.name, index)
+                clone.dev_id = "{0}-{1}".format(device.dev_id, index)
+                clone.capabilities = dict(device.capabilities)
+                devices.append(clone)
+        cls._devices = devices
+        cls._index = CapabilityIndex()
+        for device in cls._devices:
+            cls._index.add(device.dev_id, device.capabilities)
+
+
+class FarmSimulator(object):
+    """
+    Replays jobs through the reservation logic of aft: each job is matched
+    to a platform and to its compatible devices, takes the first free one
+    or polls until one is released, then writes the image, unless the
+    device already holds it, boots it and runs the test plan.
+    Device ids are unique in a farm, as they name the lock files.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, durations, cfg_file_name=None, session=None,
+                 scale=None, channels_per_cutter=None, max_writes=0,
+                 poll=DevicesTopology.RESERVE_POLL):
+        self._durations = durations
+        self._session = session or AftSession()
+        self._cfg_file_name = cfg_file_name or \
+            DevicesManager.get_default_config_file()
+        self._scale = scale or {}
+        self._channels_per_cutter = channels_per_cutter
+        self._max_writes = max_writes
+        self._poll = poll
+        self._platforms = []
+        self._devices = {}
+        self._reset()
+    # pylint: enable=too-many-arguments
+
+    def _reset(self):
+        """
+        Clears the state of a simulation.
+        """
+        self._events = []
+        self._sequence = 0
+        self._now = 0.0
+        self._busy = {}
+        self._busy_time = dict.fromkeys(self._devices, 0.0)
+        self._images = {}
+        self._waiting = []
+        self._writing = 0
+        self._write_queue = []
+        self._cutter_free = {}
+        self._jobs = []
+
+    def load(self):
+        """
+        Loads the platforms with their topologies and test plans.
+        Returns False if the configuration can't be read.
+        """
+        config = self._session.get_config(self._cfg_file_name)
+        if config is None:
+            logging.critical("Cannot read {0}".format(self._cfg_file_name))
+            return False
+        for section in config.sections():
+            files = DevicesManager.get_platform_files(config, section)
+            if "catalog" not in files or "test_plan" not in files or \
+                    not config.has_option(section, "regex"):
+                logging.warn("Malformed section {0} in {1}"
+                             .format(section, self._cfg_file_name))
+                continue
+            topology = type("Simulated" + section, (_SimulatedTopology,), {})
+            topology.set_config_source(self._session.get_config)
+            if not topology.init(files["topology"], files["catalog"],
+                                 _SimulatedDevice, _SimulatedCutter) or \
+                    not topology.load():
+                logging.critical("Cannot load the topology of {0}"
+                                 .format(section))
+                return False
+            topology.scale(self._scale)
+            plan = self._load_test_plan(files["test_plan"])
+            if plan is None:
+                return False
+            self._platforms.append((re.compile(config.get(section, "regex")),
+                                    topology, plan))
+            for device in topology.get_devices():
+                self._devices[device.dev_id] = device
+        if self._channels_per_cutter:
+            for index, dev_id in enumerate(sorted(self._devices)):
+                self._devices[dev_id].channel = _SimulatedChannel(
+                    "sim{0}".format(index // self._channels_per_cutter),
+                    index % self._channels_per_cutter)
+        logging.info("Simulating {0} devices on {1} platforms."
+                     .format(len(self._devices), len(self._platforms)))
+        self._reset()
+        return True
+
+    def _load_test_plan(self, file_name):
+        """
+        Returns the test cases of the plan, with the requirements of the
+        plan, as the Tester collects them, None if it can't be read.
+        """
+        config = self._session.get_config(file_name)
+        if config is None:
+            logging.critical("Cannot read test plan {0}".format(file_name))
+            return None
+        requirements = []
+        for section in config.sections():
+            if config.has_option(section, "requires"):
+                requirements.extend(parse_requirements(
+                    config.get(section, "requires")))
+        return {"cases": config.sections(), "requirements": requirements}
+
+    def _schedule(self, delay, callback, *args):
+        """
+        Queues an event delay seconds from now.
+        """
+        self._sequence += 1
+        heapq.heappush(self._events, (self._now + delay, self._sequence,
+                                      callback, args))
+
+    def _arrive(self, job):
+        """
+        A job is submitted: it is matched to its platform and devices.
+        """
+        for regex, topology, plan in self._platforms:
+            if regex.match(job["image"]):
+                break
+        else:
+            job["state"] = "untestable"
+            return
+        job["plan"] = plan
+        job["candidates"] = topology.get_compatible_devices(
+            job["image"], plan["requirements"] +
+            parse_requirements(job["require"]))
+        if not job["candidates"]:
+            job["state"] = "untestable"
+            return
+        job["state"] = "waiting"
+        for device in job["candidates"]:
+            if device.dev_id not in self._busy:
+                self._reserve(job, device)
+                return
+        self._waiting.append(job)
+
+    def _reserve(self, job, device):
+        """
+        The job holds the device: the image is written, unless the
+        device already holds it.
+        """
+        self._busy[device.dev_id] = job
+        job.update(state="running", device=device, reserved=self._now)
+        if self._images.get(device.dev_id) == job["image"]:
+            job["write_skipped"] = True
+            self._switch(device, 2, self._boot, job)
+        else:
+            self._start_write(job)
+
+    def _start_write(self, job):
+        """
+        Writes the image, once a slot for writing is available.
+        """
+        if self._max_writes and self._writing >= self._max_writes:
+            self._write_queue.append(job)
+            return
+        self._writing += 1
+        job["write_start"] = self._now
+        self._images.pop(job["device"].dev_id, None)
+        self._schedule(self._durations.phase(job["device"].model, "write"),
+                       self._end_write, job)
+
+    def _end_write(self, job):
+        """
+        The image is written: the device is powered on.
+        """
+        self._writing -= 1
+        self._images[job["device"].dev_id] = job["image"]
+        if self._write_queue:
+            self._start_write(self._write_queue.pop(0))
+        self._switch(job["device"], 1, self._boot, job)
+
+    def _switch(self, device, changes, callback, job):
+        """
+        Changes the state of the channel of the device, changes times:
+        the changes of each cutter are serialized.
+        """
+        cutter_id = device.channel.cutter_id
+        start = max(self._now, self._cutter_free.get(cutter_id, 0.0))
+        for _ in range(changes):
+            start += self._durations.phase(device.model, "switch")
+        self._cutter_free[cutter_id] = start
+        self._schedule(start - self._now, callback, job)
+
+    def _boot(self, job):
+        """
+        The device is powered on: the tests start once it is ready.
+        """
+        device = job["device"]
+        expected = device.catalog_entry.get("expected_boot_time")
+        self._schedule(self._durations.phase(device.model, "boot",
+                                             default=expected),
+                       self._test, job)
+
+    def _test(self, job):
+        """
+        Runs the test plan, then powers off the device.
+        """
+        job["test_start"] = self._now
+        model = job["device"].model
+        duration = sum(self._durations.case(model, name)
+                       for name in job["plan"]["cases"])
+        self._schedule(duration, self._switch, job["device"], 1,
+                       self._release, job)
+
+    def _release(self, job):
+        """
+        The job ends, its device goes to the job waiting for it which
+        polls first.
+        """
+        device = job["device"]
+        job.update(state="completed", end=self._now)
+        del self._busy[device.dev_id]
+        self._busy_time[device.dev_id] += self._now - job["reserved"]
+        best = None
+        for waiting in self._waiting:
+            if device not in waiting["candidates"]:
+                continue
+            delay = 0.0
+            if self._poll:
+                delay = self._poll - (self._now - waiting["time"]) % self._poll
+            if best is None or delay < best[0]:
+                best = (delay, waiting)
+        if best is not None:
+            self._waiting.remove(best[1])
+            self._busy[device.dev_id] = best[1]
+            self._schedule(best[0], self._reserve, best[1], device)
+
+    def run(self, jobs):
+        """
+        Simulates the jobs, dictionaries with the arrival time in seconds,
+        the image and the capabilities required, until all are done.
+        Returns the report: see report().
+        """
+        self._reset()
+        start = time.time()
+        for job in jobs:
+            job = dict(job, state="submitted", write_skipped=False)
+            self._jobs.append(job)
+            self._now = job["time"]
+            self._schedule(0, self._arrive, job)
+        self._now = 0.0
+        events = 0
+        while self._events:
+            self._now, _, callback, args = heapq.heappop(self._events)
+            callback(*args)
+            events += 1
+        logging.info("Simulated {0} events in {1:.2f}s."
+                     .format(events, time.time() - start))
+        return self.report()
+
+    def report(self):
+        """
+        Returns a dictionary with the number of jobs, completed and
+        untestable, the throughput in jobs per hour, the percentiles of
+        the wait for a device and of the turnaround, in seconds, the
+        writes performed and skipped, and the utilization of each device
+        and of each model.
+        """
+        completed = [job for job in self._jobs if job["state"] == "completed"]
+        first = min([job["time"] for job in self._jobs] or [0.0])
+        span = max(self._now - first, 1.0)
+        models = {}
+        for dev_id, device in self._devices.items():
+            models.setdefault(device.model, []).append(
+                self._busy_time[dev_id] / span)
+        return {
+            "jobs": len(self._jobs),
+            "completed": len(completed),
+            "untestable": len([job for job in self._jobs
+                               if job["state"] == "untestable"]),
+            "span": span,
+            "throughput": len(completed) * 3600.0 / span,
+            "wait": _percentiles([job["reserved"] - job["time"]
+                                  for job in completed]),
+            "turnaround": _percentiles([job["end"] - job["time"]
+                                        for job in completed]),
+            "writes": len([job for job in completed
+                           if not job["write_skipped"]]),
+            "writes_skipped": len([job for job in completed
+                                   if job["write_skipped"]]),
+            "utilization": dict((dev_id, busy_time / span) for
+                                dev_id, busy_time in self._busy_time.items()),
+            "model_utilization": dict((model, sum(values) / len(values))
+                                      for model, values in models.items()),
+        }
+
+
+def _format_duration(seconds):
+    """
+    Seconds as H:MM:SS, - if unknown.
+    """
+    if seconds is None:
+        return "-"
+    return "{0}:{1:02d}:{2:02d}".format(int(seconds) // 3600,
+                                        int(seconds) % 3600 // 60,
+                                        int(seconds) % 60)
+
+
+def _parse_scale(values):
+    """
+    Converts "N" and "MODEL:N" into the factors of the topologies.
+    """
+    factors = {}
+    for value in values:
+        model, _, factor = value.rpartition(":")
+        factors[model or None] = int(factor)
+    return factors
+
+
+def main(argv=None):
+    """
+    Command line interface: a trace, or random arrivals, are simulated
+    and the report is printed.
+    """
+    parser = ArgumentParser(description="Simulate the farm described by the "
+                                        "aft configuration.")
+    parser.add_argument("--cfg", action="store", default=None,
+                        help="Master configuration file.")
+    parser.add_argument("--durations", action="store", default=None,
+                        help="Distributions of the durations of the phases, "
+                             "per device model.")
+    parser.add_argument("--no-history", action="store_true", default=False,
+                        help="Don't use the history for the durations of "
+                             "the test cases.")
+    parser.add_argument("--trace", action="store", default=None,
+                        help="Jobs to simulate, as json lines.")
+    parser.add_argument("--rate", action="store", type=float, default=10.0,
+                        help="Jobs per hour, without --trace.")
+    parser.add_argument("--image", action="append", default=[],
+                        help="Image of the jobs, without --trace, "
+                             "can be repeated.")
+    parser.add_argument("--days", action="store", type=float, default=7.0,
+                        help="Days of arrivals, without --trace.")
+    parser.add_argument("--seed", action="store", type=int, default=None,
+                        help="Seed of the random generator.")
+    parser.add_argument("--scale", action="append", default=[],
+                        help="Devices per device of the topology, either for "
+                             "all the models or as MODEL:N, can be repeated.")
+    parser.add_argument("--channels-per-cutter", action="store", type=int,
+                        default=None,
+                        help="Rewire the devices onto cutters with this many "
+                             "channels.")
+    parser.add_argument("--max-writes", action="store", type=int, default=0,
+                        help="Images written in parallel at most (default: "
+                             "no limit).")
+    parser.add_argument("--poll", action="store", type=float,
+                        default=DevicesTopology.RESERVE_POLL,
+                        help="Seconds between attempts of reservation, 0 for "
+                             "immediate handover.")
+    parser.add_argument("--json", action="store_true", default=False,
+                        help="Print the report as json.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    rng = random.Random(args.seed)
+    if args.trace is not None:
+        jobs = load_trace(args.trace)
+        if jobs is None:
+            return 1
+    elif args.image:
+        jobs = generate_trace(args.image, args.rate, args.days * 86400, rng)
+    else:
+        parser.error("Either --trace or --image is required.")
+    durations = Durations(rng)
+    if not durations.load(args.durations, use_history=not args.no_history):
+        return 1
+    try:
+        scale = _parse_scale(args.scale)
+    except ValueError as error:
+        parser.error("Malformed --scale: {0}".format(error))
+    simulator = FarmSimulator(durations, cfg_file_name=args.cfg,
+                              scale=scale,
+                              channels_per_cutter=args.channels_per_cutter,
+                              max_writes=args.max_writes, poll=args.poll)
+    if not simulator.load():
+        return 1
+    report = simulator.run(jobs)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+        return 0
+    print("jobs\t{0}\ncompleted\t{1}\nuntestable\t{2}\nspan\t{3}\n"
+          "throughput\t{4:.2f} jobs/h\nwrites\t{5}\nwrites skipped\t{6}"
+          .format(report["jobs"], report["completed"], report["untestable"],
+                  _format_duration(report["span"]), report["throughput"],
+                  report["writes"], report["writes_skipped"]))
+    for name in ("wait", "turnaround"):
+        print("{0}\t{1}".format(name, "\t".join(
+            "{0}={1}".format(key, _format_duration(report[name][key]))
+            for key in ("p50", "p90", "p99", "max"))))
+    for model in sorted(report["model_utilization"]):
+        print("utilization\t{0}\t{1:.1%}"
+              .format(model, report["model_utilization"][model]))
+    for dev_id in sorted(report["utilization"]):
+        print("utilization\t{0}\t{1:.1%}"
+              .format(dev_id, report["utilization"][dev_id]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Helpers for batched transfers of files between host and device.
+"""
+
+import os
+import hashlib
+import logging
+import tarfile
+
+VERSION = "0.1.0"
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def create_archive(file_pairs, archive):
+    """
+    Writes into the file object archive an uncompressed tar containing
+    every (local_file, remote_file) pair, stored under the remote path,
+    relative to the root directory of the device.
+    """
+    tar = tarfile.open(fileobj=archive, mode="w")
+    try:
+        for local_file, remote_file in file_pairs:
+            tar.add(local_file, arcname=remote_file.lstrip("/"))
+    finally:
+        tar.close()
+    archive.flush()
+    archive.seek(0)
+
+
+def resolve_path(root, path):
+    """
+    Absolute path of path inside root, None if it points outside.
+    """
+    root = os.path.realpath(root)
+    full_path = os.path.realpath(os.path.join(root, path.lstrip("/")))
+    if full_path != root and not full_path.startswith(root + os.sep):
+        return None
+    return full_path
+
+
+def is_safe_member(dir_name, member):
+    """
+    True if the member of an archive, and the target of a link, are
+    inside dir_name, following the links already extracted there.
+    Device files are never safe.
+    """
+    if member.isdev() or resolve_path(dir_name, member.name) is None:
+        return False
+    if member.issym():
+        return not os.path.isabs(member.linkname) and resolve_path(
+            dir_name, os.path.join(os.path.dirname(member.name),
+                                   member.linkname)) is not None
+    if member.islnk():
+        return not os.path.isabs(member.linkname) and \
+            resolve_path(dir_name, member.linkname) is not None
+    return True
+
+
+def _safe_members(tar, root):
+    """
+    Yields the members of the archive safe to extract into root, skipping
+    the others. Each one is checked only when the ones before it are
+    extracted, so that a path through a link extracted earlier can't
+    escape either.
+    """
+    for member in tar:
+        if is_safe_member(root, member):
+            yield member
+        else:
+            logging.warn("Skipping unsafe member {0} of the archive."
+                         .format(member.name))
+
+
+def extract_archive(archive_name, local_dir):
+    """
+    Unpacks a tar, compressed or not, into local_dir.
+    Members trying to escape from local_dir are skipped.
+    """
+    root = os.path.realpath(local_dir)
+    tar = tarfile.open(archive_name, mode="r:*")
+    try:
+        tar.extractall(path=root, members=_safe_members(tar, root))
+    finally:
+        tar.close()
+    return True
+
+
+def file_digest(file_name):
+    """
+    md5 of a local file, as printed by md5sum.
+    """
+    digest = hashlib.md5()
+    with open(file_name, "rb") as local_file:
+        for chunk in iter(lambda: local_file.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def local_digests(local_dir, remote_dir):
+    """
+    Yields (local_file, remote_file, md5) for each file in local_dir,
+    mapping it to the same relative path inside remote_dir.
+    """
+    for dir_path, _, file_names in os.walk(local_dir):
+        for file_name in file_names:
+            local_file = os.path.join(dir_path, file_name)
+            relative = os.path.relpath(local_file, local_dir)
+            yield (local_file,
+                   os.path.normpath(os.path.join(remote_dir, relative)),
+                   file_digest(local_file))
+
+
+def parse_digests(md5sum_output):
+    """
+    Converts the output of md5sum into a dictionary path -> md5.
+    """
+    digests = {}
+    for line in md5sum_output.splitlines():
+        fields = line.split(None, 1)
+        if len(fields) == 2:
+            digests[os.path.normpath(fields[1].strip())] = fields[0]
+    return digests
@@ -0,0 +1,277 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Fingerprints of the images deployed on the devices.
+"""
+
+import os
+import time
+import errno
+import signal
+import hashlib
+import logging
+import ConfigParser
+
+VERSION = "0.1.0"
+
+_STATE_ROOT = os.getenv("AFT_STATEROOT", "/var/lib/aft/")
+_FINGERPRINTS_DIR = os.path.join(_STATE_ROOT, "fingerprints")
+_LEASES_DIR = os.path.join(_STATE_ROOT, "leases")
+_HASH_CACHE_FILE = os.path.join(_STATE_ROOT, "image_hashes.cfg")
+_CHUNK_SIZE = 4 * 1024 * 1024
+_SECTION = "image"
+_LEASE_SECTION = "lease"
+# Seconds a pre-empted process group gets to exit before being killed
+PREEMPT_TIMEOUT = 30
+
+
+class ImageFingerprint(dict):
+    """
+    Describes an image and the way it was written to a device.
+    """
+    KEYS = ("image_hash", "device_class", "write_parameters")
+
+    def __init__(self, image_hash, device_class, write_parameters):
+        super(ImageFingerprint, self).__init__()
+        self["image_hash"] = image_hash
+        self["device_class"] = device_class
+        self["write_parameters"] = write_parameters
+
+    @classmethod
+    def compute(cls, file_name, device):
+        """
+        Fingerprint of the image file, when written by device.
+        """
+        device_class = type(device)
+        parameters = hashlib.sha256(
+            repr(sorted(device.catalog_entry.items()))).hexdigest()
+        return cls(image_hash=image_hash(file_name),
+                   device_class=".".join((device_class.__module__,
+                                          device_class.__name__)),
+                   write_parameters=parameters)
+
+    def matches(self, other):
+        """
+        True if other describes the same image, written the same way.
+        """
+        return other is not None and \
+            all(self[key] == other.get(key) for key in self.KEYS)
+
+
+def image_hash(file_name):
+    """
+    sha256 of the image: cached by path, size and modification time,
+    to avoid re-reading large images at every run.
+    """
+    file_name = os.path.abspath(file_name)
+    stat = os.stat(file_name)
+    cache = ConfigParser.RawConfigParser()
+    cache.read(_HASH_CACHE_FILE)
+    if cache.has_section(file_name) and \
+            cache.get(file_name, "size") == str(stat.st_size) and \
+            cache.get(file_name, "mtime") == repr(stat.st_mtime):
+        return cache.get(file_name, "sha256")
+    logging.info("Computing hash of image {0}.".format(file_name))
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as image:
+        for chunk in iter(lambda: image.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    if not cache.has_section(file_name):
+        cache.add_section(file_name)
+    cache.set(file_name, "size", str(stat.st_size))
+    cache.set(file_name, "mtime", repr(stat.st_mtime))
+    cache.set(file_name, "sha256", digest.hexdigest())
+    try:
+        _write_config(cache, _HASH_CACHE_FILE)
+    except (OSError, IOError) as error:
+        logging.warn("Cannot cache image hash: {0}".format(error))
+    return digest.hexdigest()
+
+
+def _fingerprint_file_name(dev_id):
+    """
+    File holding the fingerprint of the image deployed on the device.
+    """
+    return os.path.join(_FINGERPRINTS_DIR, "{0}.cfg".format(dev_id))
+
+
+def _write_config(config, file_name):
+    """
+    Atomically replaces file_name with the content of config.
+    """
+    dir_name = os.path.dirname(file_name)
+    if not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+    temp_file_name = "{0}.{1}".format(file_name, os.getpid())
+    with open(temp_file_name, "w") as config_file:
+        config.write(config_file)
+    os.rename(temp_file_name, file_name)
+
+
+def load_fingerprint(dev_id):
+    """
+    Returns the fingerprint recorded for the device, if any.
+    """
+    config = ConfigParser.RawConfigParser()
+    config.read(_fingerprint_file_name(dev_id))
+    try:
+        return ImageFingerprint(**dict((key, config.get(_SECTION, key))
+                                       for key in ImageFingerprint.KEYS))
+    except ConfigParser.Error:
+        return None
+
+
+def save_fingerprint(dev_id, fingerprint):
+    """
+    Records the fingerprint of the image just written to the device.
+    """
+    config = ConfigParser.RawConfigParser()
+    config.add_section(_SECTION)
+    for key in ImageFingerprint.KEYS:
+        config.set(_SECTION, key, fingerprint[key])
+    config.set(_SECTION, "written_at", repr(time.time()))
+    try:
+        _write_config(config, _fingerprint_file_name(dev_id))
+    except (OSError, IOError) as error:
+        logging.warn("Cannot record image fingerprint for {0}: {1}"
+                     .format(dev_id, error))
+        return False
+    return True
+
+
+def clear_fingerprint(dev_id):
+    """
+    Forgets the image of the device: must be called before writing,
+    so that an interrupted write doesn't leave a stale fingerprint.
+    """
+    try:
+        os.unlink(_fingerprint_file_name(dev_id))
+    except OSError:
+        pass
+    return True
+
+
+def _lease_file_name(dev_id):
+    """
+    File holding the lease of the device being pre-provisioned.
+    """
+    return os.path.join(_LEASES_DIR, "{0}.cfg".format(dev_id))
+
+
+def save_lease(dev_id, image_hash):
+    """
+    Records that the calling process is pre-provisioning the device with
+    the image, speculatively: jobs for other images can pre-empt it, by
+    terminating the whole process group of the caller, which must lead it.
+    """
+    config = ConfigParser.RawConfigParser()
+    config.add_section(_LEASE_SECTION)
+    config.set(_LEASE_SECTION, "pid", str(os.getpid()))
+    config.set(_LEASE_SECTION, "pgid", str(os.getpgrp()))
+    config.set(_LEASE_SECTION, "image_hash", image_hash)
+    config.set(_LEASE_SECTION, "started", repr(time.time()))
+    try:
+        _write_config(config, _lease_file_name(dev_id))
+    except (OSError, IOError) as error:
+        logging.warn("Cannot record the lease of {0}: {1}"
+                     .format(dev_id, error))
+        return False
+    return True
+
+
+def load_lease(dev_id):
+    """
+    Returns the lease of the device, a dictionary with pid, pgid,
+    image_hash and started, or None if there is none or its process is
+    gone.
+    """
+    config = ConfigParser.RawConfigParser()
+    config.read(_lease_file_name(dev_id))
+    try:
+        lease = {"pid": config.getint(_LEASE_SECTION, "pid"),
+                 "pgid": config.getint(_LEASE_SECTION, "pgid"),
+                 "image_hash": config.get(_LEASE_SECTION, "image_hash"),
+                 "started": config.getfloat(_LEASE_SECTION, "started")}
+    except (ConfigParser.Error, ValueError):
+        return None
+    try:
+        os.kill(lease["pid"], 0)
+    except OSError as error:
+        if error.errno == errno.ESRCH:
+            return None
+    return lease
+
+
+def clear_lease(dev_id, pid=None):
+    """
+    Removes the lease of the device, only if held by pid, when given.
+    """
+    if pid is not None:
+        config = ConfigParser.RawConfigParser()
+        config.read(_lease_file_name(dev_id))
+        try:
+            if config.getint(_LEASE_SECTION, "pid") != pid:
+                return False
+        except (ConfigParser.Error, ValueError):
+            return False
+    try:
+        os.unlink(_lease_file_name(dev_id))
+    except OSError:
+        pass
+    return True
+
+
+def preempt_lease(dev_id, image_hash):
+    """
+    Stops the pre-provisioning of the device, unless it is writing the
+    image with image_hash: terminates the process group holding the lease,
+    with the tools writing the image, and waits for all of it to exit, so
+    that nothing holds the lock of the device or writes to it any more.
+    Returns True if it was stopped.
+    """
+    lease = load_lease(dev_id)
+    if lease is None or lease["image_hash"] == image_hash:
+        return False
+    logging.info("Pre-empting the pre-provisioning of {0}, pid {1}."
+                 .format(dev_id, lease["pid"]))
+    try:
+        os.killpg(lease["pgid"], signal.SIGTERM)
+    except OSError as error:
+        logging.warn("Cannot pre-empt {0}: {1}".format(dev_id, error))
+        return False
+    if not _wait_for_group(lease["pgid"], PREEMPT_TIMEOUT):
+        logging.warn("Pre-provisioning of {0} still running, killing it."
+                     .format(dev_id))
+        try:
+            os.killpg(lease["pgid"], signal.SIGKILL)
+        except OSError:
+            pass
+        _wait_for_group(lease["pgid"], PREEMPT_TIMEOUT)
+    return True
+
+
+def _wait_for_group(pgid, timeout):
+    """
+    Waits for all the processes of the group to exit, returns False if
+    some are still running after timeout seconds.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            os.killpg(pgid, 0)
+        except OSError as error:
+            if error.errno == errno.ESRCH:
+                return True
+        if time.time() > deadline:
+            return False
+        time.sleep(0.1)
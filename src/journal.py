@@ -0,0 +1,118 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Checkpoint journal, for resuming interrupted test plans.
+"""
+
+import os
+import glob
+import json
+import logging
+
+VERSION = "0.1.0"
+
+
+class Journal(object):
+    """
+    Append-only record of the progress of a run, stored in its results
+    directory: every line is a json object, flushed to disk as soon as it
+    is written, so that a crash loses at most the case being executed.
+    """
+    FILE_NAME = "journal"
+
+    def __init__(self, results_dir):
+        self.results_dir = results_dir
+        self._file_name = os.path.join(results_dir, self.FILE_NAME)
+        self.header = None
+        self.cases = {}
+        self.finished = False
+
+    @classmethod
+    def find_latest(cls, exec_root):
+        """
+        Returns the results directory of the most recent unfinished run.
+        """
+        candidates = []
+        for file_name in glob.glob(os.path.join(exec_root + "*",
+                                                cls.FILE_NAME)):
+            journal = cls(os.path.dirname(file_name))
+            if journal.load() and not journal.finished:
+                candidates.append((os.path.getmtime(file_name),
+                                   journal.results_dir))
+        if not candidates:
+            return None
+        return max(candidates)[1]
+
+    def load(self):
+        """
+        Reads back the journal. A truncated last line, left by a crash,
+        is ignored.
+        """
+        try:
+            with open(self._file_name) as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logging.warn("Skipping corrupted journal entry.")
+                        continue
+                    if record["type"] == "start":
+                        self.header = record
+                    elif record["type"] == "case":
+                        self.cases[record["name"]] = record
+                    elif record["type"] == "end":
+                        self.finished = True
+        except (IOError, KeyError) as error:
+            logging.critical("Cannot load journal {0}: {1}"
+                             .format(self._file_name, error))
+            return False
+        return self.header is not None
+
+    def _append(self, record):
+        """
+        Writes one record and forces it to disk.
+        """
+        if not os.path.isdir(self.results_dir):
+            os.makedirs(self.results_dir)
+        with open(self._file_name, "a") as journal:
+            journal.write(json.dumps(record) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def start(self, file_name, dev_id, fingerprint):
+        """
+        Records which image is being tested on which device.
+        """
+        self.header = {"type": "start", "file_name": file_name,
+                       "dev_id": dev_id, "fingerprint": dict(fingerprint)}
+        self._append(self.header)
+
+    def record_case(self, test_case):
+        """
+        Records the outcome of a completed test case.
+        """
+        duration = test_case["duration"]
+        record = {"type": "case", "name": test_case["name"],
+                  "result": test_case["result"],
+                  "duration": duration.total_seconds()
+                              if duration is not None else None,
+                  "test_dir": test_case["test_dir"],
+                  "xunit_section": test_case.get_xunit_section()}
+        self._append(record)
+
+    def finish(self):
+        """
+        Marks the run as complete: it won't be offered for resuming.
+        """
+        self.finished = True
+        self._append({"type": "end"})
@@ -0,0 +1,305 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Logging pipeline: records are queued by the logging threads and formatted
+and written by one background thread, into the main log and into one file
+per device and per job.
+"""
+
+import os
+import gzip
+import json
+import Queue
+import shutil
+import logging
+import threading
+import logging.handlers
+from collections import OrderedDict
+
+VERSION = "0.1.0"
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+_LOG_DIR = os.getenv("AFT_LOG_DIR", "aft_logs")
+
+_context = threading.local()
+
+
+def get_context():
+    """
+    Returns the device and job the calling thread is working for.
+    """
+    return dict(getattr(_context, "fields", {}))
+
+
+def set_context(**fields):
+    """
+    Tags the records logged by the calling thread, e.g. with device and
+    job, so that they are also written in the files of the device and of
+    the job. A None value removes the field.
+    """
+    current = getattr(_context, "fields", {})
+    current.update(fields)
+    _context.fields = dict((key, value) for key, value in current.items()
+                           if value is not None)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One json object per record, for machine processing of the logs.
+    """
+    def format(self, record):
+        entry = {"time": record.created, "level": record.levelname,
+                 "logger": record.name, "thread": record.threadName,
+                 "message": record.getMessage()}
+        for field in ("device", "job"):
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotating file handler compressing the files rotated out with gzip.
+    """
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        for index in range(self.backupCount - 1, 0, -1):
+            source = "{0}.{1}.gz".format(self.baseFilename, index)
+            if os.path.exists(source):
+                os.rename(source, "{0}.{1}.gz".format(self.baseFilename,
+                                                      index + 1))
+        if self.backupCount > 0 and os.path.exists(self.baseFilename):
+            with open(self.baseFilename, "rb") as source:
+                with gzip.open(self.baseFilename + ".1.gz", "wb") as target:
+                    shutil.copyfileobj(source, target)
+            os.remove(self.baseFilename)
+        self.mode = "w"
+        self.stream = self._open()
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Queues the records, to be formatted and written by a background
+    thread, so that logging doesn't block the callers on the disk nor on
+    each other. The arguments of a record are formatted only when written:
+    they must not be modified after being logged.
+    """
+    _MAX_OPEN_FILES = 64
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, main_handler, log_dir=None, formatter=None,
+                 max_bytes=10 * 1024 * 1024, backup_count=5):
+        super(AsyncHandler, self).__init__()
+        self._main_handler = main_handler
+        self._log_dir = log_dir
+        self._formatter = formatter
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._files = OrderedDict()
+        self._queue = Queue.Queue()
+        self._start_writer()
+    # pylint: enable=too-many-arguments
+
+    def _start_writer(self):
+        """
+        Starts the background thread writing the records.
+        """
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._writer,
+                                        name="log-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def after_fork(self):
+        """
+        Makes the handler usable in a child process. The locks, the queue
+        and the files inherited from the parent may have been in use by
+        its threads at the time of the fork: they are abandoned, without
+        touching them, and the child gets its own, with its own writer.
+        Returns the file handlers abandoned.
+        """
+        if self._pid == os.getpid():
+            return []
+        abandoned = [self._main_handler] + self._files.values()
+        self.createLock()
+        main_handler = self._main_handler
+        self._main_handler = CompressingRotatingFileHandler(
+            main_handler.baseFilename, maxBytes=main_handler.maxBytes,
+            backupCount=main_handler.backupCount)
+        self._main_handler.setFormatter(main_handler.formatter)
+        self._files = OrderedDict()
+        self._queue = Queue.Queue()
+        self._start_writer()
+        return abandoned
+
+    def emit(self, record):
+        for field, value in getattr(_context, "fields", {}).items():
+            setattr(record, field, value)
+        self._queue.put(record)
+
+    def _get_file_handler(self, file_name, make_dirs=True):
+        """
+        Returns the handler writing file_name, opening it if needed.
+        Without make_dirs, returns None if its directory doesn't exist.
+        """
+        handler = self._files.pop(file_name, None)
+        if handler is None:
+            dir_name = os.path.dirname(file_name)
+            if dir_name and not os.path.isdir(dir_name):
+                if not make_dirs:
+                    return None
+                os.makedirs(dir_name)
+            if len(self._files) >= self._MAX_OPEN_FILES:
+                self._files.popitem(last=False)[1].close()
+            handler = CompressingRotatingFileHandler(
+                file_name, maxBytes=self._max_bytes,
+                backupCount=self._backup_count)
+            handler.setFormatter(self._formatter)
+        self._files[file_name] = handler
+        return handler
+
+    def _targets(self, record):
+        """
+        Returns the handlers the record must be written to.
+        """
+        targets = [self._main_handler]
+        device = getattr(record, "device", None)
+        if device is not None and self._log_dir is not None:
+            targets.append(self._get_file_handler(
+                os.path.join(self._log_dir, str(device) + ".log")))
+        job = getattr(record, "job", None)
+        if job is not None:
+            # The directory of the job is created by the job, not here
+            handler = self._get_file_handler(os.path.join(job, "aft.log"),
+                                             make_dirs=False)
+            if handler is not None:
+                targets.append(handler)
+        return targets
+
+    def _writer(self):
+        """
+        Writes the queued records, until a None is received.
+        """
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            if not isinstance(record, logging.LogRecord):
+                # An event from close_files
+                for handler in self._files.values():
+                    handler.close()
+                self._files.clear()
+                record.set()
+                continue
+            try:
+                for handler in self._targets(record):
+                    handler.handle(record)
+            # pylint: disable=broad-except
+            except Exception:
+                self.handleError(record)
+            # pylint: enable=broad-except
+
+    def close_files(self):
+        """
+        Writes the records queued so far and closes the per device and per
+        job files, which are reopened if more records arrive for them.
+        """
+        if not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        """
+        Writes the records still queued, then closes the files.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        for handler in self._files.values():
+            handler.close()
+        self._files.clear()
+        self._main_handler.close()
+        super(AsyncHandler, self).close()
+
+
+def after_fork():
+    """
+    To be called in a child process right after fork, before logging.
+    The parent's threads may have been holding the locks of the logging
+    module and of the handlers: they are replaced, and the pipeline gets
+    a writer thread of its own, so that logging and setup_logging can't
+    deadlock in the child.
+    """
+    # pylint: disable=protected-access
+    logging._lock = threading.RLock()
+    abandoned = []
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, AsyncHandler):
+            abandoned.extend(handler.after_fork())
+        else:
+            handler.createLock()
+    # Keep logging.shutdown from flushing the files of the parent
+    logging._handlerList[:] = [reference
+                               for reference in logging._handlerList
+                               if reference() not in abandoned]
+    # pylint: enable=protected-access
+
+
+def close_log_files():
+    """
+    Completes the per device and per job log files written so far, e.g.
+    before moving them.
+    """
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, AsyncHandler):
+            handler.close_files()
+
+
+# pylint: disable=too-many-arguments
+def setup_logging(file_name="aft.log", level=logging.DEBUG, log_dir=_LOG_DIR,
+                  json_output=None, max_bytes=10 * 1024 * 1024,
+                  backup_count=5):
+    """
+    Replaces the handlers of the root logger with the logging pipeline.
+    By default the output is json if AFT_LOG_JSON is set.
+    Returns the handler installed.
+    """
+    if json_output is None:
+        json_output = bool(os.getenv("AFT_LOG_JSON"))
+    formatter = JsonFormatter() if json_output else \
+        logging.Formatter(LOG_FORMAT)
+    main_handler = CompressingRotatingFileHandler(
+        file_name, maxBytes=max_bytes, backupCount=backup_count)
+    main_handler.setFormatter(formatter)
+    handler = AsyncHandler(main_handler, log_dir=log_dir, formatter=formatter,
+                           max_bytes=max_bytes, backup_count=backup_count)
+    root = logging.getLogger()
+    if any(isinstance(old_handler, AsyncHandler) and
+           old_handler._pid != os.getpid() # pylint: disable=protected-access
+           for old_handler in root.handlers):
+        after_fork()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+        if isinstance(old_handler, AsyncHandler):
+            old_handler.close()
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
+# pylint: enable=too-many-arguments
@@ -17,24 +17,26 @@ Main entry point for aft.
 import sys
 import logging
 
-from aft.devicesmanager import DevicesManager
+from aft.aftsession import AftSession
+from aft.logpipeline import AsyncHandler, setup_logging
+
+_SESSION = None
 
 
 def main(argv=None):
     """
     Entry point for library-like use.
+    argv is in the same format as sys.argv, program name included.
+    Calls in the same process share one AftSession, for services running
+    many validations, AftSession can also be used directly.
     """
-    logging.basicConfig(filename='aft.log', level=logging.DEBUG,
-                        format='%(asctime)s - %(name)s - '
-                               '%(levelname)s - %(message)s')
-    if argv is not None:
-        backup_argv = sys.argv
-        sys.argv = argv
-    DevicesManager()
-    retval = DevicesManager.run()
-    if "backup_argv" in locals():
-        sys.argv = backup_argv
-    return retval
+    global _SESSION # pylint: disable=global-statement
+    if not any(isinstance(handler, AsyncHandler)
+               for handler in logging.getLogger().handlers):
+        setup_logging()
+    if _SESSION is None:
+        _SESSION = AftSession()
+    return _SESSION.run(None if argv is None else argv[1:])
 
 
 if __name__ == "__main__":
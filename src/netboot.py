@@ -0,0 +1,386 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Network boot: instead of writing the image to the storage of the device,
+the image is unpacked once on the host and the device boots it over the
+network, from the HTTP and TFTP servers of the host.
+
+The netboot root contains one directory per image, named after its hash,
+and the boot configuration of each device: an iPXE script in
+boot/<dev_id>.ipxe and, for devices with a known MAC address, a PXELINUX
+configuration in pxelinux.cfg/01-<mac>. Both refer to the files of the
+image relative to the root.
+"""
+
+import os
+import sys
+import time
+import fcntl
+import shutil
+import signal
+import socket
+import struct
+import logging
+import tarfile
+import tempfile
+import urllib
+import threading
+import SocketServer
+import SimpleHTTPServer
+from argparse import ArgumentParser
+
+from aft.imagefingerprint import image_hash
+from aft.filetransfer import resolve_path, is_safe_member
+from aft.logpipeline import setup_logging
+
+VERSION = "0.1.0"
+
+NETBOOT_ROOT = os.getenv("AFT_NETBOOT_ROOT",
+                         os.path.join(os.getenv("AFT_STATEROOT",
+                                                "/var/lib/aft/"),
+                                      "netboot"))
+HTTP_PORT = 8069
+TFTP_PORT = 69
+
+# Name of the image in its directory, when it is not an archive
+_RAW_IMAGE = "image"
+
+
+def _safe_members(archive, dir_name):
+    """
+    Yields the members of the archive, checking each one only when the
+    ones before it are extracted.
+    """
+    for member in archive:
+        if not is_safe_member(dir_name, member):
+            raise tarfile.TarError("Unsafe member {0}".format(member.name))
+        yield member
+
+
+def _extract(file_name, dir_name):
+    """
+    Unpacks a tar archive, refusing members pointing outside dir_name, or
+    links the image itself into dir_name, if it is not an archive.
+    Members are checked one at a time, right before being extracted, so
+    that a path through a link extracted earlier can't escape either.
+    """
+    if not tarfile.is_tarfile(file_name):
+        target = os.path.join(dir_name, _RAW_IMAGE)
+        try:
+            os.link(file_name, target)
+        except OSError:
+            shutil.copyfile(file_name, target)
+        return
+    with tarfile.open(file_name) as archive:
+        archive.extractall(dir_name, members=_safe_members(archive,
+                                                           dir_name))
+
+
+def unpack_image(file_name, root=NETBOOT_ROOT):
+    """
+    Unpacks the image into its directory of the netboot root, unless
+    already done by this or another process. Returns the name of the
+    directory, relative to root, or None on failure.
+    """
+    digest = image_hash(file_name)
+    dir_name = os.path.join(root, digest)
+    if os.path.isdir(dir_name):
+        os.utime(dir_name, None)
+        return digest
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    with open(dir_name + ".lock", "w") as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        if os.path.isdir(dir_name):
+            return digest
+        logging.info("Unpacking {0} for network boot.".format(file_name))
+        temp_dir = tempfile.mkdtemp(dir=root, prefix=".unpack.")
+        try:
+            _extract(file_name, temp_dir)
+            os.chmod(temp_dir, 0755)
+            os.rename(temp_dir, dir_name)
+        except (OSError, IOError, tarfile.TarError) as error:
+            logging.critical("Cannot unpack {0}: {1}".format(file_name,
+                                                             error))
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return None
+    return digest
+
+
+def _write_file(file_name, content):
+    """
+    Atomically replaces file_name with content.
+    """
+    dir_name = os.path.dirname(file_name)
+    if not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+    temp_file_name = "{0}.{1}".format(file_name, os.getpid())
+    with open(temp_file_name, "w") as temp_file:
+        temp_file.write(content)
+    os.chmod(temp_file_name, 0644)
+    os.rename(temp_file_name, file_name)
+
+
+def _boot_config_files(dev_id, mac, root):
+    """
+    Boot configuration files of the device.
+    """
+    file_names = [os.path.join(root, "boot", "{0}.ipxe".format(dev_id))]
+    if mac:
+        file_names.append(os.path.join(
+            root, "pxelinux.cfg",
+            "01-" + mac.lower().replace(":", "-")))
+    return file_names
+
+
+def write_boot_config(dev_id, image_dir, catalog_entry, mac=None,
+                      root=NETBOOT_ROOT):
+    """
+    Points the boot configuration of the device to the image unpacked in
+    image_dir. The catalog entry gives the paths of netboot_kernel and
+    netboot_initrd inside the image and netboot_cmdline, where {image_dir}
+    is replaced by the directory of the image, relative to the root.
+    Returns False if the entry lacks the kernel.
+    """
+    kernel = catalog_entry.get("netboot_kernel")
+    if kernel is None:
+        logging.critical("No netboot_kernel for {0} in the catalog."
+                         .format(catalog_entry.get("device_model")))
+        return False
+    initrd = catalog_entry.get("netboot_initrd")
+    cmdline = catalog_entry.get("netboot_cmdline", "").replace(
+        "{image_dir}", image_dir)
+    ipxe = ["#!ipxe",
+            "kernel ../{0}/{1} {2}".format(image_dir, kernel, cmdline)]
+    pxelinux = ["DEFAULT aft", "LABEL aft",
+                "  KERNEL {0}/{1}".format(image_dir, kernel)]
+    if initrd:
+        ipxe.append("initrd ../{0}/{1}".format(image_dir, initrd))
+        pxelinux.append("  INITRD {0}/{1}".format(image_dir, initrd))
+    ipxe.append("boot")
+    pxelinux.append("  APPEND {0}".format(cmdline))
+    try:
+        for file_name, lines in zip(_boot_config_files(dev_id, mac, root),
+                                    (ipxe, pxelinux)):
+            _write_file(file_name, "\n".join(lines) + "\n")
+    except (OSError, IOError) as error:
+        logging.critical("Cannot write the boot configuration of {0}: {1}"
+                         .format(dev_id, error))
+        return False
+    return True
+
+
+def clear_boot_config(dev_id, mac=None, root=NETBOOT_ROOT):
+    """
+    Removes the boot configuration of the device.
+    """
+    for file_name in _boot_config_files(dev_id, mac, root):
+        try:
+            os.unlink(file_name)
+        except OSError:
+            pass
+    return True
+
+
+class _HttpHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Serves the files of the netboot root.
+    """
+    def translate_path(self, path):
+        path = urllib.unquote(path.split("?", 1)[0].split("#", 1)[0])
+        # An empty path is not found, without leaking files outside root
+        return resolve_path(self.server.root, path) or ""
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        logging.debug("HTTP %s: %s", self.client_address[0], format % args)
+
+
+class _HttpServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    Threaded HTTP server.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _TftpHandler(SocketServer.BaseRequestHandler):
+    """
+    Read only TFTP (RFC 1350), octet and netascii transfers alike, from a
+    new port for each transfer, with the blksize option (RFC 2348).
+    """
+    RRQ, DATA, ACK, ERROR, OACK = 1, 3, 4, 5, 6
+    TIMEOUT = 2
+    RETRIES = 5
+
+    def _error(self, sock, code, message):
+        """
+        Sends an error packet.
+        """
+        sock.sendto(struct.pack("!HH", self.ERROR, code) + message + "\0",
+                    self.client_address)
+
+    def _send(self, sock, packet, block):
+        """
+        Sends a packet until it is acknowledged. Returns False on timeout.
+        """
+        for _ in range(self.RETRIES):
+            sock.sendto(packet, self.client_address)
+            deadline = time.time() + self.TIMEOUT
+            while time.time() < deadline:
+                sock.settimeout(max(0.01, deadline - time.time()))
+                try:
+                    reply, address = sock.recvfrom(516)
+                except socket.timeout:
+                    break
+                if address != self.client_address or len(reply) < 4:
+                    continue
+                opcode, number = struct.unpack("!HH", reply[:4])
+                if opcode == self.ACK and number == block:
+                    return True
+                if opcode == self.ERROR:
+                    return False
+        return False
+
+    def handle(self):
+        packet = self.request[0]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.server.server_address[0], 0))
+        try:
+            fields = packet[2:].split("\0")
+            if struct.unpack("!H", packet[:2])[0] != self.RRQ or \
+                    len(fields) < 2:
+                self._error(sock, 4, "Illegal TFTP operation")
+                return
+            options = dict(zip([field.lower() for field in fields[2:-1:2]],
+                               fields[3:-1:2]))
+            file_name = resolve_path(self.server.root, fields[0])
+            if file_name is None or not os.path.isfile(file_name):
+                self._error(sock, 1, "File not found")
+                return
+            block_size = 512
+            if "blksize" in options:
+                block_size = min(max(int(options["blksize"]), 8), 65464)
+                if not self._send(sock, struct.pack("!H", self.OACK) +
+                                  "blksize\0{0}\0".format(block_size), 0):
+                    return
+            logging.debug("TFTP %s: %s", self.client_address[0], fields[0])
+            with open(file_name, "rb") as source:
+                block = 1
+                while True:
+                    data = source.read(block_size)
+                    if not self._send(sock, struct.pack(
+                            "!HH", self.DATA, block & 0xffff) + data,
+                                      block & 0xffff):
+                        logging.warn("TFTP transfer of %s to %s timed out.",
+                                     fields[0], self.client_address[0])
+                        return
+                    if len(data) < block_size:
+                        return
+                    block += 1
+        except (ValueError, struct.error, IOError) as error:
+            logging.warn("TFTP request from %s failed: %s",
+                         self.client_address[0], error)
+        finally:
+            sock.close()
+
+
+class _TftpServer(SocketServer.ThreadingMixIn, SocketServer.UDPServer):
+    """
+    Threaded TFTP server.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class NetbootServer(object):
+    """
+    HTTP and TFTP servers of the netboot root, shared by all the devices
+    of the host. Port 0 picks a free port, e.g. for local testing.
+    """
+    def __init__(self, root=NETBOOT_ROOT, host="", http_port=HTTP_PORT,
+                 tftp_port=TFTP_PORT):
+        self._servers = []
+        for server_class, handler, port in (
+                (_HttpServer, _HttpHandler, http_port),
+                (_TftpServer, _TftpHandler, tftp_port)):
+            if port is None:
+                continue
+            server = server_class((host, port), handler)
+            server.root = root
+            self._servers.append(server)
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def get_ports(self):
+        """
+        Returns the ports the servers listen on: HTTP first, then TFTP.
+        """
+        return [server.server_address[1] for server in self._servers]
+
+    def start(self):
+        """
+        Serves in background threads.
+        """
+        for server in self._servers:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        logging.info("Serving network boot on ports {0}"
+                     .format(self.get_ports()))
+
+    def stop(self):
+        """
+        Stops the servers.
+        """
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+
+
+def main(argv=None):
+    """
+    Entry point of the network boot daemon.
+    """
+    parser = ArgumentParser(description="Serve the images unpacked for "
+                                        "network boot to the devices.")
+    parser.add_argument("--root", action="store", default=NETBOOT_ROOT,
+                        help="Netboot root directory.")
+    parser.add_argument("--host", action="store", default="",
+                        help="Address to listen on (default: all).")
+    parser.add_argument("--http-port", action="store", type=int,
+                        default=HTTP_PORT, help="HTTP port.")
+    parser.add_argument("--tftp-port", action="store", type=int,
+                        default=TFTP_PORT, help="TFTP port.")
+    args = parser.parse_args(argv)
+    setup_logging(file_name="aft-netbootd.log")
+    try:
+        server = NetbootServer(root=args.root, host=args.host,
+                               http_port=args.http_port,
+                               tftp_port=args.tftp_port)
+    except socket.error as error:
+        logging.critical("Cannot listen: {0}".format(error))
+        return 1
+    server.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
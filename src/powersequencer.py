@@ -0,0 +1,189 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Farm-wide power sequencing: many devices are powered in parallel, but with
+a bounded number booting at the same time and staggered power on, to avoid
+inrush current spikes and USB enumeration storms.
+"""
+
+import sys
+import time
+import logging
+import threading
+from argparse import ArgumentParser
+
+from aft.device import Device
+from aft.aftsession import AftSession
+from aft.concurrency import WorkerPool, gather
+from aft.devicesmanager import DevicesManager
+from aft.logpipeline import setup_logging
+
+VERSION = "0.1.0"
+
+
+class PowerSequencer(object):
+    """
+    Powers on, or power cycles, a set of devices. At most concurrency
+    devices are booting at any time and two consecutive power ons are at
+    least stagger seconds apart. A new device is powered as soon as one of
+    the booting ones becomes ready.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, concurrency=4, stagger=2.0, off_time=5.0,
+                 timeout=Device.BOOT_TIMEOUT, wait_ready=True):
+        self._concurrency = max(1, concurrency)
+        self._stagger = stagger
+        self._off_time = off_time
+        self._timeout = timeout
+        self._wait_ready = wait_ready
+        self._lock = threading.Lock()
+        self._next_power_on = 0
+    # pylint: enable=too-many-arguments
+
+    def _wait_turn(self):
+        """
+        Waits until the stagger interval since the previous power on has
+        elapsed.
+        """
+        with self._lock:
+            now = time.time()
+            turn = max(now, self._next_power_on)
+            self._next_power_on = turn + self._stagger
+        time.sleep(turn - now)
+
+    def _power_on(self, device):
+        """
+        Powers on one device and, if required, waits for it to be ready.
+        Returns its report.
+        """
+        report = {"device": device.name, "dev_id": device.dev_id,
+                  "powered": False, "ready": False, "boot_time": None}
+        self._wait_turn()
+        logging.info("Powering on %s", device.name)
+        if not device.attach():
+            logging.critical("Cannot power on %s", device.name)
+            return report
+        report["powered"] = True
+        if self._wait_ready and device.wait_until_ready(self._timeout):
+            report["ready"] = True
+            report["boot_time"] = device.boot_time
+        return report
+
+    def run(self, devices, cycle=False):
+        """
+        Powers on the devices, powering them off first if cycle is True.
+        Returns one report per device, in the same order: a dictionary with
+        device, dev_id, powered, ready and boot_time in seconds.
+        """
+        devices = list(devices)
+        pool = WorkerPool(min(self._concurrency, len(devices)) or 1)
+        try:
+            if cycle:
+                logging.info("Powering off %d devices.", len(devices))
+                gather([pool.submit(device.detach) for device in devices])
+                time.sleep(self._off_time)
+            start_time = time.time()
+            reports = gather([pool.submit(self._power_on, device)
+                              for device in devices])
+        finally:
+            pool.shutdown()
+        reports = [report if report is not None else
+                   {"device": device.name, "dev_id": device.dev_id,
+                    "powered": False, "ready": False, "boot_time": None}
+                   for device, report in zip(devices, reports)]
+        logging.info("Sequenced %d devices in %.1fs, %d ready.", len(devices),
+                     time.time() - start_time,
+                     len([report for report in reports if report["ready"]]))
+        return reports
+
+
+def main(argv=None):
+    """
+    Command line interface, for recovering the farm after maintenance.
+    Devices reserved by running jobs are skipped.
+    """
+    parser = ArgumentParser(description="Power on the devices of the farm "
+                                        "in staggered waves.")
+    parser.add_argument("--cfg", action="store", default=None,
+                        help="Master configuration file.")
+    parser.add_argument("--platform", action="append", default=[],
+                        help="Platform section of the master configuration "
+                             "(default: all), can be repeated.")
+    parser.add_argument("--cycle", action="store_true", default=False,
+                        help="Power off the devices first.")
+    parser.add_argument("--concurrency", action="store", type=int, default=4,
+                        help="Maximum number of devices booting together.")
+    parser.add_argument("--stagger", action="store", type=float, default=2.0,
+                        help="Minimum seconds between two power ons.")
+    parser.add_argument("--off-time", action="store", type=float,
+                        default=5.0,
+                        help="Seconds the devices stay off, with --cycle.")
+    parser.add_argument("--timeout", action="store", type=float,
+                        default=Device.BOOT_TIMEOUT,
+                        help="Maximum boot time of a device.")
+    parser.add_argument("--no-wait", action="store_true", default=False,
+                        help="Don't wait for the devices to be ready.")
+    parser.add_argument("devices", nargs="*",
+                        help="Names or ids of the devices (default: all).")
+    args = parser.parse_args(argv)
+    setup_logging()
+
+    session = AftSession()
+    cfg_file_name = args.cfg or DevicesManager.get_default_config_file()
+    config = session.get_config(cfg_file_name)
+    if config is None:
+        logging.critical("Cannot read %s", cfg_file_name)
+        return 1
+    locks = []
+    try:
+        for section in args.platform or config.sections():
+            manager = DevicesManager(session=session)
+            if not manager.load_platform(section, cfg_file_name):
+                return 1
+            topology_class = manager.get_topology_class()
+            for device in topology_class.get_devices():
+                if args.devices and device.name not in args.devices and \
+                        device.dev_id not in args.devices:
+                    continue
+                lockfile = topology_class.lock_device(device)
+                if lockfile is None:
+                    print("{0}\tbusy".format(device.name))
+                    continue
+                locks.append((topology_class, device, lockfile))
+        sequencer = PowerSequencer(concurrency=args.concurrency,
+                                   stagger=args.stagger,
+                                   off_time=args.off_time,
+                                   timeout=args.timeout,
+                                   wait_ready=not args.no_wait)
+        reports = sequencer.run([device for _, device, _ in locks],
+                                cycle=args.cycle)
+    finally:
+        for topology_class, device, lockfile in locks:
+            topology_class.unlock_device(device, lockfile)
+    failed = 0
+    for report in reports:
+        if not report["powered"]:
+            state = "failed"
+        elif args.no_wait:
+            state = "powered"
+        elif report["ready"]:
+            state = "ready\t{0:.1f}s".format(report["boot_time"])
+        else:
+            state = "not ready"
+        failed += state in ("failed", "not ready")
+        print("{0}\t{1}".format(report["device"], state))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,275 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Speculative pre-provisioning: idle devices are written in background with
+the images most likely to be tested next, according to the history, so
+that a job for one of them finds it already deployed.
+"""
+
+import os
+import sys
+import time
+import signal
+import sqlite3
+import logging
+from argparse import ArgumentParser
+
+from aft.aftsession import AftSession
+from aft.devicesmanager import DevicesManager
+from aft.resultstore import ResultStore
+from aft.logpipeline import setup_logging, set_context, after_fork
+from aft.imagefingerprint import ImageFingerprint, load_fingerprint, \
+    save_fingerprint, clear_fingerprint, save_lease, clear_lease
+
+VERSION = "0.1.0"
+
+LOG_FILE = "aft-provision.log"
+
+
+class Provisioner(object):
+    """
+    Chooses the image for each idle device and writes it, one process per
+    device, holding the lock of the device and a lease on it. A job needing
+    the device for another image pre-empts the write by terminating the
+    process group of the write, which is a session of its own; a job for
+    the same image waits for it, then skips writing.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, cfg_file_name=None, session=None, concurrency=2,
+                 half_life=86400.0, window=7 * 86400.0):
+        self._session = session or AftSession()
+        self._cfg_file_name = cfg_file_name or \
+            DevicesManager.get_default_config_file()
+        self._concurrency = max(1, concurrency)
+        self._half_life = half_life
+        self._window = window
+        self._pids = {}
+    # pylint: enable=too-many-arguments
+
+    def _scores(self, model):
+        """
+        Likelihood of each image still available for the model.
+        """
+        try:
+            store = ResultStore()
+            scores = store.image_scores(model, half_life=self._half_life,
+                                        window=self._window)
+            store.close()
+        except (sqlite3.Error, OSError) as error:
+            logging.warn("No history available for {0}: {1}"
+                         .format(model, error))
+            return {}
+        return dict((image, score) for image, score in scores.items()
+                    if os.path.isfile(image))
+
+    def plan(self, sections=None):
+        """
+        Returns the (topology class, device, image, fingerprint) to write:
+        the idle devices of each model are spread over the likely images,
+        proportionally to their scores. A device keeps its image while
+        that is worth at least as much as the best alternative.
+        """
+        config = self._session.get_config(self._cfg_file_name)
+        if config is None:
+            logging.critical("Cannot read {0}".format(self._cfg_file_name))
+            return []
+        writes = []
+        for section in sections or config.sections():
+            manager = DevicesManager(session=self._session)
+            if not manager.load_platform(section, self._cfg_file_name):
+                continue
+            topology_class = manager.get_topology_class()
+            models = {}
+            for device in topology_class.get_devices():
+                models.setdefault(device.model, []).append(device)
+            for model, devices in models.items():
+                writes.extend(self._plan_model(topology_class, devices,
+                                               self._scores(model)))
+        return writes
+
+    def _plan_model(self, topology_class, devices, scores):
+        """
+        Plans the writes for the devices of one model.
+        """
+        compatible = dict((image,
+                           topology_class.get_compatible_devices(image))
+                          for image in scores)
+        fingerprints = {}
+        current = {}
+        holders = dict.fromkeys(scores, 0)
+        for device in devices:
+            fingerprints[device.dev_id] = dict(
+                (image, ImageFingerprint.compute(image, device))
+                for image in scores if device in compatible[image])
+            deployed = load_fingerprint(device.dev_id)
+            current[device.dev_id] = None
+            for image, fingerprint in fingerprints[device.dev_id].items():
+                if fingerprint.matches(deployed):
+                    holders[image] += 1
+                    current[device.dev_id] = image
+                    break
+        writes = []
+        for device in devices:
+            if topology_class.is_device_busy(device):
+                continue
+            image = current[device.dev_id]
+            choices = sorted(fingerprints[device.dev_id],
+                             key=lambda choice: -scores[choice] /
+                             (holders[choice] + (choice != image)))
+            if not choices or choices[0] == image:
+                continue
+            if image is not None and scores[image] / holders[image] >= \
+                    scores[choices[0]] / (holders[choices[0]] + 1):
+                continue
+            if image is not None:
+                holders[image] -= 1
+            holders[choices[0]] += 1
+            writes.append((topology_class, device, choices[0],
+                           fingerprints[device.dev_id][choices[0]]))
+        return writes
+
+    def _provision(self, topology_class, device, image, fingerprint):
+        """
+        Writes the image in the child process, never returns.
+        """
+        exit_code = 1
+        try:
+            os.setsid()
+            after_fork()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            setup_logging(file_name=LOG_FILE)
+            set_context(device=device.dev_id)
+            lockfile = topology_class.lock_device(device)
+            if lockfile is None:
+                logging.info("{0} got busy, not provisioning it."
+                             .format(device.name))
+            else:
+                try:
+                    save_lease(device.dev_id, fingerprint["image_hash"])
+                    clear_fingerprint(device.dev_id)
+                    logging.info("Pre-provisioning {0} with {1}."
+                                 .format(device.name, image))
+                    if device.deploy_image(image):
+                        save_fingerprint(device.dev_id, fingerprint)
+                        device.detach()
+                        exit_code = 0
+                    else:
+                        logging.warn("Failed to pre-provision {0}."
+                                     .format(device.name))
+                finally:
+                    clear_lease(device.dev_id)
+                    topology_class.unlock_device(device, lockfile)
+        # pylint: disable=broad-except
+        except BaseException:
+            logging.exception("Pre-provisioning of {0} failed."
+                              .format(device.name))
+        # pylint: enable=broad-except
+        finally:
+            logging.shutdown()
+            os._exit(exit_code) # pylint: disable=protected-access
+
+    def _wait(self):
+        """
+        Waits for one write to end, clearing the lease it may have left,
+        e.g. if pre-empted. Returns False if there is none.
+        """
+        if not self._pids:
+            return False
+        pid, status = os.waitpid(-1, 0)
+        device = self._pids.pop(pid, None)
+        if device is None:
+            return True
+        clear_lease(device.dev_id, pid)
+        if os.WIFSIGNALED(status):
+            logging.info("Pre-provisioning of {0} pre-empted."
+                         .format(device.name))
+        elif os.WEXITSTATUS(status) == 0:
+            logging.info("{0} pre-provisioned.".format(device.name))
+        return True
+
+    def run(self, sections=None):
+        """
+        Performs one round of pre-provisioning, returns the number of
+        devices written.
+        """
+        self._session.reload()
+        written = 0
+        try:
+            for write in self.plan(sections):
+                while len(self._pids) >= self._concurrency:
+                    self._wait()
+                pid = os.fork()
+                if pid == 0:
+                    self._provision(*write)
+                self._pids[pid] = write[1]
+                written += 1
+            while self._wait():
+                pass
+        except BaseException:
+            # The writes are sessions of their own: not interrupted with us
+            for pid in self._pids:
+                try:
+                    os.killpg(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            raise
+        return written
+
+
+def main(argv=None):
+    """
+    Command line interface: one round, or a round every interval seconds.
+    """
+    parser = ArgumentParser(description="Pre-provision the idle devices with "
+                                        "the images most likely to be "
+                                        "tested next.")
+    parser.add_argument("--cfg", action="store", default=None,
+                        help="Master configuration file.")
+    parser.add_argument("--platform", action="append", default=[],
+                        help="Platform section of the master configuration "
+                             "(default: all), can be repeated.")
+    parser.add_argument("--concurrency", action="store", type=int, default=2,
+                        help="Maximum number of devices written together.")
+    parser.add_argument("--half-life", action="store", type=float,
+                        default=24.0,
+                        help="Hours after which a run counts half as much.")
+    parser.add_argument("--window", action="store", type=float, default=7.0,
+                        help="Days of history considered.")
+    parser.add_argument("--interval", action="store", type=float, default=0,
+                        help="Seconds between rounds (default: one round).")
+    parser.add_argument("--dry-run", action="store_true", default=False,
+                        help="Print the plan without writing.")
+    args = parser.parse_args(argv)
+    setup_logging(file_name=LOG_FILE)
+    provisioner = Provisioner(cfg_file_name=args.cfg,
+                              concurrency=args.concurrency,
+                              half_life=args.half_life * 3600,
+                              window=args.window * 86400)
+    if args.dry_run:
+        for _, device, image, _ in provisioner.plan(args.platform):
+            print("{0}\t{1}".format(device.name, image))
+        return 0
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            provisioner.run(args.platform)
+            if not args.interval:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
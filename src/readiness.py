@@ -0,0 +1,167 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Probes detecting when a device has completed booting.
+"""
+
+import os
+import re
+import abc
+import time
+import errno
+import socket
+import logging
+
+VERSION = "0.1.0"
+
+
+class Probe(object):
+    """
+    Abstract check telling if a device has reached a certain state.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, name):
+        self.name = name
+
+    @abc.abstractmethod
+    def check(self, timeout):
+        """
+        Returns True if the condition is met. Must not block for longer
+        than timeout.
+        """
+
+    def close(self):
+        """
+        Releases resources held by the probe.
+        """
+
+
+class ExecuteProbe(Probe):
+    """
+    Succeeds when a trivial command runs on the device.
+    """
+    def __init__(self, device, command=("true",), user="root"):
+        super(ExecuteProbe, self).__init__(name="execute")
+        self._device = device
+        self._command = command
+        self._user = user
+
+    def check(self, timeout):
+        """
+        Runs the command, expecting it to succeed.
+        """
+        result = self._device.execute(self._command, max(1, int(timeout)),
+                                      user=self._user)
+        return result is not None and result.returncode == 0
+
+
+class NetworkProbe(Probe):
+    """
+    Succeeds when a TCP port of the device accepts connections.
+    """
+    def __init__(self, host, port=22):
+        super(NetworkProbe, self).__init__(name="network")
+        self._address = (host, int(port))
+
+    def check(self, timeout):
+        """
+        Attempts to connect.
+        """
+        try:
+            socket.create_connection(self._address, timeout).close()
+            return True
+        except (socket.error, socket.timeout):
+            return False
+
+
+class SerialPatternProbe(Probe):
+    """
+    Succeeds when a pattern appears on the serial console of the device,
+    or in a file where its output is logged. Once seen, it stays seen.
+    """
+    _MAX_BUFFER = 64 * 1024
+
+    def __init__(self, file_name, pattern):
+        super(SerialPatternProbe, self).__init__(name="serial")
+        self._file_name = file_name
+        self._pattern = re.compile(pattern, re.MULTILINE)
+        self._buffer = ""
+        self._fd = None
+        self._seen = False
+
+    def check(self, timeout):
+        """
+        Consumes whatever was printed since the previous check.
+        """
+        if self._seen:
+            return True
+        try:
+            if self._fd is None:
+                self._fd = os.open(self._file_name, os.O_RDONLY |
+                                   os.O_NONBLOCK | os.O_NOCTTY)
+            while True:
+                data = os.read(self._fd, 4096)
+                if not data:
+                    break
+                self._buffer = (self._buffer + data)[-self._MAX_BUFFER:]
+        except OSError as error:
+            if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                logging.warn("Cannot read {0}: {1}"
+                             .format(self._file_name, error))
+                return False
+        self._seen = self._pattern.search(self._buffer) is not None
+        return self._seen
+
+    def close(self):
+        """
+        Closes the console.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+# pylint: disable=too-many-arguments
+def wait_for_probes(probes, timeout, initial_delay=0, min_interval=0.5,
+                    max_interval=5.0):
+    """
+    Polls the probes, in order, until all of them succeed or the timeout
+    expires. A probe is not polled again once it has succeeded.
+    The interval between polls grows exponentially, from min_interval to
+    max_interval, but never extends past the deadline.
+    Returns True if all the probes succeeded.
+    """
+    deadline = time.time() + timeout
+    pending = list(probes)
+    interval = min_interval
+    time.sleep(max(0, min(initial_delay, timeout)))
+    try:
+        while True:
+            while pending and \
+                    pending[0].check(max(0, deadline - time.time())):
+                logging.debug("Probe {0} succeeded.".format(pending[0].name))
+                pending.pop(0)
+            if not pending:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logging.warn("Timeout waiting for probe {0}."
+                             .format(pending[0].name))
+                return False
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 1.5, max_interval)
+    finally:
+        for probe in probes:
+            probe.close()
+# pylint: enable=too-many-arguments
@@ -0,0 +1,243 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Persistent sessions for running commands on a device.
+"""
+
+import os
+import abc
+import time
+import logging
+import tempfile
+import threading
+import subprocess
+
+from aft.cmdlinetool import run_command
+
+VERSION = "0.1.0"
+
+
+class RemoteSession(object):
+    """
+    Abstract persistent channel used for running commands on a device,
+    on behalf of a specific user.
+    """
+    __metaclass__ = abc.ABCMeta
+    KEEPALIVE_INTERVAL = 30
+    # True if the session implements stream()
+    supports_streaming = False
+
+    def __init__(self, device, user):
+        self.device = device
+        self.user = user
+        self._last_used = 0
+
+    @abc.abstractmethod
+    def open(self):
+        """
+        Establishes the channel. Returns True on success.
+        """
+
+    @abc.abstractmethod
+    def close(self):
+        """
+        Tears down the channel.
+        """
+
+    @abc.abstractmethod
+    def is_alive(self):
+        """
+        Cheap check telling if the channel is still usable.
+        """
+
+    @abc.abstractmethod
+    def _execute(self, command, timeout, verbose=False):
+        """
+        Runs a command through the channel.
+        Returns a CmdResult, or None if the channel itself broke.
+        """
+
+    def stream(self, command, timeout, stdin=None, stdout=None):
+        """
+        Runs a command feeding it the content of the file object stdin and
+        writing its output directly into the file object stdout, without
+        buffering it in memory.
+        Returns a CmdResult with empty stdoutdata, or None on failure.
+        """
+        return None
+
+    def reconnect(self):
+        """
+        Re-establishes the channel, for example after a reboot of the device.
+        """
+        logging.info("Reconnecting session {0}@{1}."
+                     .format(self.user, self.device.name))
+        self.close()
+        return self.open()
+
+    def keepalive(self):
+        """
+        Probes the channel, if it has been idle for longer than the
+        keepalive interval, and re-establishes it when it went stale.
+        """
+        if time.time() - self._last_used < self.KEEPALIVE_INTERVAL:
+            return True
+        if self.is_alive() or self.reconnect():
+            self._last_used = time.time()
+            return True
+        logging.critical("Cannot open session {0}@{1}."
+                         .format(self.user, self.device.name))
+        return False
+
+    def execute(self, command, timeout, verbose=False):
+        """
+        Runs a command on the device, reconnecting once if the channel
+        turns out to be broken.
+        """
+        if not self.keepalive():
+            return None
+        result = self._execute(command, timeout, verbose)
+        if result is None and self.reconnect():
+            result = self._execute(command, timeout, verbose)
+        if result is not None:
+            self._last_used = time.time()
+        return result
+
+
+class SessionPool(object):
+    """
+    Per-device collection of sessions, one for each user.
+    """
+    def __init__(self, session_class, device, **session_parms):
+        self._session_class = session_class
+        self._device = device
+        self._session_parms = session_parms
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        """
+        Returns the session for the user, creating it when needed.
+        """
+        with self._lock:
+            session = self._sessions.get(user)
+            if session is None:
+                session = self._session_class(device=self._device, user=user,
+                                              **self._session_parms)
+                self._sessions[user] = session
+            return session
+
+    def invalidate(self):
+        """
+        Closes all the sessions: to be used when the device is known to be
+        going down, so that the next command reconnects immediately.
+        """
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+class SshSession(RemoteSession):
+    """
+    Session based on an OpenSSH control master: handshake and
+    authentication are performed only once, then every command is
+    multiplexed over the same connection.
+    """
+    SSH = "ssh"
+    CONTROL_PERSIST = 600
+    supports_streaming = True
+    # ssh reports with this returncode its own failures
+    _SSH_ERROR = 255
+
+# pylint: disable=too-many-arguments
+    def __init__(self, device, user, host, port=22, options=()):
+        super(SshSession, self).__init__(device=device, user=user)
+        self._host = host
+        self._port = str(port)
+        self._options = tuple(options)
+        self._control_path = \
+            os.path.join(tempfile.gettempdir(),
+                         "aft_ssh_{0}_{1}_{2}_{3}".format(os.getpid(), user,
+                                                          host, port))
+# pylint: enable=too-many-arguments
+
+    def _ssh_args(self, *extra):
+        """
+        Command line shared by all the invocations of ssh.
+        """
+        return ((self.SSH, "-o", "ControlPath=" + self._control_path,
+                 "-o", "BatchMode=yes", "-p", self._port) +
+                self._options + extra +
+                ("{0}@{1}".format(self.user, self._host),))
+
+    def _remote_command(self, command):
+        """
+        Command line running command on the device, through the master.
+        """
+        if isinstance(command, str):
+            command = (command,)
+        return self._ssh_args("-o", "ControlMaster=no", "--") + tuple(command)
+
+    def open(self):
+        """
+        Starts the control master in background.
+        """
+        command = self._ssh_args("-f", "-N", "-o", "ControlMaster=yes",
+                                 "-o", "ControlPersist={0}"
+                                 .format(self.CONTROL_PERSIST))
+        # The master stays in background: it must not hold the pipes.
+        with open(os.devnull, "w") as devnull:
+            result = run_command(command, timeout=self.CONTROL_PERSIST,
+                                 stdout=devnull, stderr=devnull)
+        return result is not None and result.returncode == 0
+
+    def close(self):
+        """
+        Stops the control master, if any.
+        """
+        run_command(self._ssh_args("-O", "exit"), timeout=5)
+
+    def is_alive(self):
+        """
+        Asks the control master if it is still connected.
+        """
+        result = run_command(self._ssh_args("-O", "check"), timeout=5)
+        return result is not None and result.returncode == 0
+
+    def _execute(self, command, timeout, verbose=False):
+        """
+        Runs the command through the control master.
+        """
+        result = run_command(self._remote_command(command), timeout=timeout,
+                             verbose=verbose)
+        if result is None or result.returncode == self._SSH_ERROR:
+            return None
+        return result
+
+    def stream(self, command, timeout, stdin=None, stdout=None):
+        """
+        Runs the command through the control master, connecting its
+        standard input and output to the files provided.
+        """
+        if not self.keepalive():
+            return None
+        if stdout is None:
+            stdout = subprocess.PIPE
+        result = run_command(self._remote_command(command), timeout=timeout,
+                             stdin=stdin, stdout=stdout)
+        if result is None or result.returncode == self._SSH_ERROR:
+            return None
+        self._last_used = time.time()
+        return result
+
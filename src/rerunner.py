@@ -0,0 +1,120 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Helper devices for rerunning the failed test cases of a run in parallel
+with the rest of its test plan.
+"""
+
+import threading
+import logging
+
+from aft.concurrency import WorkerPool, Deadline
+from aft.logpipeline import set_context
+from aft.imagefingerprint import load_fingerprint
+
+
+class Rerunner(object):
+    """
+    Executes operations on other devices of the model being tested which
+    already hold the image, each worker locking and booting one of them
+    the first time it needs it and keeping it until close. Booting is
+    bounded by deadline, the one of the test plan.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, topology_class, devices, fingerprint, workers=1,
+                 deadline=None):
+        self._topology_class = topology_class
+        self._devices = list(devices)
+        self._fingerprint = fingerprint
+        self._deadline = deadline or Deadline()
+        self._pool = WorkerPool(max(1, workers))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._held = []
+    # pylint: enable=too-many-arguments
+
+    def _acquire(self):
+        """
+        Locks and boots a free device holding the image, returns None if
+        there is none.
+        """
+        for device in self._devices:
+            if self._deadline.expired():
+                logging.info("No time left for booting a device for the "
+                             "reruns.")
+                return None
+            if not self._fingerprint.matches(load_fingerprint(device.dev_id)):
+                continue
+            try:
+                lockfile = self._topology_class.lock_device(device)
+            except IOError as error:
+                logging.warn("Cannot lock {0}: {1}"
+                             .format(device.dev_id, error))
+                continue
+            if lockfile is None:
+                continue
+            with self._lock:
+                self._held.append((device, lockfile))
+            set_context(device=device.dev_id)
+            logging.info("Booting {0} for the reruns.".format(device.name))
+            if device.boot_deployed_image() and \
+                    device.verify_image(self._fingerprint) and \
+                    device.wait_until_ready(
+                        timeout=self._deadline.bound(device.BOOT_TIMEOUT)):
+                return device
+            logging.warn("{0} is not usable for the reruns."
+                         .format(device.name))
+            self._release(device, lockfile)
+        return None
+
+    def _release(self, device, lockfile):
+        """
+        Powers off a helper device and unlocks it, once the commands still
+        running for it are killed.
+        """
+        with self._lock:
+            self._held.remove((device, lockfile))
+        device.cancel()
+        device.detach()
+        self._topology_class.unlock_device(device, lockfile)
+
+    def _run(self, function, args):
+        """
+        Calls function with the device of the worker, acquiring one if
+        needed. Returns None without calling it if there is no device.
+        """
+        device = getattr(self._local, "device", None)
+        if device is None:
+            device = self._acquire()
+            if device is None:
+                logging.info("No other device holds the image.")
+                return None
+            self._local.device = device
+        set_context(device=device.dev_id)
+        return function(device, *args)
+
+    def submit(self, function, *args):
+        """
+        Queues function(device, *args) for execution on a helper device,
+        returns its Future. The result is None if no device was available.
+        """
+        return self._pool.submit(self._run, function, args)
+
+    def close(self):
+        """
+        Waits for the operations queued, then releases the devices.
+        """
+        self._pool.shutdown()
+        for device, lockfile in list(self._held):
+            self._release(device, lockfile)
+        return True
@@ -0,0 +1,310 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Local database with the history of the test runs.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import logging
+from argparse import ArgumentParser
+from xml.etree import ElementTree
+
+VERSION = "0.1.0"
+
+_DB_FILE = os.getenv("AFT_RESULTS_DB",
+                     os.path.join(os.getenv("AFT_STATEROOT", "/var/lib/aft/"),
+                                  "results.db"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE,
+    start_time REAL,
+    end_time REAL,
+    image TEXT,
+    image_hash TEXT,
+    device TEXT,
+    model TEXT,
+    results_dir TEXT);
+CREATE TABLE IF NOT EXISTS cases (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER REFERENCES runs(id),
+    name TEXT,
+    tester TEXT,
+    test TEXT,
+    parameters TEXT,
+    duration REAL,
+    passed INTEGER,
+    output_dir TEXT);
+CREATE TABLE IF NOT EXISTS case_cache (
+    key TEXT PRIMARY KEY,
+    name TEXT,
+    result INTEGER,
+    duration REAL,
+    test_dir TEXT,
+    xunit_section TEXT,
+    created REAL);
+CREATE INDEX IF NOT EXISTS runs_model ON runs(model);
+CREATE INDEX IF NOT EXISTS runs_image_hash ON runs(image_hash);
+CREATE INDEX IF NOT EXISTS cases_run ON cases(run_id);
+CREATE INDEX IF NOT EXISTS cases_name ON cases(name);
+"""
+
+
+def parse_duration(duration):
+    """
+    Converts into seconds a duration as written in results.xml:
+    either a number of seconds or H:MM:SS.ffffff .
+    """
+    seconds = 0.0
+    try:
+        for field in str(duration).split(":"):
+            seconds = seconds * 60 + float(field)
+    except ValueError:
+        return None
+    return seconds
+
+
+class ResultStore(object):
+    """
+    Indexed history of runs and test cases, stored in SQLite.
+    """
+    def __init__(self, db_file=_DB_FILE):
+        dir_name = os.path.dirname(os.path.abspath(db_file))
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        self._connection = sqlite3.connect(db_file, timeout=30)
+        self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        self._connection.close()
+
+    def has_run(self, name):
+        """
+        True if a run with this name has already been stored.
+        """
+        return self._connection.execute(
+            "SELECT 1 FROM runs WHERE name = ?", (name,)).fetchone() \
+            is not None
+
+# pylint: disable=too-many-arguments
+    def add_run(self, name, start_time, end_time, test_cases, image=None,
+                image_hash=None, device=None, model=None, results_dir=None):
+        """
+        Stores a run together with its test cases, which are dictionaries
+        with the same keys as TestCase, plus "tester" and "duration" in
+        seconds.
+        """
+        with self._connection:
+            run_id = self._connection.execute(
+                "INSERT INTO runs (name, start_time, end_time, image, "
+                "image_hash, device, model, results_dir) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, start_time, end_time, image, image_hash, device,
+                 model, results_dir)).lastrowid
+            self._connection.executemany(
+                "INSERT INTO cases (run_id, name, tester, test, parameters, "
+                "duration, passed, output_dir) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, case["name"], case.get("tester"), case.get("test"),
+                  case.get("parameters"), case["duration"],
+                  1 if case["result"] else 0, case.get("test_dir"))
+                 for case in test_cases])
+        return run_id
+# pylint: enable=too-many-arguments
+
+    def import_xunit(self, results_file, image=None, image_hash=None,
+                     device=None, model=None):
+        """
+        Imports a results.xml file written by aft.
+        Returns False if it was already imported or can't be parsed.
+        """
+        try:
+            suite = ElementTree.parse(results_file).getroot()
+        except (IOError, ElementTree.ParseError) as error:
+            logging.warn("Cannot import {0}: {1}".format(results_file, error))
+            return False
+        name = suite.get("name", os.path.abspath(results_file))
+        if self.has_run(name):
+            return False
+        results_dir = os.path.dirname(os.path.abspath(results_file))
+        start_time = os.path.getmtime(results_file) - \
+            (parse_duration(suite.get("time", 0)) or 0)
+        test_cases = [{"name": case.get("name"),
+                       "result": case.get("passed") == "1",
+                       "duration": parse_duration(case.get("duration"))}
+                      for case in suite.iter("testcase")]
+        self.add_run(name=name, start_time=start_time,
+                     end_time=os.path.getmtime(results_file),
+                     test_cases=test_cases, image=image,
+                     image_hash=image_hash, device=device, model=model,
+                     results_dir=results_dir)
+        return True
+
+    def get_cached_case(self, key):
+        """
+        Returns the cached outcome of a test case, in the same format
+        used by the journal, or None.
+        """
+        row = self._connection.execute(
+            "SELECT name, result, duration, test_dir, xunit_section "
+            "FROM case_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return {"name": row[0], "result": bool(row[1]), "duration": row[2],
+                "test_dir": row[3], "xunit_section": row[4]}
+
+    def cache_case(self, key, test_case):
+        """
+        Stores the outcome of a test case, for reuse by identical runs.
+        """
+        duration = test_case["duration"]
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO case_cache (key, name, result, "
+                "duration, test_dir, xunit_section, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, test_case["name"], 1 if test_case["result"] else 0,
+                 duration.total_seconds() if duration is not None else None,
+                 test_case["test_dir"], test_case.get_xunit_section(),
+                 time.time()))
+
+    def case_statistics(self, model=None, name=None):
+        """
+        Returns, for each test case, a dictionary with the number of runs,
+        failures and the average duration, optionally restricted to a
+        device model and to a test case name.
+        """
+        query = ["SELECT cases.name, COUNT(*), SUM(1 - cases.passed), "
+                 "AVG(cases.duration) FROM cases "
+                 "JOIN runs ON runs.id = cases.run_id WHERE 1"]
+        parms = []
+        if model is not None:
+            query.append("AND runs.model = ?")
+            parms.append(model)
+        if name is not None:
+            query.append("AND cases.name = ?")
+            parms.append(name)
+        query.append("GROUP BY cases.name")
+        return dict((row[0], {"runs": row[1], "failures": row[2],
+                              "duration": row[3]})
+                    for row in self._connection.execute(" ".join(query),
+                                                        parms))
+
+    def case_durations(self, model=None):
+        """
+        Returns the measured durations of the test cases, as a dictionary
+        from device model to a dictionary from test case name to the list
+        of its durations, optionally restricted to a device model.
+        """
+        query = ["SELECT runs.model, cases.name, cases.duration FROM cases "
+                 "JOIN runs ON runs.id = cases.run_id "
+                 "WHERE cases.duration IS NOT NULL"]
+        parms = []
+        if model is not None:
+            query.append("AND runs.model = ?")
+            parms.append(model)
+        durations = {}
+        for row in self._connection.execute(" ".join(query), parms):
+            durations.setdefault(row[0], {}).setdefault(row[1], []) \
+                .append(row[2])
+        return durations
+
+    def image_scores(self, model, half_life=86400.0, window=7 * 86400.0):
+        """
+        Returns how likely each image is to be tested next on a device
+        model: the runs of the last window seconds, each weighing half as
+        much every half_life seconds, as a dictionary from image to score.
+        """
+        now = time.time()
+        scores = {}
+        for image, start_time in self._connection.execute(
+                "SELECT image, start_time FROM runs WHERE model = ? AND "
+                "image IS NOT NULL AND start_time > ?",
+                (model, now - window)):
+            scores[image] = scores.get(image, 0.0) + \
+                0.5 ** (max(0.0, now - start_time) / half_life)
+        return scores
+
+    def runs(self, model=None, limit=20):
+        """
+        Returns the most recent runs, optionally for a device model.
+        """
+        query = ["SELECT runs.name, runs.start_time, runs.model, runs.device,"
+                 " runs.image, COUNT(cases.id), SUM(1 - cases.passed) "
+                 "FROM runs LEFT JOIN cases ON runs.id = cases.run_id "
+                 "WHERE 1"]
+        parms = []
+        if model is not None:
+            query.append("AND runs.model = ?")
+            parms.append(model)
+        query.append("GROUP BY runs.id ORDER BY runs.start_time DESC "
+                     "LIMIT ?")
+        parms.append(limit)
+        return self._connection.execute(" ".join(query), parms).fetchall()
+
+
+def main(argv=None):
+    """
+    Command line interface for importing and querying the results.
+    """
+    parser = ArgumentParser(description="Query the history of aft runs.")
+    parser.add_argument("--db", action="store", default=_DB_FILE,
+                        help="Results database.")
+    commands = parser.add_subparsers(dest="command")
+    importer = commands.add_parser("import",
+                                   help="Import existing results.xml files.")
+    importer.add_argument("--model", action="store", default=None)
+    importer.add_argument("--device", action="store", default=None)
+    importer.add_argument("--image", action="store", default=None)
+    importer.add_argument("results_files", nargs="+")
+    cases = commands.add_parser("cases",
+                                help="Statistics of the test cases.")
+    cases.add_argument("--model", action="store", default=None)
+    cases.add_argument("--case", action="store", default=None)
+    runs = commands.add_parser("runs", help="Most recent runs.")
+    runs.add_argument("--model", action="store", default=None)
+    runs.add_argument("--limit", action="store", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    store = ResultStore(args.db)
+    if args.command == "import":
+        imported = 0
+        for results_file in args.results_files:
+            if store.import_xunit(results_file, image=args.image,
+                                  device=args.device, model=args.model):
+                imported += 1
+        print("Imported {0} of {1} files."
+              .format(imported, len(args.results_files)))
+    elif args.command == "cases":
+        statistics = store.case_statistics(model=args.model, name=args.case)
+        for name in sorted(statistics):
+            print("{0}\truns={1}\tfailures={2}\taverage={3:.3f}s"
+                  .format(name, statistics[name]["runs"],
+                          statistics[name]["failures"],
+                          statistics[name]["duration"] or 0))
+    elif args.command == "runs":
+        for run in store.runs(model=args.model, limit=args.limit):
+            print("\t".join(str(field) for field in run))
+    store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,270 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Server keeping aft warm: plugins imported and configurations parsed once,
+then one forked worker per job, so a job doesn't pay for the start up.
+"""
+
+import os
+import sys
+import json
+import errno
+import socket
+import signal
+import logging
+from argparse import ArgumentParser
+
+from aft.classloader import ClassLoader
+from aft.aftsession import AftSession
+from aft.logpipeline import LOG_FORMAT, setup_logging, after_fork
+
+VERSION = "0.1.0"
+
+_SOCKET = os.getenv("AFT_SERVER_SOCKET", "/var/run/aft/server.sock")
+
+
+class _Channel(object):
+    """
+    Json lines connection between the worker and the client.
+    """
+    def __init__(self, connection):
+        self._file = connection.makefile("w", 0)
+
+    def send(self, **message):
+        """
+        Sends one message, ignoring a client that went away.
+        """
+        try:
+            self._file.write(json.dumps(message) + "\n")
+        except (IOError, socket.error):
+            pass
+
+    def write(self, text):
+        """
+        File-like interface, for redirecting the output of the job.
+        """
+        self.send(output=text)
+
+    def flush(self):
+        """
+        Nothing to do: every write is sent immediately.
+        """
+
+
+class _ChannelHandler(logging.Handler):
+    """
+    Forwards the log of the job to the client.
+    """
+    def __init__(self, channel):
+        super(_ChannelHandler, self).__init__()
+        self._channel = channel
+
+    def emit(self, record):
+        self._channel.send(log=self.format(record), level=record.levelno)
+
+
+class AftServer(object):
+    """
+    Pre-forking server: the parent is warmed up once, each job runs in a
+    child forked from it, which inherits the imported modules and the
+    parsed configurations for free. The parent reloads the configuration
+    files that change, for the jobs started afterwards.
+    """
+    def __init__(self, socket_name=_SOCKET, max_jobs=8):
+        self._socket_name = socket_name
+        self._max_jobs = max_jobs
+        self._session = AftSession()
+        self._workers = set()
+        self._listener = None
+        self._cfg_file_names = (None,)
+
+    def warm_up(self, cfg_file_names=()):
+        """
+        Imports the aft modules and every plugin, and parses the
+        configurations, so that the workers don't have to.
+        """
+        # pylint: disable=unused-variable
+        import aft.tester
+        import aft.devicesmanager
+        # pylint: enable=unused-variable
+        plugins = ClassLoader.preload_plugins()
+        self._cfg_file_names = cfg_file_names or (None,)
+        for cfg_file_name in self._cfg_file_names:
+            self._session.preload(cfg_file_name)
+        logging.info("Server warmed up, {0} plugins loaded.".format(plugins))
+
+    def _listen(self):
+        """
+        Creates the Unix socket, replacing a stale one.
+        """
+        dir_name = os.path.dirname(self._socket_name)
+        if dir_name and not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        try:
+            os.unlink(self._socket_name)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self._socket_name)
+        os.chmod(self._socket_name, 0660)
+        self._listener.listen(16)
+        self._listener.settimeout(1.0)
+
+    def _reap(self, block=False):
+        """
+        Collects the workers that have terminated.
+        """
+        while self._workers:
+            try:
+                pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                self._workers.clear()
+                return
+            if pid == 0:
+                return
+            self._workers.discard(pid)
+            block = False
+
+    def serve_forever(self):
+        """
+        Accepts jobs until interrupted.
+        """
+        self._listen()
+        logging.info("Serving on {0}".format(self._socket_name))
+        try:
+            while True:
+                self._reap(block=len(self._workers) >= self._max_jobs)
+                if self._session.reload():
+                    for cfg_file_name in self._cfg_file_names:
+                        self._session.preload(cfg_file_name)
+                try:
+                    connection, _ = self._listener.accept()
+                except socket.timeout:
+                    continue
+                except socket.error as error:
+                    if error.errno == errno.EINTR:
+                        continue
+                    raise
+                pid = os.fork()
+                if pid == 0:
+                    self._worker(connection)
+                connection.close()
+                self._workers.add(pid)
+        finally:
+            self._listener.close()
+            os.unlink(self._socket_name)
+
+    def _worker(self, connection):
+        """
+        Runs one job in the forked child, never returns.
+        """
+        exit_code = 1
+        try:
+            after_fork()
+            self._listener.close()
+            self._session.after_fork()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            connection.settimeout(None)
+            channel = _Channel(connection)
+            try:
+                request = json.loads(connection.makefile("r").readline())
+                os.chdir(request.get("cwd", "/"))
+                argv = request["argv"]
+            except (ValueError, KeyError, TypeError, OSError) as error:
+                channel.send(log="Invalid request: {0}".format(error),
+                             level=logging.ERROR)
+                channel.send(exit=exit_code)
+                return
+            setup_logging()
+            handler = _ChannelHandler(channel)
+            handler.setLevel(request.get("level", logging.INFO))
+            handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            logging.root.addHandler(handler)
+            sys.stdout = sys.stderr = channel
+            try:
+                exit_code = self._session.run(argv)
+            except SystemExit as error:
+                exit_code = error.code if isinstance(error.code, int) else 1
+            # pylint: disable=broad-except
+            except BaseException:
+                logging.exception("Job {0} failed.".format(argv))
+            # pylint: enable=broad-except
+            channel.send(exit=exit_code)
+        finally:
+            logging.shutdown()
+            os._exit(0) # pylint: disable=protected-access
+
+
+def server_main(argv=None):
+    """
+    Entry point of the server.
+    """
+    parser = ArgumentParser(description="Keep aft warm and run jobs "
+                                        "submitted with aft-client.")
+    parser.add_argument("--socket", action="store", default=_SOCKET,
+                        help="Unix socket to listen on.")
+    parser.add_argument("--max-jobs", action="store", type=int, default=8,
+                        help="Maximum number of jobs running concurrently.")
+    parser.add_argument("--cfg", action="append", default=[],
+                        help="Platform configuration to pre-parse, "
+                             "can be repeated.")
+    args = parser.parse_args(argv)
+    setup_logging(file_name="aft-server.log")
+    server = AftServer(socket_name=args.socket, max_jobs=args.max_jobs)
+    server.warm_up(args.cfg)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def client_main(argv=None):
+    """
+    Entry point of the client: accepts the same arguments as aft, runs
+    them in the server and returns the same exit code.
+    """
+    if argv is None:
+        argv = sys.argv
+    socket_name = os.getenv("AFT_SERVER_SOCKET", _SOCKET)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_name)
+    except socket.error as error:
+        sys.stderr.write("Cannot connect to aft-server on {0}: {1}\n"
+                         .format(socket_name, error))
+        return 1
+    connection.sendall(json.dumps({"argv": argv[1:],
+                                   "cwd": os.getcwd()}) + "\n")
+    exit_code = 1
+    for line in connection.makefile("r"):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if "log" in message:
+            sys.stderr.write(message["log"] + "\n")
+        elif "output" in message:
+            sys.stdout.write(message["output"])
+        elif "exit" in message:
+            exit_code = message["exit"]
+    connection.close()
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(server_main())
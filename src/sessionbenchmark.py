@@ -0,0 +1,161 @@
+# Copyright (c) 2015 Intel, Inc.
+# Author igor.stoppa@intel.com
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Benchmark of the persistent ssh sessions: the same commands are run once
+with a new ssh connection each, and once over a control master.
+Runs against a real sshd, e.g. on localhost, or against a stand-in for the
+ssh client which simulates the cost of the handshake:
+
+    python -m aft.sessionbenchmark --host localhost
+    python -m aft.sessionbenchmark --stand-in --handshake 0.2
+"""
+
+import os
+import sys
+import stat
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+from aft.cmdlinetool import run_command
+from aft.remotesession import SshSession
+
+# Mimics the options of ssh used by SshSession: a connection costs the
+# handshake, unless it goes through a running control master.
+_STAND_IN = """#!{python}
+import os, sys, time, subprocess
+args = sys.argv[1:]
+options = dict(args[i + 1].split("=", 1) for i in range(len(args) - 1)
+               if args[i] == "-o" and "=" in args[i + 1])
+control = options.get("ControlPath")
+if "-O" in args:
+    operation = args[args.index("-O") + 1]
+    if control is None or not os.path.exists(control):
+        sys.exit(255)
+    if operation == "exit":
+        os.unlink(control)
+    sys.exit(0)
+if options.get("ControlMaster") == "yes":
+    time.sleep({handshake})
+    open(control, "w").close()
+    sys.exit(0)
+if options.get("ControlMaster") != "no" or not os.path.exists(control):
+    time.sleep({handshake})
+command = args[args.index("--") + 2:]
+sys.exit(subprocess.call(" ".join(command), shell=True))
+"""
+
+
+class _BenchmarkDevice(object):
+    """
+    The little of a device the sessions need.
+    """
+    def __init__(self, name):
+        self.name = name
+
+
+def _write_stand_in(directory, handshake):
+    """
+    Writes the stand-in for ssh, returns its path.
+    """
+    file_name = os.path.join(directory, "ssh")
+    with open(file_name, "w") as script:
+        script.write(_STAND_IN.format(python=sys.executable,
+                                      handshake=handshake))
+    os.chmod(file_name, stat.S_IRWXU)
+    return file_name
+
+
+# pylint: disable=too-many-arguments
+def run_benchmark(host, user, port=22, command="true", count=20,
+                  ssh=SshSession.SSH, timeout=30):
+    """
+    Runs command count times with a connection each, then over a session.
+    Returns the seconds taken by each way, None if a command failed.
+    """
+    one_shot = (ssh, "-o", "BatchMode=yes", "-p", str(port), "--",
+                "{0}@{1}".format(user, host), command)
+    start = time.time()
+    for _ in range(count):
+        result = run_command(one_shot, timeout=timeout)
+        if result is None or result.returncode != 0:
+            return None
+    per_command = time.time() - start
+
+    session_class = type("BenchmarkSession", (SshSession,), {"SSH": ssh})
+    session = session_class(device=_BenchmarkDevice(host), user=user,
+                            host=host, port=port)
+    start = time.time()
+    try:
+        if not session.open():
+            return None
+        for _ in range(count):
+            result = session.execute(command, timeout)
+            if result is None or result.returncode != 0:
+                return None
+    finally:
+        session.close()
+    return per_command, time.time() - start
+# pylint: enable=too-many-arguments
+
+
+def main(argv=None):
+    """
+    Command line interface.
+    """
+    parser = ArgumentParser(description="Compare running commands with a "
+                                        "new ssh connection each and over a "
+                                        "persistent session.")
+    parser.add_argument("--host", action="store", default="localhost",
+                        help="Host running sshd.")
+    parser.add_argument("--user", action="store",
+                        default=os.getenv("USER", "root"),
+                        help="User to log in as.")
+    parser.add_argument("--port", action="store", type=int, default=22,
+                        help="Port of sshd.")
+    parser.add_argument("--command", action="store", default="true",
+                        help="Command to run.")
+    parser.add_argument("--count", action="store", type=int, default=20,
+                        help="Number of times the command is run.")
+    parser.add_argument("--stand-in", action="store_true", default=False,
+                        help="Use a stand-in for ssh instead of sshd.")
+    parser.add_argument("--handshake", action="store", type=float,
+                        default=0.2,
+                        help="Seconds taken by the handshake of the "
+                             "stand-in.")
+    args = parser.parse_args(argv)
+    directory = tempfile.mkdtemp(prefix="aft_benchmark_")
+    try:
+        ssh = _write_stand_in(directory, args.handshake) \
+            if args.stand_in else SshSession.SSH
+        times = run_benchmark(host=args.host, user=args.user,
+                              port=args.port, command=args.command,
+                              count=max(1, args.count), ssh=ssh)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    if times is None:
+        print("Running the command failed.")
+        return 1
+    per_command, session = times
+    print("{0} commands, {1}".format(args.count, args.command))
+    print("one connection each:\t{0:.3f}s\t{1:.1f}ms per command"
+          .format(per_command, per_command * 1000 / args.count))
+    print("persistent session:\t{0:.3f}s\t{1:.1f}ms per command"
+          .format(session, session * 1000 / args.count))
+    print("speedup:\t\t{0:.1f}x".format(per_command / max(session, 1e-6)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,8 +18,14 @@ Class representing a Test Case.
 
 import os
 import re
+import sys
+import inspect
+import hashlib
 import datetime
 import logging
+import collections
+
+from aft.concurrency import run_async
 
 VERSION = "0.1.0"
 
@@ -28,16 +34,32 @@ VERSION = "0.1.0"
 # This class is meant to perform one single task
 # and therefore requires only one public method
 # pylint: disable=too-few-public-methods
-class TestCase(dict):
+class TestCase(object):
     """
     Class providing the foundations for a Test Case.
+    The fields are stored in slots, to keep compact test plans with many
+    thousands of cases, but they are accessed like the items of a
+    dictionary. Keys added by subclasses are kept in a separate
+    dictionary; subclasses can declare __slots__ = () to stay compact.
+    Test cases are registered as collections.MutableMapping, without
+    deriving from it, which would add a __dict__ to each of them; unlike
+    dictionaries, they compare by identity.
     """
+    _MISSING = object()
 
     _TEST_EXEC_ROOT = os.getenv("AFT_EXECROOT", "./aft_results.")
 
+    _FIELDS = ("name", "test", "parameters", "pass_regex", "user", "result",
+               "env", "duration", "output", "xunit_section", "xunit_file",
+               "test_dir", "device", "start_time", "end_time", "skipped",
+               "cacheable", "cached", "timeout", "aborted",
+               "results_dir")
+    _FIELD_SET = frozenset(_FIELDS)
+    __slots__ = tuple("_" + field for field in _FIELDS) + ("_extra",)
+
 # pylint: disable=too-many-arguments
     def __init__(self, name, test, parameters, pass_regex, user):
-        super(TestCase, self).__init__()
+        self._extra = None
         self["name"] = name
         self["test"] = test
         self["parameters"] = parameters
@@ -48,12 +70,172 @@ class TestCase(dict):
         self["duration"] = None
         self["output"] = None
         self["xunit_section"] = ""
+        self["xunit_file"] = None
         self["test_dir"] = None
         self["device"] = None
         self["start_time"] = 0
         self["end_time"] = 0
+        self["skipped"] = False
+        self["cacheable"] = False
+        self["cached"] = False
+        self["timeout"] = None
+        self["aborted"] = False
+        self["results_dir"] = None
 # pylint: enable=too-many-arguments
 
+    def __getitem__(self, key):
+        if key in self._FIELD_SET:
+            try:
+                return getattr(self, "_" + key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._FIELD_SET:
+            setattr(self, "_" + key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._FIELD_SET:
+            try:
+                delattr(self, "_" + key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in self._FIELD_SET:
+            return hasattr(self, "_" + key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        self._extra = None
+        for key, value in state.items():
+            self[key] = value
+
+    def get(self, key, default=None):
+        """
+        Same as dict.get .
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """
+        Same as dict.keys .
+        """
+        return [field for field in self._FIELDS
+                if hasattr(self, "_" + field)] + list(self._extra or ())
+
+    def values(self):
+        """
+        Same as dict.values .
+        """
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        """
+        Same as dict.items .
+        """
+        return [(key, self[key]) for key in self.keys()]
+
+    def iterkeys(self):
+        """
+        Same as dict.iterkeys .
+        """
+        return iter(self.keys())
+
+    def itervalues(self):
+        """
+        Same as dict.itervalues .
+        """
+        return iter(self.values())
+
+    def iteritems(self):
+        """
+        Same as dict.iteritems .
+        """
+        return iter(self.items())
+
+    def has_key(self, key):
+        """
+        Same as dict.has_key .
+        """
+        return key in self
+
+    def pop(self, key, default=_MISSING):
+        """
+        Same as dict.pop .
+        """
+        try:
+            value = self[key]
+        except KeyError:
+            if default is self._MISSING:
+                raise
+            return default
+        del self[key]
+        return value
+
+    def popitem(self):
+        """
+        Same as dict.popitem .
+        """
+        keys = self.keys()
+        if not keys:
+            raise KeyError("popitem(): test case is empty")
+        return keys[-1], self.pop(keys[-1])
+
+    def setdefault(self, key, default=None):
+        """
+        Same as dict.setdefault .
+        """
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        """
+        Same as dict.update .
+        """
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        """
+        Same as dict.clear .
+        """
+        for key in self.keys():
+            del self[key]
+
+    def get_results_dir(self):
+        """
+        Directory holding the results of the whole test plan, set by the
+        tester running it.
+        """
+        if self["results_dir"] is None:
+            return self._TEST_EXEC_ROOT + str(os.getpid())
+        return self["results_dir"]
+
     @staticmethod
     def _is_test_case(entry):
         """
@@ -76,7 +258,7 @@ class TestCase(dict):
         Prepare a directory for the test case and return its name.
         """
         date = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
-        test_dir = os.path.join(self._TEST_EXEC_ROOT + str(os.getpid()),
+        test_dir = os.path.join(self.get_results_dir(),
                                 "%s-%s" % (date, self["name"]))
         os.makedirs(test_dir)
         os.makedirs(os.path.join(test_dir, "aft"))
@@ -109,19 +291,41 @@ class TestCase(dict):
         self["xunit_section"] = "".join(xml)
         return True
 
+    def _run_on_device(self, command, timeout, verbose=False):
+        """
+        Runs a command on the device as the user of the test case,
+        reusing the persistent session of the user when the device
+        supports sessions.
+        """
+        device = self["device"]
+        if device.get_session(self["user"]) is not None:
+            return device.execute_in_session(command, timeout,
+                                             user=self["user"],
+                                             verbose=verbose)
+        return device.execute(command, timeout, user=self["user"],
+                              verbose=verbose)
+
+    def _run_and_check(self, command, timeout):
+        """
+        Runs a command on the device, storing its output as the output of
+        the test case, and checks it for success.
+        """
+        self["output"] = self._run_on_device(command, timeout)
+        return self._check_for_success()
+
     def _check_for_success(self):
         """
         Checks if any of the output lines matches
         the regex that identifies a succesfull run.
         """
         self["result"] = False
-        logging.info("self['output'] {0}".format(self["output"]))
+        logging.debug("Output: %s", self["output"])
         if self["output"] is None or self["output"].returncode is not 0:
-            logging.info("Test Failed: returncode {0}"
-                         .format(self["output"].returncode))
+            logging.info("Test Failed: returncode %s",
+                         getattr(self["output"], "returncode", None))
             if self["output"] is not None:
-              logging.info("stdout:\n{0}".format(self["output"].stdoutdata))
-              logging.info("stderr:\n{0}".format(self["output"].stderrdata))
+                logging.debug("stdout:\n%s", self["output"].stdoutdata)
+                logging.debug("stderr:\n%s", self["output"].stderrdata)
         elif self["pass_regex"] is "":
             logging.info("Test passed: returncode 0, no pass_regex")
             self["result"] = True
@@ -129,16 +333,162 @@ class TestCase(dict):
             for line in self["output"].stdoutdata.splitlines():
                 if re.match(self["pass_regex"], line) is not None:
                     logging.info("Test passed: returncode 0 "
-                                 "Matching pass_regex {0}"
-                                 .format(self["pass_regex"]))
+                                 "Matching pass_regex %s", self["pass_regex"])
                     self["result"] = True
                     break
             else:
-                 logging.info("Test failed: returncode 0\n"
-                              "But could not find matching pass_regex {0}"
-                              .format(self["pass_regex"]))
+                logging.info("Test failed: returncode 0\n"
+                             "But could not find matching pass_regex %s",
+                             self["pass_regex"])
         return self["result"]
 
+    def _source_digest(self):
+        """
+        Digest of the source of the module implementing the test case.
+        """
+        try:
+            file_name = inspect.getsourcefile(type(self)) or \
+                inspect.getfile(type(self))
+            with open(file_name, "rb") as source:
+                return hashlib.sha256(source.read()).hexdigest()
+        except (TypeError, IOError):
+            return sys.modules[type(self).__module__].__name__
+
+    def cache_key(self, image_hash, model):
+        """
+        Key identifying the outcome of the test case: same image, same
+        device model, same test and parameters, same test code.
+        """
+        tester = type(self)
+        return hashlib.sha256(repr((image_hash, model,
+                                    ".".join((tester.__module__,
+                                              tester.__name__)),
+                                    self["test"], self["parameters"],
+                                    self["pass_regex"], self["user"],
+                                    self._source_digest()))).hexdigest()
+
+    def restore_cached(self, record):
+        """
+        Reports the outcome of a previous identical execution, flagged as
+        such in the xunit section.
+        """
+        self.restore(record)
+        self["cached"] = True
+        self["xunit_section"] = self["xunit_section"].replace(
+            "<testcase ", '<testcase cached="1" ', 1)
+        return True
+
+    def record_reruns(self, reruns):
+        """
+        Classifies the failed test case with the copies of it rerun after
+        the failure, in the format of surefire: if any passed, the case is
+        flaky and counts as passed, its failures reported as flakyFailure;
+        otherwise it failed consistently and the failures of the reruns
+        are reported as rerunFailure.
+        """
+        flaky = any(rerun["result"] for rerun in reruns)
+        failures = [rerun for rerun in reruns if not rerun["result"]]
+        section = self.get_xunit_section()
+        if flaky:
+            self["result"] = True
+            self["flakiness"] = "passed_on_retry"
+            section = section.replace('passed="0"', 'passed="1"', 1)
+            section = section.replace("<failure ", "<flakyFailure ")
+            section = section.replace("</failure>", "</flakyFailure>")
+            element = "flakyFailure"
+        else:
+            self["flakiness"] = "failed_consistently"
+            element = "rerunFailure"
+        section = section.replace(
+            "<testcase ", '<testcase flakiness="{0}" reruns="{1}" '
+            .format(self["flakiness"], len(reruns)), 1)
+        section = section[:section.rindex("</testcase>")] + "".join(
+            '<{0} message="test failure">\n{1}\n</{0}>\n'
+            .format(element, rerun["output"]) for rerun in failures) + \
+            "</testcase>\n"
+        if self["xunit_section"] is None and self["xunit_file"]:
+            with open(self["xunit_file"], "w") as xunit_file:
+                xunit_file.write(section)
+        else:
+            self["xunit_section"] = section
+        return flaky
+
+    def release_output(self, spill=False):
+        """
+        Drops the output of a test case whose result has already been
+        persisted. With spill, the xunit section is moved to a file in the
+        directory of the test case too, and read back only when needed.
+        """
+        self["output"] = None
+        if spill and not self["cached"] and self["test_dir"] and \
+                self["xunit_section"]:
+            xunit_file = os.path.join(self["test_dir"], "aft",
+                                      "xunit_section.xml")
+            with open(xunit_file, "w") as section:
+                section.write(self["xunit_section"])
+            self["xunit_file"] = xunit_file
+            self["xunit_section"] = None
+        return True
+
+    def get_xunit_section(self):
+        """
+        Returns the xunit section, reading it back if it was spilled.
+        """
+        if self["xunit_section"] is None and self["xunit_file"]:
+            with open(self["xunit_file"]) as section:
+                return section.read()
+        return self["xunit_section"] or ""
+
+    def skip(self, reason):
+        """
+        Marks the test case as not executed.
+        """
+        self["skipped"] = True
+        self["xunit_section"] = ('<testcase name="{0}" passed="0" '
+                                 'duration="0">\n'
+                                 '<skipped message="{1}"/>\n'
+                                 '</testcase>\n'.format(self["name"], reason))
+        return True
+
+    def abort(self, reason):
+        """
+        Marks the test case as not completed, because of an error outside
+        of the test, e.g. its deadline expiring.
+        """
+        self["result"] = False
+        self["aborted"] = True
+        self["xunit_section"] = ('<testcase name="{0}" passed="0" '
+                                 'duration="0">\n'
+                                 '<error message="{1}"/>\n'
+                                 '</testcase>\n'.format(self["name"], reason))
+        return True
+
+    def copy(self):
+        """
+        New instance of the same test case, not executed yet.
+        """
+        test_case = type(self)(name=self["name"], test=self["test"],
+                               parameters=self["parameters"],
+                               pass_regex=self["pass_regex"],
+                               user=self["user"])
+        test_case["cacheable"] = self["cacheable"]
+        test_case["timeout"] = self["timeout"]
+        test_case["results_dir"] = self["results_dir"]
+        return test_case
+
+    def restore(self, record):
+        """
+        Restores the outcome of the test case, as recorded in the journal
+        of an interrupted run.
+        """
+        self["result"] = record["result"]
+        if record["duration"] is not None:
+            self["duration"] = \
+                datetime.timedelta(seconds=record["duration"])
+        self["test_dir"] = record["test_dir"]
+        self["xunit_section"] = record["xunit_section"]
+        return True
+
     def execute(self, device):
         """
         Prepare and executes the test case, storing the results.
@@ -146,13 +496,21 @@ class TestCase(dict):
         """
         self["device"] = device
         self["start_time"] = datetime.datetime.now()
-        logging.info("Test Start Time: {0}".format(self["start_time"]))
+        logging.info("Test Start Time: %s", self["start_time"])
         self._prepare()
         getattr(self, self["test"])()
         self["duration"] = datetime.datetime.now() - self["start_time"]
-        logging.info("Test Duration: {0}".format(self["duration"]))
+        logging.info("Test Duration: %s", self["duration"])
         self._build_xunit_section()
         return True
 
+    def execute_async(self, device):
+        """
+        Executes the test case in background, returning a Future.
+        """
+        return run_async(self.execute, device=device)
+
 
 # pylint: enable=too-few-public-methods
+
+collections.MutableMapping.register(TestCase)
@@ -18,10 +18,17 @@ Class implementing a Tester interface.
 
 import os
 import time
+import itertools
+import sqlite3
 import ConfigParser
 import logging
 
 from aft.classloader import ClassLoader
+from aft.resultstore import ResultStore
+from aft.concurrency import Deadline, run_until
+from aft.artifactstore import ArtifactStore
+from aft.logpipeline import close_log_files
+from aft.capabilities import parse_requirements
 
 VERSION = "0.1.0"
 
@@ -39,28 +46,127 @@ class Tester(object):
 
     _TEST_EXEC_ROOT = os.getenv("AFT_EXECROOT", "./aft_results.")
 
-    _start_time = 0
-    _end_time = 0
-    _results = []
-    _required_test_cases = []
-    _test_plan = []
-    _xunit_results = ""
+    ORDERINGS = ("plan", "fail_first", "shortest_first")
+    OUTPUT_POLICIES = ("keep", "release", "spill")
+    # Copy the results into the artifact store, or also turn the results
+    # directory into a view of the store, with <file>.gz links
+    ARTIFACT_MODES = ("copy", "view")
+    # Numbers the runs performed by the process, for unique run ids
+    _run_counter = itertools.count()
 
-    @classmethod
-    def init(cls, test_plan):
+    def __init__(self):
+        self._start_time = 0
+        self._end_time = 0
+        self._results = []
+        self._test_plan = []
+        self._requirements = []
+        self._journal = None
+        self._image = None
+        self._image_hash = None
+        self._ordering = "plan"
+        self._stop_on_failure = False
+        self._use_cache = False
+        self._output_policy = "keep"
+        self._store_artifacts = None
+        self._rerun_failed = 0
+        self._rerunner = None
+        self._deadline = Deadline()
+        self._results_dir = None
+        self._run_id = None
+
+# pylint: disable=too-many-arguments
+    def init(self, test_plan, journal=None, ordering="plan",
+             stop_on_failure=False, use_cache=False, output_policy="keep",
+             config=None, store_artifacts=None, rerun_failed=0):
+        """
+        Loads the test plan and sets the options of execution.
+        config is the test plan already parsed, if available.
+        store_artifacts is one of ARTIFACT_MODES, or None.
+        rerun_failed is the number of times a failed test case is rerun,
+        to tell flaky ones from real failures.
+        """
+        self._journal = journal
+        self._ordering = ordering
+        self._stop_on_failure = stop_on_failure
+        self._use_cache = use_cache
+        self._output_policy = output_policy
+        self._store_artifacts = store_artifacts
+        self._rerun_failed = rerun_failed
+        return self._build_test_plan(test_plan_file=test_plan, config=config)
+# pylint: enable=too-many-arguments
+
+    def set_rerunner(self, rerunner):
+        """
+        Other devices holding the image, where the failed test cases are
+        rerun while the test plan goes on; None to rerun them on the device
+        under test, at the end of the test plan.
+        """
+        self._rerunner = rerunner
+
+    def _new_run_id(self):
+        """
+        Allocates the identifier of the run, unique on the host at any
+        time: runs after the first one in the same process get a numbered
+        suffix.
+        """
+        runs = next(Tester._run_counter)
+        if runs:
+            self._run_id = "{0}.{1}".format(os.getpid(), runs)
+        else:
+            self._run_id = str(os.getpid())
+        return self._run_id
+
+    def new_results_dir(self):
+        """
+        Allocates the directory for the results of a new run.
+        """
+        self._results_dir = self._TEST_EXEC_ROOT + self._new_run_id()
+        return self._results_dir
+
+    def set_results_dir(self, results_dir):
         """
-        Initialization of Class variables
+        Overrides the directory holding the results, e.g. when resuming
+        an interrupted run.
         """
-        return cls._build_test_plan(test_plan_file=test_plan)
+        self._new_run_id()
+        self._results_dir = results_dir
 
-    @classmethod
-    def _build_test_plan(cls, test_plan_file):
+    def get_results_dir(self):
+        """
+        Directory holding the results of the run.
+        """
+        if self._results_dir is None:
+            self.new_results_dir()
+        return self._results_dir
+
+    def set_deadline(self, deadline):
+        """
+        Deadline for the execution of the whole test plan.
+        """
+        self._deadline = deadline
+
+    def get_requirements(self):
+        """
+        Returns the capabilities the device must have for the test plan:
+        the ones required by any of its test cases.
+        """
+        return list(self._requirements)
+
+    def set_image(self, file_name, image_hash):
+        """
+        Records which image is being tested, for the history of results.
+        """
+        self._image = file_name
+        self._image_hash = image_hash
+
+    def _build_test_plan(self, test_plan_file, config=None):
         """
         Gathers list of required test cases.
         """
-        config = ConfigParser.SafeConfigParser()
         try:
-            config.read(test_plan_file)
+            if config is None:
+                config = ConfigParser.SafeConfigParser()
+                config.read(test_plan_file)
             for test_case_name in config.sections():
                 tester = config.get(test_case_name, "tester")
                 test = config.get(test_case_name, "test")
@@ -76,90 +182,376 @@ class Tester(object):
                                              tester))
                     return False
 
-                cls._test_plan.append(
-                    tester_class(
-                        name=test_case_name,
-                        test=test,
-                        parameters=parameters,
-                        pass_regex=pass_regex,
-                        user=user))
-        except (ImportError, AttributeError, ConfigParser.Error) as error:
+                test_case = tester_class(name=test_case_name,
+                                         test=test,
+                                         parameters=parameters,
+                                         pass_regex=pass_regex,
+                                         user=user)
+                if config.has_option(test_case_name, "cacheable"):
+                    test_case["cacheable"] = \
+                        config.getboolean(test_case_name, "cacheable")
+                if config.has_option(test_case_name, "timeout"):
+                    test_case["timeout"] = \
+                        config.getfloat(test_case_name, "timeout")
+                if config.has_option(test_case_name, "requires"):
+                    self._requirements.extend(parse_requirements(
+                        config.get(test_case_name, "requires")))
+                self._test_plan.append(test_case)
+        except (ImportError, AttributeError, ValueError,
+                ConfigParser.Error) as error:
             logging.critical("Error while loading test plan {0}:\n{1}"
                              .format(test_plan_file, error))
             return False
-        if len(cls._test_plan) == 0:
+        if len(self._test_plan) == 0:
             logging.warn("Building test plan: no test cases available.")
             return False
         return True
 
-    @classmethod
-    def _execute_test_plan(cls, device):
+    def _order_test_plan(self, model):
+        """
+        Sorts the test plan according to the history of the test cases
+        on the device model. The sort is stable: cases without history,
+        or with the same score, keep the order of the plan.
+        """
+        if self._ordering == "plan":
+            return True
+        try:
+            store = ResultStore()
+            statistics = store.case_statistics(model=model)
+            store.close()
+        except (sqlite3.Error, OSError) as error:
+            logging.warn("No history available for ordering the test plan:"
+                         " {0}".format(error))
+            return True
+        if self._ordering == "fail_first":
+            def key(test_case):
+                """
+                Estimated failure probability, highest first. Unknown
+                cases count as 0.5, then the shortest ones come first.
+                """
+                history = statistics.get(test_case["name"],
+                                         {"runs": 0, "failures": 0,
+                                          "duration": None})
+                return (-(history["failures"] + 1.0) /
+                        (history["runs"] + 2.0),
+                        history["duration"] is None,
+                        history["duration"])
+        else:
+            def key(test_case):
+                """
+                Average duration, cases without history last.
+                """
+                duration = statistics.get(test_case["name"],
+                                          {}).get("duration")
+                return (duration is None, duration)
+        self._test_plan.sort(key=key)
+        logging.info("Test plan ordered by {0}: {1}"
+                     .format(self._ordering,
+                             [test_case["name"]
+                              for test_case in self._test_plan]))
+        return True
+
+    def _execute_test_case(self, test_case, device):
+        """
+        Executes the test case, unless the cache already holds the result
+        of an identical execution. Only passing results are cached, so
+        that failures are always confirmed.
+        """
+        if not (self._use_cache and test_case["cacheable"] and
+                self._image_hash is not None):
+            return test_case.execute(device=device)
+        key = test_case.cache_key(image_hash=self._image_hash,
+                                  model=device.model)
+        try:
+            store = ResultStore()
+            record = store.get_cached_case(key)
+            if record is not None:
+                logging.info("Reusing cached result of {0}."
+                             .format(test_case["name"]))
+                store.close()
+                return test_case.restore_cached(record)
+            result = test_case.execute(device=device)
+            if test_case["result"]:
+                store.cache_case(key, test_case)
+            store.close()
+            return result
+        except (sqlite3.Error, OSError) as error:
+            logging.warn("Test cases cache not available: {0}"
+                         .format(error))
+        if test_case["duration"] is None:
+            return test_case.execute(device=device)
+        return True
+
+    def _power_cycle(self, device):
+        """
+        Stops whatever is running on the device by cancelling its work and
+        power cycling it through its cutter channel, then waits for it to
+        be ready again, within the deadline of the test plan. Returns False
+        if it isn't.
+        """
+        logging.warn("Power cycling {0}.".format(device.name))
+        device.cancel()
+        device.detach()
+        if self._deadline.expired():
+            return False
+        device.attach()
+        return device.wait_until_ready(
+            timeout=self._deadline.bound(device.BOOT_TIMEOUT))
+
+    def _execute_within_deadline(self, test_case, device):
+        """
+        Executes the test case, giving up on it when its timeout or the
+        deadline of the test plan expires. Returns False in that case: the
+        work of the device is cancelled, killing the commands of the test
+        case, and the device must be power cycled.
+        """
+        cancellation = device.cancellation(
+            self._deadline.child(test_case["timeout"]))
+        with cancellation:
+            completed, _ = run_until(cancellation.deadline,
+                                     self._execute_test_case,
+                                     test_case=test_case, device=device)
+        if not completed:
+            logging.critical("Test case {0} exceeded its deadline on {1}."
+                             .format(test_case["name"], device.dev_id))
+            device.cancel()
+        return completed
+
+    def _rerun_test_case(self, device, test_case):
+        """
+        Executes copies of the failed test case on device, until one passes
+        or the attempts are over. Returns the copies executed.
+        """
+        reruns = []
+        for attempt in range(self._rerun_failed):
+            logging.info("Rerunning {0} on {1}, attempt {2} of {3}."
+                         .format(test_case["name"], device.dev_id,
+                                 attempt + 1, self._rerun_failed))
+            rerun = test_case.copy()
+            if not self._execute_within_deadline(test_case=rerun,
+                                                 device=device):
+                self._power_cycle(device)
+                break
+            reruns.append(rerun)
+            if rerun["result"]:
+                break
+        return reruns
+
+    def _collect_reruns(self, reruns, device, rerun_locally=True):
+        """
+        Classifies the failed test cases with their reruns, waiting for
+        the ones running on other devices. The ones no other device could
+        take are rerun on device, if rerun_locally.
+        """
+        for test_case in self._test_plan:
+            if test_case["name"] not in reruns:
+                continue
+            copies = None
+            if reruns[test_case["name"]] is not None:
+                try:
+                    copies = reruns[test_case["name"]].result()
+                # pylint: disable=broad-except
+                except Exception as error:
+                    logging.warn("Rerun of {0} failed on the other device:"
+                                 " {1}".format(test_case["name"], error))
+                # pylint: enable=broad-except
+            if copies is None and rerun_locally:
+                copies = self._rerun_test_case(device=device,
+                                               test_case=test_case)
+            if not copies:
+                continue
+            if test_case.record_reruns(copies):
+                logging.info("Test case {0} is flaky: passed on retry."
+                             .format(test_case["name"]))
+            else:
+                logging.info("Test case {0} failed consistently."
+                             .format(test_case["name"]))
+            if self._journal is not None:
+                self._journal.record_case(test_case)
+        return True
+
+    def _execute_test_plan(self, device):
         """
         Execute the test plan.
+        A test case exceeding its deadline is reported as an error and the
+        device is power cycled; if it doesn't recover, or the deadline of
+        the test plan expires, the remaining test cases are reported as
+        errors too.
         """
         logging.info("Executing the Test Plan")
-        if len(cls._test_plan) == 0:
+        if len(self._test_plan) == 0:
             logging.warn("No test cases available.")
         else:
-            test_cases_number = len(cls._test_plan)
+            test_cases_number = len(self._test_plan)
             logging.info("Test cases available: {0}"
                          .format(test_cases_number))
-            cls._start_time = time.time()
-            logging.info("Start time: {0}".format(cls._start_time))
-            counter = 0
-            for test_case in cls._test_plan:
-                counter = counter + 1
-                logging.info("Executing test case {0} of {1}"
-                             .format(counter, test_cases_number))
-                test_case.execute(device=device)
-            cls._end_time = time.time()
-            logging.info("End time: {0}".format(cls._end_time))
+            self._start_time = time.time()
+            logging.info("Start time: {0}".format(self._start_time))
+            self._order_test_plan(model=device.model)
+            failed = False
+            reruns = {}
+            abort_reason = None
+            for test_case in self._test_plan:
+                test_case["results_dir"] = self.get_results_dir()
+            for index, test_case in enumerate(self._test_plan):
+                counter = index + 1
+                if abort_reason is None and self._deadline.expired():
+                    logging.critical("The test plan exceeded its deadline.")
+                    abort_reason = "deadline of the test plan expired"
+                if abort_reason is not None:
+                    test_case.abort(abort_reason)
+                    continue
+                if failed and self._stop_on_failure:
+                    test_case.skip("stopped after first failure")
+                    continue
+                if self._journal is not None and \
+                        test_case["name"] in self._journal.cases:
+                    logging.info("Test case {0} of {1} already completed."
+                                 .format(counter, test_cases_number))
+                    test_case.restore(self._journal.cases[test_case["name"]])
+                else:
+                    logging.info("Executing test case {0} of {1}"
+                                 .format(counter, test_cases_number))
+                    if not self._execute_within_deadline(test_case=test_case,
+                                                         device=device):
+                        test_case = test_case.copy()
+                        test_case.abort("deadline expired")
+                        self._test_plan[index] = test_case
+                        if not self._power_cycle(device) and \
+                                not self._deadline.expired():
+                            logging.critical("Device {0} not recovered: "
+                                             "aborting the test plan."
+                                             .format(device.dev_id))
+                            abort_reason = "device not recovered after a " \
+                                           "deadline expired"
+                    elif self._journal is not None:
+                        self._journal.record_case(test_case)
+                    if self._rerun_failed and not test_case["result"] and \
+                            not test_case["aborted"]:
+                        reruns[test_case["name"]] = \
+                            self._rerunner.submit(self._rerun_test_case,
+                                                  test_case) \
+                            if self._rerunner is not None else None
+                if self._output_policy != "keep":
+                    test_case.release_output(
+                        spill=self._output_policy == "spill")
+                failed = failed or not test_case["result"]
+            self._collect_reruns(reruns=reruns, device=device,
+                                 rerun_locally=abort_reason is None)
+            self._end_time = time.time()
+            logging.info("End time: {0}".format(self._end_time))
         return True
 
-    @classmethod
-    def _results_to_xunit(cls):
-        """
-        Return test results formatted in xunit XML
-        """
-        xml = [('<?xml version="1.0" encoding="utf-8"?>\n'
-                '<testsuite errors="0" failures="{0}" '
-                .format(len([test_case for test_case in cls._test_plan
-                             if not test_case["result"]])) +
-                'name="aft.{0}.{1}" skips="0" '
-                .format(time.strftime("%Y%m%d%H%M%S",
-                                      time.localtime(cls._start_time)),
-                        os.getpid()) +
-                'tests="{0}" time="{1}">\n'
-                .format(len(cls._results),
-                        cls._end_time - cls._start_time))]
-        for test_case in cls._test_plan:
-            xml.append(test_case["xunit_section"])
-        xml.append('</testsuite>\n')
-        cls._xunit_results = "".join(xml)
-
-    @classmethod
-    def _save_test_results(cls):
+    def _run_name(self):
+        """
+        Unique name of the test run.
+        """
+        return "aft.{0}.{1}".format(time.strftime("%Y%m%d%H%M%S",
+                                                  time.localtime(
+                                                      self._start_time)),
+                                    self._run_id or self._new_run_id())
+
+    def _results_to_xunit(self, results):
+        """
+        Writes the test results, formatted in xunit XML, to the file
+        object results, one test case at a time.
+        """
+        results.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                      '<testsuite errors="{0}" failures="{1}" '
+                      .format(len([test_case for test_case in self._test_plan
+                                   if test_case["aborted"]]),
+                              len([test_case for test_case in self._test_plan
+                                   if not test_case["result"] and
+                                   not test_case["skipped"] and
+                                   not test_case["aborted"]])) +
+                      'flaky="{0}" '
+                      .format(len([test_case for test_case in self._test_plan
+                                   if test_case.get("flakiness") ==
+                                   "passed_on_retry"])) +
+                      'name="{0}" skips="{1}" '
+                      .format(self._run_name(),
+                              len([test_case for test_case in self._test_plan
+                                   if test_case["skipped"]])) +
+                      'tests="{0}" time="{1}">\n'
+                      .format(len(self._results),
+                              self._end_time - self._start_time))
+        for test_case in self._test_plan:
+            results.write(test_case.get_xunit_section())
+        results.write('</testsuite>\n')
+
+    def _save_test_results(self):
         """
         Store the test results.
         """
         logging.info("Storing the test results.")
-        cls._results_to_xunit()
-        results_filename = os.path.join(cls._test_plan[0]["test_dir"],
-                                        "..", "results.xml")
+        results_filename = os.path.join(self.get_results_dir(),
+                                        "results.xml")
         with open(results_filename, "w") as results:
-            results.write(cls._xunit_results)
+            self._results_to_xunit(results)
+        if self._journal is not None:
+            self._journal.finish()
         logging.info("Results saved to {0}.".format(results_filename))
         return True
 
-    @classmethod
-    def test(cls, device):
+    def _store_results(self, device):
+        """
+        Adds the run to the history of results. Failures are not fatal.
+        """
+        test_cases = []
+        for test_case in self._test_plan:
+            if test_case["skipped"] or test_case["cached"] or \
+                    test_case["aborted"]:
+                continue
+            record = dict(test_case)
+            record["tester"] = type(test_case).__name__
+            if test_case["duration"] is not None:
+                record["duration"] = test_case["duration"].total_seconds()
+            test_cases.append(record)
+        try:
+            store = ResultStore()
+            store.add_run(name=self._run_name(), start_time=self._start_time,
+                          end_time=self._end_time, test_cases=test_cases,
+                          image=self._image, image_hash=self._image_hash,
+                          device=device.dev_id, model=device.model,
+                          results_dir=self.get_results_dir())
+            store.close()
+        except (sqlite3.Error, OSError) as error:
+            logging.warn("Cannot store the results in the history: {0}"
+                         .format(error))
+        return True
+
+    def archive_results(self):
+        """
+        Stores the results directory in the artifact store, turning it
+        into a view of the store in "view" mode, if requested and if the
+        test plan was executed.
+        Must be called once the run is over and nothing more is logged
+        for it. Failures are not fatal.
+        """
+        if not self._store_artifacts or not self._end_time:
+            return True
+        close_log_files()
+        failed = any(not test_case["result"] and not test_case["skipped"]
+                     for test_case in self._test_plan)
+        make_view = self._store_artifacts == "view"
+        try:
+            ArtifactStore().store_run(name=self._run_name(),
+                                      results_dir=self.get_results_dir(),
+                                      failed=failed, make_view=make_view)
+        except (OSError, IOError) as error:
+            logging.warn("Cannot store the artifacts: {0}".format(error))
+        return True
+
+    def test(self, device):
         """
         Run specific test cases and save the results.
         """
-        if not cls._execute_test_plan(device=device):
+        if not self._execute_test_plan(device=device):
             logging.critical("Failed to execute the test plan.")
-        elif not cls._save_test_results():
+        elif not self._save_test_results():
             logging.critical("Failed to save the test plan.")
+        elif not self._store_results(device=device):
+            logging.critical("Failed to store the test results.")
         else:
             logging.info("Test completed.")
             return True